@@ -0,0 +1,114 @@
+import asyncio
+import time
+
+import constants
+import metrics
+
+# Admission control for CPU-heavy routes. Requests are grouped into route classes; each class admits a limited number
+# of concurrent requests and lets a bounded number wait for a free slot. When the queue is full, or a request waits
+# longer than the queue timeout, it is rejected straight away with 503 and Retry-After instead of piling up behind the
+# crypto work and starving the cheap pages. Routes outside every class are never limited.
+
+# Route classes: name -> (HTTP methods, exact paths, path prefixes)
+ROUTE_CLASSES = {
+    "crypto": (
+        {"POST"},
+        {"/login", "/token", "/purchase", "/download_private_key", "/create_user", "/derived_key",
+         "/api/v1/purchase_orders"},
+        ("/view_purchase_order/", "/review_purchase_order/", "/api/v1/purchase_orders/"),
+    ),
+}
+
+ACTIVE = metrics.Gauge("admission_active_requests", "Requests currently admitted per route class", ["route_class"])
+WAITING = metrics.Gauge("admission_waiting_requests", "Requests waiting for admission per route class",
+                        ["route_class"])
+LIMIT = metrics.Gauge("admission_limit", "Configured concurrency limit and queue size per route class",
+                      ["route_class", "kind"])
+ADMITTED = metrics.Counter("admission_admitted_total", "Requests admitted per route class", ["route_class"])
+REJECTED = metrics.Counter("admission_rejected_total", "Requests rejected per route class and reason",
+                           ["route_class", "reason"])
+WAIT_TIME = metrics.Histogram("admission_wait_seconds", "Time spent waiting for admission", ["route_class"])
+
+
+class Limiter:
+
+    def __init__(self, name: str, limit: int, queue_size: int, timeout: float):
+        self.name = name
+        self.limit = limit
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.waiting = 0
+        # created on first use so it binds to the server's event loop rather than the import-time one
+        self.semaphore = None
+        LIMIT.set(limit, route_class=name, kind="concurrency")
+        LIMIT.set(queue_size, route_class=name, kind="queue")
+
+    async def acquire(self):
+        # Returns True once the request holds a slot, False if it was rejected.
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.limit)
+
+        if self.semaphore.locked():
+            if self.waiting >= self.queue_size:
+                REJECTED.inc(route_class=self.name, reason="queue_full")
+                return False
+
+            self.waiting += 1
+            WAITING.set(self.waiting, route_class=self.name)
+            start = time.perf_counter()
+            try:
+                if not await self.acquire_within(self.timeout):
+                    REJECTED.inc(route_class=self.name, reason="timeout")
+                    return False
+            finally:
+                self.waiting -= 1
+                WAITING.set(self.waiting, route_class=self.name)
+            WAIT_TIME.observe(time.perf_counter() - start, route_class=self.name)
+        else:
+            await self.semaphore.acquire()
+            WAIT_TIME.observe(0, route_class=self.name)
+
+        ACTIVE.inc(route_class=self.name)
+        ADMITTED.inc(route_class=self.name)
+        return True
+
+    async def acquire_within(self, timeout: float):
+        # Waits up to timeout for a slot and returns whether the caller holds one. wait_for could cancel an acquire
+        # that had just succeeded and lose the slot for good, so a slot won in that race (or while the caller itself is
+        # cancelled) is handed back.
+        task = asyncio.ensure_future(self.semaphore.acquire())
+        try:
+            done, _ = await asyncio.wait({task}, timeout=timeout)
+        except BaseException:
+            await self.abandon(task)
+            raise
+        if done:
+            return True
+        await self.abandon(task)
+        return False
+
+    async def abandon(self, task):
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            return
+        self.semaphore.release()
+
+    def release(self):
+        ACTIVE.dec(route_class=self.name)
+        self.semaphore.release()
+
+
+limiters = {
+    "crypto": Limiter("crypto", constants.CRYPTO_CONCURRENCY, constants.CRYPTO_QUEUE_SIZE,
+                      constants.CRYPTO_QUEUE_TIMEOUT),
+}
+
+
+def limiter_for(method: str, path: str):
+    # Returns the limiter for the route class of a request, or None if the route is not limited.
+    for name, (methods, paths, prefixes) in ROUTE_CLASSES.items():
+        if method in methods and (path in paths or path.startswith(prefixes)):
+            return limiters[name]
+    return None
@@ -0,0 +1,135 @@
+from uuid import UUID
+
+from fastapi import APIRouter, Depends, Header, UploadFile, File, status
+from fastapi.responses import ORJSONResponse
+from typing import List, Optional
+
+import auth
+import methods
+import models
+import exceptions
+
+# JSON mirror of the HTML routes for internal tooling, authenticated with a bearer token from /token. Responses are
+# serialized with orjson, and errors are HTTP errors with a JSON {"detail": ...} body and a meaningful status code.
+
+ERRORS = {
+    status.HTTP_401_UNAUTHORIZED: {"model": models.Error},
+    status.HTTP_403_FORBIDDEN: {"model": models.Error},
+    status.HTTP_404_NOT_FOUND: {"model": models.Error},
+    status.HTTP_409_CONFLICT: {"model": models.Error},
+}
+
+router = APIRouter(prefix="/api/v1", default_response_class=ORJSONResponse, responses=ERRORS)
+
+
+def summary(row):
+    # Converts a purchase order row into the fields of models.PurchaseOrderSummary.
+    return {
+        "purchase_order_id": row['purchase_order_id'],
+        "purchase_order_number": row['purchase_order_number'],
+        "sender_id": row['sender_id'],
+        "recipient_id": row['recipient_id'],
+        "purchaser_id": row['purchaser_id'],
+        "sender_name": row['sender_name'],
+        "recipient_name": row['recipient_name'],
+        "purchaser_name": row['purchaser_name'],
+        "sent_timestamp": row['sent_timestamp'],
+        "reviewed_timestamp": row['reviewed_timestamp'],
+        "status": methods.status_of(row),
+    }
+
+
+async def get_participating_purchase_order(po_id: UUID, user):
+    po = await methods.get_purchase_order(po_id)
+    if po is None:
+        raise exceptions.API_404_NOT_FOUND_EXCEPTION
+    if user['user_id'] not in (po.recipient_id, po.sender_id, po.purchaser_id):
+        raise exceptions.API_403_FORBIDDEN_EXCEPTION
+    return po
+
+
+@router.get("/users", response_model=List[models.UserOut])
+async def users(user=Depends(auth.get_current_user_from_token)):
+    return [
+        {
+            "user_id": row['user_id'],
+            "email": row['email'],
+            "first_name": row['first_name'],
+            "last_name": row['last_name'],
+            "role": row['role_name']
+        }
+        for row in await methods.get_users()
+    ]
+
+
+@router.get("/users/{user_id}/public_key", response_model=models.PublicKeyOut)
+async def public_key(user_id: UUID, user=Depends(auth.get_current_user_from_token)):
+    key = await methods.get_public_key(user_id)
+    if key is None:
+        raise exceptions.API_404_NOT_FOUND_EXCEPTION
+    return {"user_id": user_id, "public_key": key}
+
+
+@router.get("/purchase_orders", response_model=models.PurchaseOrderPage)
+async def purchase_orders(
+        user=Depends(auth.get_current_user_from_token),
+        filters: models.PurchaseOrderFilter = Depends(methods.parse_purchase_order_filter),
+        before: Optional[int] = None,
+        limit: int = 50
+):
+    pos, next_before = await methods.search_purchase_orders(user, filters, before, limit)
+    return {"items": [summary(po) for po in pos], "next_before": next_before}
+
+
+@router.post("/purchase_orders", response_model=models.PurchaseOrderSummary, status_code=status.HTTP_201_CREATED)
+async def submit_purchase_order(
+        order: models.PurchaseOrderIn,
+        user=Depends(auth.get_current_user_from_token),
+        idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")
+):
+    po_id, _ = await methods.create_purchase_order(
+        user,
+        order.supervisor_id,
+        order.supplier_name,
+        order.supplier_contact,
+        order.supplier_address,
+        [item.dict() for item in order.items],
+        order.password,
+        idempotency_key
+    )
+    return summary(await methods.get_purchase_order(po_id))
+
+
+@router.get("/purchase_orders/{po_id}", response_model=models.PurchaseOrderSummary)
+async def purchase_order(po_id: UUID, user=Depends(auth.get_current_user_from_token)):
+    return summary(await get_participating_purchase_order(po_id, user))
+
+
+@router.post("/purchase_orders/{po_id}/open", response_model=models.PurchaseOrderDetail)
+async def open_purchase_order(po_id: UUID, body: models.PasswordIn, user=Depends(auth.get_current_user_from_token)):
+    po = await get_participating_purchase_order(po_id, user)
+    opened = await methods.open_purchase_order(po, user, body.password)
+    return {**summary(po), **opened}
+
+
+@router.post("/purchase_orders/{po_id}/attachments", response_model=models.AttachmentOut,
+             status_code=status.HTTP_201_CREATED)
+async def add_attachment(po_id: UUID, file: UploadFile = File(...), user=Depends(auth.get_current_user_from_token)):
+    # Download links are handed out by /open, which unwraps the attachment keys.
+    po = await get_participating_purchase_order(po_id, user)
+    row = await methods.add_attachment(po, user, file)
+    return {key: row[key] for key in ("attachment_id", "file_name", "content_type", "size", "sha256")}
+
+
+@router.post("/purchase_orders/{po_id}/review", response_model=models.PurchaseOrderSummary)
+async def review_purchase_order(
+        po_id: UUID,
+        body: models.ReviewIn,
+        user=Depends(auth.get_current_user_from_token),
+        idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")
+):
+    po = await get_participating_purchase_order(po_id, user)
+    if user['user_id'] != po.recipient_id:
+        raise exceptions.API_403_FORBIDDEN_EXCEPTION
+    await methods.review(po, user, body.purchaser_id, body.password, body.accept, idempotency_key)
+    return summary(await methods.get_purchase_order(po_id))
@@ -0,0 +1,273 @@
+import base64
+import hashlib
+import json
+import os
+import re
+import struct
+import time
+import urllib.parse
+import uuid
+
+import aiofiles
+
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from fastapi import HTTPException, status
+from sqlalchemy.sql import select, exists
+
+import constants
+import crypto
+import exceptions
+import tables
+
+from database import database
+
+# Encrypted purchase order attachments (supplier quotes, invoices). An upload is read from the UploadFile in chunks of
+# ATTACHMENT_CHUNK_SIZE bytes, each encrypted with AES-256-GCM under a fresh per-file key, and appended to a file under
+# MEDIA_ROOT/attachments, so memory use does not depend on the file size. The file key is wrapped with PGP for the
+# order's participants, like the order itself, and re-wrapped for the purchaser when the order is reviewed.
+#
+# Chunk i is sealed with the nonce (nonce prefix, i) and authenticates the attachment id, i and whether it is the last
+# chunk, so chunks cannot be reordered, swapped between files or cut off. Every sealed chunk but the last is exactly
+# chunk_size + 16 bytes long, so a byte range maps straight to the chunks that hold it and downloads decrypt only those.
+#
+# Opening an order (which needs the user's password) unwraps its attachment keys and hands out download links. A link
+# carries the file key sealed under a key derived from SECRET_KEY, is bound to the user and expires after
+# ATTACHMENT_LINK_MINUTES.
+#
+# Orders live in two tables (and move between them when archived), so attachments cannot reference them with a foreign
+# key. Deleting a user, which deletes their orders, removes the attachments left without an order; `python manage.py
+# sweep-attachments` also removes stored files that no attachment refers to, e.g. from interrupted uploads.
+
+TAG_SIZE = 16
+RANGE = re.compile(r"^bytes=(\d*)-(\d*)$")
+# content types shown in the browser; everything else, whatever the uploader claimed, is downloaded as octet-stream
+INLINE_TYPES = {"application/pdf", "image/png", "image/jpeg", "image/gif", "image/webp", "text/plain"}
+
+
+def storage_path(attachment_id):
+    return os.path.join(constants.MEDIA_ROOT, "attachments", str(attachment_id)[:2], "{}.bin".format(attachment_id))
+
+
+def nonce(prefix: bytes, index: int):
+    return prefix + struct.pack(">I", index)
+
+
+def associated_data(attachment_id, index: int, last: bool):
+    return uuid.UUID(str(attachment_id)).bytes + struct.pack(">I?", index, last)
+
+
+async def store(upload, po, uploader_id, recipients):
+    # Encrypts an UploadFile chunk by chunk into MEDIA_ROOT, wraps its key for the recipients (armored public keys) and
+    # records it. Returns the attachment row.
+    attachment_id = uuid.uuid4()
+    chunk_size = constants.ATTACHMENT_CHUNK_SIZE
+    file_key = AESGCM.generate_key(bit_length=256)
+    aead = AESGCM(file_key)
+    prefix = os.urandom(8)
+    digest = hashlib.sha256()
+    path = storage_path(attachment_id)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    size = 0
+    index = 0
+    try:
+        async with aiofiles.open(path + ".part", "wb") as file:
+            chunk = await upload.read(chunk_size)
+            while True:
+                following = await upload.read(chunk_size) if len(chunk) == chunk_size else b""
+                size += len(chunk)
+                if size > constants.ATTACHMENT_MAX_BYTES:
+                    raise exceptions.API_413_ATTACHMENT_TOO_LARGE_EXCEPTION
+                digest.update(chunk)
+                last = not following
+                await file.write(aead.encrypt(nonce(prefix, index), chunk,
+                                              associated_data(attachment_id, index, last)))
+                if last:
+                    break
+                chunk = following
+                index += 1
+        os.replace(path + ".part", path)
+    except BaseException:
+        if os.path.exists(path + ".part"):
+            os.remove(path + ".part")
+        raise
+
+    try:
+        wrapped_key = await crypto.run(crypto.wrap_key, file_key, recipients)
+        query = tables.purchase_order_attachments.insert().values(
+            attachment_id=attachment_id,
+            purchase_order_id=po.purchase_order_id,
+            uploader_id=uploader_id,
+            file_name=os.path.basename(upload.filename or "attachment")[:255],
+            content_type=(upload.content_type or "application/octet-stream")[:100],
+            size=size,
+            chunk_size=chunk_size,
+            nonce_prefix=prefix.hex(),
+            sha256=digest.hexdigest(),
+            wrapped_key=wrapped_key
+        )
+        await database.execute(query)
+    except BaseException:
+        os.remove(path)
+        raise
+    return await get_attachment(attachment_id)
+
+
+async def remove_orphans():
+    # Deletes the attachments whose order exists in neither purchase_orders nor purchase_orders_archive, and their
+    # files. Returns the number removed.
+    a = tables.purchase_order_attachments
+    query = a.delete().where(
+        ~exists().where(tables.purchase_orders.c.purchase_order_id == a.c.purchase_order_id)).where(
+        ~exists().where(tables.purchase_orders_archive.c.purchase_order_id == a.c.purchase_order_id)
+    ).returning(a.c.attachment_id)
+    rows = await database.fetch_all(query)
+    for row in rows:
+        path = storage_path(row['attachment_id'])
+        if os.path.exists(path):
+            os.remove(path)
+    return len(rows)
+
+
+async def sweep(min_age_seconds: float = 3600):
+    # Removes orphaned attachments and then every file under MEDIA_ROOT/attachments older than min_age_seconds that no
+    # attachment refers to; younger files may belong to uploads still being stored. Returns (attachments, files).
+    removed = await remove_orphans()
+    root = os.path.join(constants.MEDIA_ROOT, "attachments")
+    cutoff = time.time() - min_age_seconds
+    candidates = {}
+    for directory, _, names in os.walk(root):
+        for name in names:
+            path = os.path.join(directory, name)
+            if os.path.getmtime(path) >= cutoff:
+                continue
+            try:
+                candidates[path] = uuid.UUID(name.split(".")[0])
+            except ValueError:
+                candidates[path] = None
+
+    ids = [attachment_id for attachment_id in candidates.values() if attachment_id is not None]
+    known = set()
+    for start in range(0, len(ids), 500):
+        query = select([tables.purchase_order_attachments.c.attachment_id]).where(
+            tables.purchase_order_attachments.c.attachment_id.in_(ids[start:start + 500]))
+        known.update(str(row['attachment_id']) for row in await database.fetch_all(query))
+
+    files = 0
+    for path, attachment_id in candidates.items():
+        if path.endswith(".bin") and str(attachment_id) in known:
+            continue
+        os.remove(path)
+        files += 1
+    return removed, files
+
+
+async def get_attachment(attachment_id):
+    query = select([tables.purchase_order_attachments]).where(
+        tables.purchase_order_attachments.c.attachment_id == attachment_id)
+    return await database.fetch_one(query)
+
+
+async def attachments_of(po_id):
+    query = select([tables.purchase_order_attachments]).where(
+        tables.purchase_order_attachments.c.purchase_order_id == po_id
+    ).order_by(tables.purchase_order_attachments.c.created_timestamp)
+    return await database.fetch_all(query)
+
+
+def _link_key():
+    return hashlib.sha256("attachment-links:{}".format(constants.SECRET_KEY).encode('utf-8')).digest()
+
+
+def link_token(user_id, attachment_id, file_key: bytes):
+    # A download token for one user and attachment, carrying the file key sealed under the server's link key.
+    payload = json.dumps({
+        "u": str(user_id),
+        "a": str(attachment_id),
+        "k": file_key.hex(),
+        "exp": int(time.time() + constants.ATTACHMENT_LINK_MINUTES * 60),
+    }).encode('utf-8')
+    token_nonce = os.urandom(12)
+    return base64.urlsafe_b64encode(token_nonce + AESGCM(_link_key()).encrypt(token_nonce, payload, None)).decode()
+
+
+def file_key_of(token: str, user_id, attachment_id):
+    # The file key in a download token, or None if the token is invalid, expired or not for this user and attachment.
+    try:
+        raw = base64.urlsafe_b64decode(token.encode())
+        payload = json.loads(AESGCM(_link_key()).decrypt(raw[:12], raw[12:], None))
+    except (ValueError, InvalidTag):
+        return None
+    if payload["u"] != str(user_id) or payload["a"] != str(attachment_id) or payload["exp"] < time.time():
+        return None
+    return bytes.fromhex(payload["k"])
+
+
+def links(user_id, rows, file_keys):
+    # Attachment metadata with download links for the attachments whose key the user could unwrap.
+    return [
+        {
+            "attachment_id": row['attachment_id'],
+            "file_name": row['file_name'],
+            "content_type": row['content_type'],
+            "size": row['size'],
+            "sha256": row['sha256'],
+            "url": None if file_key is None else "/attachments/{}?token={}".format(
+                row['attachment_id'], link_token(user_id, row['attachment_id'], file_key)),
+        }
+        for row, file_key in zip(rows, file_keys)
+    ]
+
+
+def download_headers(row):
+    # (media type, headers) for serving an attachment. Only INLINE_TYPES are shown inline; nothing is sniffed, and
+    # everything but PDFs (whose browser viewers do not run sandboxed) is sandboxed, so an uploaded file can never run
+    # script on the app's origin.
+    content_type = (row['content_type'] or "").split(";")[0].strip().lower()
+    inline = content_type in INLINE_TYPES
+    headers = {
+        "Content-Disposition": "{}; filename*=UTF-8''{}".format("inline" if inline else "attachment",
+                                                                urllib.parse.quote(row['file_name'])),
+        "X-Content-Type-Options": "nosniff",
+    }
+    if content_type != "application/pdf":
+        headers["Content-Security-Policy"] = "sandbox"
+    return (content_type if inline else "application/octet-stream"), headers
+
+
+def byte_range(header: str, size: int):
+    # (first, last) byte of a single `bytes=` range, None for no or an unsupported range header, which is answered
+    # with the whole file. Raises 416 for a range outside the file.
+    match = RANGE.match(header or "")
+    if match is None or match.groups() == ("", ""):
+        return None
+    start, end = match.groups()
+    if start == "":
+        first, last = max(0, size - int(end)), size - 1
+    else:
+        first, last = int(start), min(int(end), size - 1) if end else size - 1
+    if first >= size or first > last:
+        raise HTTPException(status_code=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
+                            headers={"Content-Range": "bytes */{}".format(size)})
+    return first, last
+
+
+async def decrypted(row, file_key: bytes, first: int, last: int):
+    # Yields the plaintext bytes first..last of an attachment, reading and decrypting one chunk at a time.
+    aead = AESGCM(file_key)
+    chunk_size = row['chunk_size']
+    prefix = bytes.fromhex(row['nonce_prefix'])
+    last_index = max(0, -(-row['size'] // chunk_size) - 1)
+    if last < first:
+        return
+    async with aiofiles.open(storage_path(row['attachment_id']), "rb") as file:
+        index = first // chunk_size
+        await file.seek(index * (chunk_size + TAG_SIZE))
+        while index * chunk_size <= last:
+            sealed = await file.read(chunk_size + TAG_SIZE)
+            chunk = aead.decrypt(nonce(prefix, index), sealed,
+                                 associated_data(row['attachment_id'], index, index == last_index))
+            offset = index * chunk_size
+            yield chunk[max(0, first - offset):last - offset + 1]
+            index += 1
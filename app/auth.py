@@ -6,20 +6,28 @@ from fastapi.responses import RedirectResponse
 from jose import JWTError, jwt
 from passlib.context import CryptContext
 
+from pgpy import PGPKey
+from pgpy.constants import HashAlgorithm, SymmetricKeyAlgorithm
+
 from models import UserAuthIn, User, TokenData
-from tables import users, roles, user_roles
-from database import database
+from tables import users, roles, user_roles, private_keys, token_revocations
+from database import database, reads
+from sqlalchemy import func
 from sqlalchemy.sql import select
-from hashlib import sha256
-from base64 import urlsafe_b64encode
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from pydantic import ValidationError
 
-import bcrypt
+import asyncio
+import logging
 import exceptions
 import constants
+import kdf
+import tracing
 
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 300
-SALT_ROUNDS = 12
+
+logger = logging.getLogger(__name__)
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
@@ -27,13 +35,15 @@ oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
 
 def verify_password(plain_password, hashed_password):
-    # Compares a plain password (with added salt) with a stored hashed password to validate user credentials.
-    return bcrypt.checkpw(plain_password.encode("utf-8"), hashed_password.encode("utf-8"))
+    # Compares a plain password (with added salt) with a stored hashed password to validate user credentials. The
+    # stored hash records its own KDF scheme and parameters.
+    with tracing.span("kdf.verify_password"):
+        return kdf.verify_password(plain_password, hashed_password)
 
 
 def get_password_hash(password):
-    # Hashes a password combined with salt using bcrypt, used for securely storing user passwords.
-    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(SALT_ROUNDS)).decode('utf-8')
+    # Hashes a password with the current KDF scheme and parameters, used for securely storing user passwords.
+    return kdf.hash_password(password)
 
 
 async def get_user_by_id(user_id: str):
@@ -50,16 +60,17 @@ async def get_user_by_email(email: str):
     return user
 
 
-async def get_user_with_roles(email: str):
+async def get_user_with_roles(email: str, primary: bool = False):
+    # The user with their role name. Reads may be served by the replica unless primary is set.
     query = select([users]).where(users.c.email == email.lower())
-    user_result = await database.fetch_one(query)
+    user_result = await reads.fetch_one(query, primary=primary)
 
     if user_result:
         user = dict(user_result)
         role_query = select([roles]).select_from(
             roles.join(user_roles, roles.c.role_name == user_roles.c.role_name)
         ).where(user_roles.c.user_id == user['user_id'])
-        role = await database.fetch_one(role_query)
+        role = await reads.fetch_one(role_query, primary=primary)
 
         if role:
             user['role'] = role['role_name']
@@ -77,9 +88,47 @@ async def authenticate_user(email: str, password: str):
         return False
     if not verify_password(password, user.password):
         return False
+    await upgrade_credentials(user, password)
     return user
 
 
+async def upgrade_credentials(user, password: str):
+    # After a successful login, re-hashes the password and re-protects the private key if either was made with KDF
+    # parameters other than the current ones. This is the only moment the plain password is available, so parameter
+    # changes roll out transparently as users sign in. Failures are logged and never block the login.
+    query = select([private_keys]).where(private_keys.c.user_id == user.user_id)
+    private_key = await database.fetch_one(query)
+
+    update_password = kdf.needs_update(user.password)
+    update_private_key = private_key is not None and kdf.needs_update(private_key['salt'])
+    if not update_password and not update_private_key:
+        return
+
+    try:
+        async with database.transaction():
+            if update_password:
+                query = users.update().where(users.c.user_id == user.user_id).values(
+                    password=get_password_hash(password)
+                )
+                await database.execute(query)
+
+            if update_private_key:
+                salt = kdf.new_salt()
+                key = PGPKey()
+                key.parse(private_key['private_key'])
+                with key.unlock(kdf.derive_key(password, private_key['salt'])):
+                    key.protect(kdf.derive_key(password, salt), SymmetricKeyAlgorithm.AES256, HashAlgorithm.SHA256)
+                    protected_key = str(key)
+
+                query = private_keys.update().where(private_keys.c.user_id == user.user_id).values(
+                    private_key=protected_key,
+                    salt=salt
+                )
+                await database.execute(query)
+    except Exception as e:
+        logger.warning(f"credential upgrade failed for user_id={user.user_id}: {e}")
+
+
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     # Creates a JWT access token with an optional expiry time. This token is used for secure user sessions.
     to_encode = data.copy()
@@ -92,40 +141,116 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     return encoded_jwt
 
 
-async def get_current_user(request: Request):
-    token = request.cookies.get("access_token")
-    if not token:
-        return None
+class TokenRevocations:
+    # In-memory copy of the token_revocations table: the minimum valid token version per user. Access tokens carry
+    # the user's id, role and token version, so authorizing a request needs no database query; bumping a user's
+    # version (on deletion or a role change) revokes every token issued before. Each worker reloads the table every
+    # TOKEN_REVOCATION_REFRESH_SECONDS and applies its own bumps immediately. Rows older than the token lifetime are
+    # pruned, since every token they could revoke has expired.
+
+    def __init__(self):
+        self.versions = {}
+
+    def is_revoked(self, user_id, version: int):
+        return version < self.versions.get(str(user_id), 0)
+
+    async def current_version(self, user_id):
+        query = select([token_revocations.c.token_version]).where(token_revocations.c.user_id == user_id)
+        return await database.execute(query) or 0
+
+    async def revoke(self, user_id):
+        query = pg_insert(token_revocations).values(user_id=user_id, token_version=1)
+        query = query.on_conflict_do_update(
+            index_elements=[token_revocations.c.user_id],
+            set_={"token_version": token_revocations.c.token_version + 1, "revoked_timestamp": func.now()}
+        ).returning(token_revocations.c.token_version)
+        self.versions[str(user_id)] = await database.fetch_val(query)
+
+    async def refresh(self):
+        expired = datetime.utcnow() - timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+        await database.execute(token_revocations.delete().where(token_revocations.c.revoked_timestamp < expired))
+        rows = await database.fetch_all(select([token_revocations.c.user_id, token_revocations.c.token_version]))
+        self.versions = {str(row['user_id']): row['token_version'] for row in rows}
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(constants.TOKEN_REVOCATION_REFRESH_SECONDS)
+            try:
+                await self.refresh()
+            except Exception as e:
+                logger.warning(f"token revocation refresh failed: {e}")
+
+
+revocations = TokenRevocations()
+
+
+async def create_user_token(user):
+    # Creates an access token carrying the claims get_user_from_token needs to authorize without the database.
+    # the claims must not come from a lagging replica
+    user = await get_user_with_roles(user['email'], primary=True)
+    version = await revocations.current_version(user['user_id'])
+    access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+    return create_access_token(
+        data={
+            "sub": user['email'],
+            "uid": str(user['user_id']),
+            "role": user['role'],
+            "ver": version,
+            "first_name": user['first_name'],
+            "last_name": user['last_name'],
+        },
+        expires_delta=access_token_expires
+    )
 
-    if token.startswith("Bearer "):
-        token = token[7:]
 
+async def get_user_from_token(token: str):
+    # Returns the user a token was issued to, or None if it is invalid, expired or revoked. Tokens issued before they
+    # carried claims fall back to a database lookup.
     try:
         payload = jwt.decode(token, constants.SECRET_KEY, algorithms=[ALGORITHM])
         email: str = payload.get("sub")
         if email is None:
             return None
-        token_data = TokenData(email=email)
-    except JWTError:
+        token_data = TokenData(
+            email=email,
+            user_id=payload.get("uid"),
+            role=payload.get("role"),
+            version=payload.get("ver", 0),
+            first_name=payload.get("first_name"),
+            last_name=payload.get("last_name"),
+        )
+    except (JWTError, ValidationError):
         return None
-    user = await get_user_with_roles(email=token_data.email)
-    if user is None:
+
+    if token_data.user_id is None:
+        return await get_user_with_roles(email=token_data.email)
+
+    if revocations.is_revoked(token_data.user_id, token_data.version):
         return None
-    return user
+    return {
+        "user_id": token_data.user_id,
+        "email": token_data.email,
+        "first_name": token_data.first_name,
+        "last_name": token_data.last_name,
+        "role": token_data.role,
+    }
+
+
+async def get_current_user(request: Request):
+    token = request.cookies.get("access_token")
+    if not token:
+        return None
+
+    if token.startswith("Bearer "):
+        token = token[7:]
+
+    return await get_user_from_token(token)
 
 
 async def get_current_user_from_token(token: str = Depends(oauth2_scheme)):
     # Extracts and verifies the JWT token to retrieve the current user's information. Throws an exception if the token
     # is invalid.
-    try:
-        payload = jwt.decode(token, constants.SECRET_KEY, algorithms=[ALGORITHM])
-        email: str = payload.get("sub")
-        if email is None:
-            raise exceptions.API_401_CREDENTIALS_EXCEPTION
-        token_data = TokenData(username=email)
-    except JWTError:
-        raise exceptions.API_401_CREDENTIALS_EXCEPTION
-    user = await get_user_with_roles(email=token_data.email)
+    user = await get_user_from_token(token)
     if user is None:
         raise exceptions.API_401_CREDENTIALS_EXCEPTION
     return user
@@ -141,10 +266,7 @@ async def login_for_access_token(form_data):
             detail="Incorrect email or password",
             headers={"WWW-Authenticate": "Bearer"},
         )
-    access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-    access_token = create_access_token(
-        data={"sub": user.email}, expires_delta=access_token_expires
-    )
+    access_token = await create_user_token(user)
 
     return {"access_token": access_token, "token_type": "bearer"}
 
@@ -156,10 +278,7 @@ async def login_for_access_cookie(username: str, password: str):
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect username or password"
         )
-    access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-    access_token = create_access_token(
-        data={"sub": user.email}, expires_delta=access_token_expires
-    )
+    access_token = await create_user_token(user)
     response = RedirectResponse(url="/", status_code=status.HTTP_303_SEE_OTHER)
     response.set_cookie(key="access_token", value=f"Bearer {access_token}", httponly=True)
 
@@ -167,12 +286,13 @@ async def login_for_access_cookie(username: str, password: str):
 
 
 async def get_derived_key(password, salt):
-    bcrypt_hash = bcrypt.hashpw(password.encode('utf-8'), salt)
-    sha256_hash = sha256(bcrypt_hash).digest()
-    key = urlsafe_b64encode(sha256_hash)
-
-    return key
+    # Derives the passphrase of a user's private key from their password and the KDF record stored as their salt.
+    if isinstance(salt, bytes):
+        salt = salt.decode('utf-8')
+    with tracing.span("kdf.derive_key"):
+        return kdf.derive_key(password, salt)
 
 
 async def gensalt():
-    return bcrypt.gensalt(SALT_ROUNDS)
+    # Returns a new private key KDF record for the current scheme and parameters.
+    return kdf.new_salt().encode('utf-8')
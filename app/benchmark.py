@@ -0,0 +1,509 @@
+import argparse
+import asyncio
+import csv
+import inspect
+import io
+import jinja2
+import json
+import platform
+import statistics
+import time
+import types
+
+import pgpy
+
+from pgpy import PGPKey, PGPMessage
+from pgpy.constants import HashAlgorithm, SymmetricKeyAlgorithm
+from sqlalchemy import desc
+from sqlalchemy.sql import select, or_
+from datetime import datetime, date, timedelta
+
+import auth
+import constants
+import crypto
+import fixtures
+import kdf
+import methods
+import models
+import tables
+import timestamping
+
+from database import database
+
+# Microbenchmarks for the operations that dominate request time: password hashing and key derivation, PGP key
+# generation, parsing, unlocking, signing, encryption, decryption and verification, and purchase order formatting.
+# Every case calls the real functions from auth.py and methods.py with synthetic keys and orders.
+#
+# Run it inside the server container so the environment matches production:
+#
+#   docker compose exec server python benchmark.py --output before.json
+#   docker compose exec server python benchmark.py --compare before.json
+#
+# --compare prints the relative change of each case against a previously saved report. The database group
+# (--groups db) needs the database and seeds synthetic rows inside a transaction that is rolled back afterwards.
+
+PASSWORD = "benchmark-password"
+
+GROUPS = {}
+DEFAULT_GROUPS = []
+
+
+def group(name, default=True):
+    # Registers a benchmark group. A group is a function or async generator function that receives the parsed
+    # arguments and yields (case name, callable, rounds) tuples; callables may be plain functions or coroutine
+    # functions. Groups that are not default only run when selected with --groups.
+    def decorator(func):
+        GROUPS[name] = func
+        if default:
+            DEFAULT_GROUPS.append(name)
+        return func
+
+    return decorator
+
+
+def new_key(profile, name="Bench User", email="bench@example.com"):
+    return crypto.generate_key(name, email, profile)
+
+
+def protected_key(key_type):
+    # Returns (armored protected private key, derived key) the way create_user stores them.
+    key = new_key(key_type)
+    derived_key = kdf.derive_key(PASSWORD, kdf.new_salt())
+    key.protect(derived_key, SymmetricKeyAlgorithm.AES256, HashAlgorithm.SHA256)
+    return str(key), derived_key
+
+
+@group("kdf")
+def kdf_cases(args):
+    params = [{"scheme": "bcrypt", "rounds": rounds} for rounds in args.salt_rounds]
+    params += [{"scheme": "scrypt", "ln": ln, "r": 8, "p": 1} for ln in args.scrypt_ln]
+
+    for param in params:
+        label = ",".join("{}={}".format(k, v) for k, v in param.items() if k != "scheme")
+        hashed = kdf.hash_password(PASSWORD, param)
+        salt = kdf.new_salt(param).encode('utf-8')
+
+        async def derive_key(salt=salt):
+            await auth.get_derived_key(PASSWORD, salt)
+
+        yield "{}.get_password_hash[{}]".format(param["scheme"], label), \
+            lambda p=param: kdf.hash_password(PASSWORD, p), args.rounds
+        yield "{}.verify_password[{}]".format(param["scheme"], label), \
+            lambda h=hashed: auth.verify_password(PASSWORD, h), args.rounds
+        yield "{}.get_derived_key[{}]".format(param["scheme"], label), derive_key, args.rounds
+
+
+@group("keygen")
+def keygen_cases(args):
+    for key_type in args.key_types:
+        yield "PGPKey.new[{}]".format(key_type), lambda k=key_type: new_key(k), args.keygen_rounds
+
+
+@group("pgp")
+def pgp_cases(args):
+    payload = json.dumps(fixtures.synthetic_order(10))
+
+    for key_type in args.key_types:
+        armored, derived_key = protected_key(key_type)
+        private_key = PGPKey()
+        private_key.parse(armored)
+        other_key = new_key(key_type, name="Bench Other", email="other@example.com")
+        public_key = private_key.pubkey
+        other_public_key = other_key.pubkey
+
+        def parse(armored=armored):
+            key = PGPKey()
+            key.parse(armored)
+
+        def unlock(private_key=private_key, derived_key=derived_key):
+            with private_key.unlock(derived_key):
+                pass
+
+        def sign(private_key=private_key, derived_key=derived_key):
+            with private_key.unlock(derived_key):
+                message = PGPMessage.new(payload)
+                message |= private_key.sign(message)
+
+        def encrypt_chained(public_key=public_key, other_public_key=other_public_key):
+            # The pattern used by submit_purchase_order: one session key, a PKESK added per recipient.
+            cipher = SymmetricKeyAlgorithm.AES256
+            sessionkey = cipher.gen_key()
+            encrypted = public_key.encrypt(PGPMessage.new(payload), cipher=cipher, sessionkey=sessionkey)
+            other_public_key.encrypt(encrypted, cipher=cipher, sessionkey=sessionkey)
+
+        def encrypt_per_recipient(public_key=public_key, other_public_key=other_public_key):
+            # One independently encrypted message per recipient, for comparison.
+            message = PGPMessage.new(payload)
+            public_key.encrypt(message)
+            other_public_key.encrypt(message)
+
+        with private_key.unlock(derived_key):
+            signed = PGPMessage.new(payload)
+            signed |= private_key.sign(signed)
+        cipher = SymmetricKeyAlgorithm.AES256
+        sessionkey = cipher.gen_key()
+        encrypted = public_key.encrypt(signed, cipher=cipher, sessionkey=sessionkey)
+        encrypted = str(other_public_key.encrypt(encrypted, cipher=cipher, sessionkey=sessionkey))
+
+        def decrypt(private_key=private_key, derived_key=derived_key, encrypted=encrypted):
+            with private_key.unlock(derived_key):
+                private_key.decrypt(PGPMessage.from_blob(encrypted))
+
+        def verify(public_key=public_key, signed=signed):
+            assert public_key.verify(signed)
+
+        yield "PGPKey.parse[{}]".format(key_type), parse, args.rounds
+        yield "PGPKey.unlock[{}]".format(key_type), unlock, args.rounds
+        yield "PGPKey.sign[{}]".format(key_type), sign, args.rounds
+        yield "PGPKey.encrypt.chained[{},2 recipients]".format(key_type), encrypt_chained, args.rounds
+        yield "PGPKey.encrypt.per_recipient[{},2 recipients]".format(key_type), encrypt_per_recipient, args.rounds
+        yield "PGPKey.decrypt[{}]".format(key_type), decrypt, args.rounds
+        yield "PGPKey.verify[{}]".format(key_type), verify, args.rounds
+
+
+@group("order")
+def order_cases(args):
+    # The complete crypto work of submitting and viewing a purchase order, with every participant using the same key
+    # profile. The server's part is a batched timestamp, see the timestamp group. Shows the per-request latency of each
+    # profile.
+    payload = json.dumps(fixtures.synthetic_order(10))
+    email = methods.format_purchase_order(fixtures.synthetic_order(10), "http://localhost/purchase_orders/x")
+
+    for key_type in args.key_types:
+        sender_key = new_key(key_type, name="Bench Sender", email="sender@example.com")
+        recipient_key = new_key(key_type, name="Bench Supervisor", email="supervisor@example.com")
+
+        def submit(sender_key=sender_key, recipient_key=recipient_key):
+            cipher = SymmetricKeyAlgorithm.AES256
+            sessionkey = cipher.gen_key()
+            results = []
+            for content in (email, payload):
+                message = PGPMessage.new(content)
+                message |= sender_key.sign(message)
+                encrypted = sender_key.pubkey.encrypt(message, cipher=cipher, sessionkey=sessionkey)
+                encrypted = recipient_key.pubkey.encrypt(encrypted, cipher=cipher, sessionkey=sessionkey)
+                results.append(str(encrypted))
+            return results
+
+        encrypted_json = submit()[1]
+
+        def view(sender_key=sender_key, recipient_key=recipient_key, encrypted_json=encrypted_json):
+            decrypted = recipient_key.decrypt(PGPMessage.from_blob(encrypted_json))
+            json.loads(decrypted.message)
+            assert sender_key.pubkey.verify(decrypted)
+
+        yield "order.submit[{}]".format(key_type), submit, args.rounds
+        yield "order.view[{}]".format(key_type), view, args.rounds
+
+
+@group("timestamp")
+def timestamp_cases(args):
+    # The server's signing work for a burst of submitted orders: one RSA-2048 server signature per order, as before
+    # batched timestamps, against one Merkle tree and a single signature of its root.
+    server_key = new_key("rsa2048", name="Bench Server", email="server@example.com")
+
+    for batch_size in args.batch_sizes:
+        digests = [timestamping.digest_of("order {}".format(i)) for i in range(batch_size)]
+
+        def per_order(digests=digests):
+            return [server_key.sign(digest) for digest in digests]
+
+        def batched(digests=digests):
+            root, proofs = timestamping.merkle_tree(digests)
+            return server_key.sign(timestamping.statement(root, len(digests), datetime.utcnow())), proofs
+
+        yield "timestamp.per_order_signatures[orders={}]".format(batch_size), per_order, args.rounds
+        yield "timestamp.merkle_batch[orders={}]".format(batch_size), batched, args.rounds
+
+
+def legacy_format_purchase_order(data, review_url):
+    # The email body before it was built from a list of lines: repeated string concatenation.
+    po = data['purchase_order']
+    formatted_text = "Purchase Order Summary\n"
+    formatted_text += "Date Requested: {}\n\n".format(data['readable_timestamp'])
+    formatted_text += "Requested by: {}\nSent to: {}\n\n".format(data['sender_name'], data['recipient_name'])
+    formatted_text += "Supplier Information:\nName: {}\nContact: {}\nAddress: {}\n\nItems Ordered:\n".format(
+        po['supplier_name'], po['supplier_contact'], po['supplier_address'])
+    for idx, item in enumerate(po['items'], start=1):
+        formatted_text += "Item {}:\n".format(idx)
+        formatted_text += "  - Details: {}\n".format(item['item_details'])
+        formatted_text += "  - Number: {}\n".format(item['item_number'])
+        formatted_text += "  - Quantity: {}\n".format(item['item_quantity'])
+        formatted_text += "  - Price: ${}\n".format(item['item_price'])
+        formatted_text += "  - URL: {}\n\n".format(item['item_url'])
+    formatted_text += "Review Purchase Order: {}\n".format(review_url)
+    return formatted_text
+
+
+@group("format")
+def format_cases(args):
+    for item_count in args.item_counts:
+        data = fixtures.synthetic_order(item_count)
+        yield "legacy_format_purchase_order[items={}]".format(item_count), \
+            lambda d=data: legacy_format_purchase_order(d, "http://localhost/purchase_orders/x"), args.rounds
+        yield "format_purchase_order[items={}]".format(item_count), \
+            lambda d=data: methods.format_purchase_order(d, "http://localhost/purchase_orders/x"), args.rounds
+
+
+BENCH_USER = {"user_id": "sender", "first_name": "Bench", "last_name": "User", "role": "User"}
+
+
+def item_upload(name: str, content_type: str, data: bytes):
+    # Stands in for an UploadFile: items_from_upload only uses the file name, content type and file object.
+    return types.SimpleNamespace(filename=name, content_type=content_type, file=io.BytesIO(data))
+
+
+@group("items")
+def item_cases(args):
+    # Line item upload parsing and the purchase order view page, at increasing order sizes.
+    environment = jinja2.Environment(loader=jinja2.FileSystemLoader(constants.TEMPLATE_FOLDER), autoescape=True)
+    template = environment.get_template("purchase_order.html")
+
+    for item_count in args.item_counts:
+        data = fixtures.synthetic_order(item_count)
+        items = data['purchase_order']['items']
+
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, fieldnames=methods.ITEM_FIELDS)
+        writer.writeheader()
+        writer.writerows(items)
+        csv_data = buffer.getvalue().encode('utf-8')
+        json_data = json.dumps(items).encode('utf-8')
+
+        yield "items_from_upload.csv[items={}]".format(item_count), \
+            lambda d=csv_data: methods.items_from_upload(item_upload("items.csv", "text/csv", d)), args.rounds
+        yield "items_from_upload.json[items={}]".format(item_count), \
+            lambda d=json_data: methods.items_from_upload(item_upload("items.json", "application/json", d)), \
+            args.rounds
+        yield "render.purchase_order[items={}]".format(item_count), \
+            lambda d=data: template.render(data=d, user=BENCH_USER, recipient_id="supervisor", status=None,
+                                           item_page_size=constants.ITEM_PAGE_SIZE, purchasers=[], po_id="x"), \
+            args.rounds
+
+
+def legacy_purchase_orders_by_user(user):
+    # The list query before participant names were stored on the purchase order: three self-joins on users.
+    sender = tables.users.alias('sender')
+    recipient = tables.users.alias('receiver')
+    purchaser = tables.users.alias('purchaser')
+
+    query = select([
+        tables.purchase_orders,
+        sender.c.first_name.label('sender_first_name'),
+        sender.c.last_name.label('sender_last_name'),
+        recipient.c.first_name.label('receiver_first_name'),
+        recipient.c.last_name.label('receiver_last_name'),
+        purchaser.c.first_name.label('purchaser_first_name'),
+        purchaser.c.last_name.label('purchaser_last_name'),
+    ]).select_from(
+        tables.purchase_orders
+        .join(sender, tables.purchase_orders.c.sender_id == sender.c.user_id)
+        .join(recipient, tables.purchase_orders.c.recipient_id == recipient.c.user_id)
+        .outerjoin(purchaser, tables.purchase_orders.c.purchaser_id == purchaser.c.user_id)
+    ).order_by(desc(tables.purchase_orders.c.purchase_order_number))
+
+    if user['role'] != "Admin":
+        query = query.where(
+            or_(
+                tables.purchase_orders.c.sender_id == user['user_id'],
+                tables.purchase_orders.c.recipient_id == user['user_id'],
+                tables.purchase_orders.c.purchaser_id == user['user_id'],
+            )
+        )
+    return database.fetch_all(query)
+
+
+SEED_USERS = """
+insert into public.users (email, first_name, last_name, public_key, password)
+select 'bench-' || g || '@example.com', 'First' || g, 'Last' || g, '', ''
+from generate_series(1, :count) g
+"""
+
+SEED_PURCHASE_ORDERS = """
+insert into public.purchase_orders (sender_id, recipient_id, purchaser_id, sender_name, recipient_name, purchaser_name,
+                                    email_content, json_content, sent_timestamp, reviewed_timestamp, status)
+select u.ids[1 + g % u.n], u.ids[1 + (g * 7) % u.n], case when g % 3 = 0 then u.ids[1 + (g * 13) % u.n] end,
+       u.names[1 + g % u.n], u.names[1 + (g * 7) % u.n], case when g % 3 = 0 then u.names[1 + (g * 13) % u.n] end,
+       repeat('x', 3000), repeat('x', 6000), now() - g * interval '1 minute',
+       case when g % 3 <> 2 then now() - g * interval '1 minute' + interval '1 hour' end,
+       case g % 3 when 0 then true when 1 then false end
+from generate_series(1, :count) g,
+     (select array_agg(user_id) ids, array_agg(first_name || ' ' || last_name) names, count(*) n
+      from public.users where email like 'bench-%') u
+"""
+
+
+def search_filters(user):
+    # Representative searches: the first page of each, as the search page shows it.
+    today = date.today()
+    return [
+        ("all", models.PurchaseOrderFilter()),
+        ("pending", models.PurchaseOrderFilter(status=models.PurchaseOrderStatus.pending)),
+        ("sent_last_week", models.PurchaseOrderFilter(sent_from=today - timedelta(days=7), sent_to=today)),
+        ("number_range", models.PurchaseOrderFilter(number_from=1000, number_to=2000)),
+        ("participant", models.PurchaseOrderFilter(participant_id=user['user_id'])),
+    ]
+
+
+@group("db", default=False)
+async def db_cases(args):
+    # The purchase order list query before and after participant names were stored on the order, and the metadata
+    # searches, at increasing table sizes. Synthetic users and orders are inserted in a transaction that is rolled back at the end, so this can be
+    # pointed at a development database without leaving anything behind.
+    await database.connect()
+    try:
+        async with database.transaction(force_rollback=True):
+            await database.execute(SEED_USERS, {"count": args.user_count})
+            user = dict(await database.fetch_one(
+                "select user_id from public.users where email = 'bench-1@example.com'"))
+            user['role'] = "User"
+            admin = {"user_id": user['user_id'], "role": "Admin"}
+
+            seeded = 0
+            for count in sorted(args.order_counts):
+                await database.execute(SEED_PURCHASE_ORDERS, {"count": count - seeded})
+                await database.execute("analyze public.purchase_orders")
+                seeded = count
+
+                yield "list.legacy_join[user,orders={}]".format(count), \
+                    lambda: legacy_purchase_orders_by_user(user), args.rounds
+                yield "list.get_purchase_orders_by_user[user,orders={}]".format(count), \
+                    lambda: methods.get_purchase_orders_by_user(user), args.rounds
+                yield "list.legacy_join[admin,orders={}]".format(count), \
+                    lambda: legacy_purchase_orders_by_user(admin), args.rounds
+                yield "list.get_purchase_orders_by_user[admin,orders={}]".format(count), \
+                    lambda: methods.get_purchase_orders_by_user(admin), args.rounds
+
+                for label, filters in search_filters(user):
+                    yield "search.{}[user,orders={}]".format(label, count), \
+                        lambda f=filters: methods.search_purchase_orders(user, f), args.rounds
+                    yield "search.{}[admin,orders={}]".format(label, count), \
+                        lambda f=filters: methods.search_purchase_orders(admin, f), args.rounds
+    finally:
+        await database.disconnect()
+
+
+async def measure(func, rounds, warmup):
+    # Times `rounds` calls of func after `warmup` untimed calls and returns the samples in seconds.
+    async def call():
+        result = func()
+        if inspect.isawaitable(result):
+            await result
+
+    for _ in range(warmup):
+        await call()
+
+    samples = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        await call()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+async def cases_of(name, args):
+    cases = GROUPS[name](args)
+    if inspect.isasyncgen(cases):
+        async for case in cases:
+            yield case
+    else:
+        for case in cases:
+            yield case
+
+
+async def run(args):
+    # Runs every selected group in one task, so database groups keep a single connection and transaction throughout.
+    results = {}
+    for name in args.groups:
+        async for case, func, rounds in cases_of(name, args):
+            results[case] = summarize(await measure(func, rounds, args.warmup))
+            print("{} done".format(case), flush=True)
+    return results
+
+
+def summarize(samples):
+    ordered = sorted(samples)
+    p95 = ordered[min(len(ordered) - 1, int(round(0.95 * (len(ordered) - 1))))]
+    return {
+        "rounds": len(samples),
+        "mean_ms": statistics.mean(samples) * 1000,
+        "median_ms": statistics.median(samples) * 1000,
+        "p95_ms": p95 * 1000,
+        "min_ms": ordered[0] * 1000,
+    }
+
+
+def print_report(results, baseline=None):
+    width = max([len(name) for name in results] + [4])
+    header = "{:<{w}}  {:>6}  {:>10}  {:>10}  {:>10}  {:>10}".format(
+        "case", "rounds", "mean ms", "median ms", "p95 ms", "min ms", w=width)
+    if baseline:
+        header += "  {:>9}".format("vs base")
+    print(header)
+    print("-" * len(header))
+
+    for name, result in results.items():
+        line = "{:<{w}}  {:>6}  {:>10.3f}  {:>10.3f}  {:>10.3f}  {:>10.3f}".format(
+            name, result["rounds"], result["mean_ms"], result["median_ms"], result["p95_ms"], result["min_ms"],
+            w=width)
+        if baseline:
+            base = baseline.get(name)
+            if base and base["median_ms"] > 0:
+                change = (result["median_ms"] - base["median_ms"]) / base["median_ms"] * 100
+                line += "  {:>+8.1f}%".format(change)
+            else:
+                line += "  {:>9}".format("new")
+        print(line)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the crypto and formatting hot path.")
+    parser.add_argument("--groups", nargs="+", choices=list(GROUPS), default=DEFAULT_GROUPS,
+                        help="benchmark groups to run (default: {})".format(" ".join(DEFAULT_GROUPS)))
+    parser.add_argument("--rounds", type=int, default=10, help="timed rounds per case")
+    parser.add_argument("--keygen-rounds", type=int, default=3, help="timed rounds per key generation case")
+    parser.add_argument("--warmup", type=int, default=1, help="untimed rounds before each case")
+    parser.add_argument("--salt-rounds", type=int, nargs="+", default=[10, 11, 12, 13],
+                        help="bcrypt costs to measure")
+    parser.add_argument("--scrypt-ln", type=int, nargs="+", default=[14, 15, 16],
+                        help="scrypt log2(N) values to measure")
+    parser.add_argument("--key-types", nargs="+", choices=list(crypto.KEY_PROFILES),
+                        default=list(crypto.KEY_PROFILES), help="key profiles to measure")
+    parser.add_argument("--item-counts", type=int, nargs="+", default=[10, 100, 1000, 10000],
+                        help="purchase order sizes to format, parse and render")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 10, 100],
+                        help="orders per burst for the timestamp group")
+    parser.add_argument("--order-counts", type=int, nargs="+", default=[10000, 100000],
+                        help="purchase order table sizes for the database group")
+    parser.add_argument("--user-count", type=int, default=1000, help="synthetic users for the database group")
+    parser.add_argument("--output", help="write the report as JSON to this path")
+    parser.add_argument("--compare", help="a JSON report from a previous run to compare against")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    results = asyncio.run(run(args))
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)["results"]
+
+    print()
+    print_report(results, baseline)
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump({
+                "created": datetime.utcnow().isoformat(),
+                "python": platform.python_version(),
+                "machine": platform.machine(),
+                "pgpy": pgpy.__version__,
+                "results": results
+            }, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -7,6 +7,8 @@ from fastapi_mail import FastMail, MessageSchema, ConnectionConfig
 APP_ROOT = "./"
 MEDIA_ROOT = os.path.join(APP_ROOT, 'media')
 DATA_ROOT = os.path.join(APP_ROOT, 'data')
+MIGRATIONS_ROOT = os.path.join(DATA_ROOT, 'migrations')
+PROFILE_ROOT = os.getenv('PROFILE_ROOT', os.path.join(APP_ROOT, 'profiles'))
 
 # database info
 DB_USER = os.getenv('POSTGRES_USER')
@@ -15,15 +17,89 @@ DB_SERVER = os.getenv('POSTGRES_SERVER')
 DB_PORT = os.getenv('POSTGRES_PORT')
 DB_DB = os.getenv('POSTGRES_DB')
 DB_URL = "postgresql://{}:{}@db:{}/{}".format(DB_USER, DB_KEY, DB_PORT, DB_DB)
+# optional streaming replica for read-only queries, see database.ReadRouter
+DB_REPLICA_URL = os.getenv('DB_REPLICA_URL')
+REPLICA_MAX_LAG_SECONDS = float(os.getenv('REPLICA_MAX_LAG_SECONDS', 5))
+REPLICA_LAG_CHECK_SECONDS = float(os.getenv('REPLICA_LAG_CHECK_SECONDS', 2))
+READ_YOUR_WRITES_SECONDS = float(os.getenv('READ_YOUR_WRITES_SECONDS', 30))
 
 SERVER_ADDRESS = os.getenv('SERVER_ADDRESS')
 SERVER_PORT = os.getenv('PORT')
 SECRET_KEY = os.getenv('SECRET_KEY')
+# how often each worker reloads the token revocation table
+TOKEN_REVOCATION_REFRESH_SECONDS = float(os.getenv('TOKEN_REVOCATION_REFRESH_SECONDS', 10))
 
 SERVER_PRIVATE_KEY = os.path.join(APP_ROOT, "server_private_key.asc")
 SERVER_PRIVATE_KEY_PW = os.getenv('SERVER_KEY_PW')
 SERVER_PUBLIC_KEY = os.path.join(APP_ROOT, "server_public_key.asc")
 
+# key derivation for passwords and private keys, see kdf.py; `python manage.py calibrate` suggests values
+KDF_SCHEME = os.getenv('KDF_SCHEME', 'bcrypt')
+BCRYPT_ROUNDS = int(os.getenv('BCRYPT_ROUNDS', 12))
+SCRYPT_LN = int(os.getenv('SCRYPT_LN', 15))
+SCRYPT_R = int(os.getenv('SCRYPT_R', 8))
+SCRYPT_P = int(os.getenv('SCRYPT_P', 1))
+ARGON2_MEMORY_COST = int(os.getenv('ARGON2_MEMORY_COST', 65536))
+ARGON2_TIME_COST = int(os.getenv('ARGON2_TIME_COST', 3))
+ARGON2_PARALLELISM = int(os.getenv('ARGON2_PARALLELISM', 1))
+
+# default key profile for new users, see crypto.KEY_PROFILES
+KEY_PROFILE = os.getenv('KEY_PROFILE', 'rsa2048')
+
+# admission control for CPU-heavy routes, see admission.py
+CRYPTO_CONCURRENCY = int(os.getenv('CRYPTO_CONCURRENCY', os.cpu_count() or 1))
+CRYPTO_QUEUE_SIZE = int(os.getenv('CRYPTO_QUEUE_SIZE', 16))
+CRYPTO_QUEUE_TIMEOUT = float(os.getenv('CRYPTO_QUEUE_TIMEOUT', 5))
+RETRY_AFTER_SECONDS = int(os.getenv('RETRY_AFTER_SECONDS', 2))
+
+# worker processes for purchase order signing and encryption, see crypto.run
+CRYPTO_WORKERS = int(os.getenv('CRYPTO_WORKERS', os.cpu_count() or 1))
+CRYPTO_KEY_CACHE_SIZE = int(os.getenv('CRYPTO_KEY_CACHE_SIZE', 1000))
+
+# batched Merkle timestamps of purchase orders, see timestamping.py
+TIMESTAMP_WINDOW_MS = float(os.getenv('TIMESTAMP_WINDOW_MS', 50))
+TIMESTAMP_BATCH_MAX = int(os.getenv('TIMESTAMP_BATCH_MAX', 1000))
+
+# slow query log, see database.InstrumentedDatabase
+SLOW_QUERY_MS = float(os.getenv('SLOW_QUERY_MS', 200))
+SLOW_QUERY_LOG = os.getenv('SLOW_QUERY_LOG', os.path.join(APP_ROOT, 'slow_queries.log'))
+SLOW_QUERY_KEEP = int(os.getenv('SLOW_QUERY_KEEP', 200))
+SLOW_QUERY_EXPLAIN_INTERVAL = float(os.getenv('SLOW_QUERY_EXPLAIN_INTERVAL', 60))
+
+# sampling interval in seconds for on-demand request profiles, see profiling.py
+PROFILE_INTERVAL = float(os.getenv('PROFILE_INTERVAL', 0.001))
+
+# how long a worker may serve a cached role directory changed by another worker, see methods.RoleDirectory
+ROLE_DIRECTORY_TTL_SECONDS = float(os.getenv('ROLE_DIRECTORY_TTL_SECONDS', 60))
+
+# idempotency keys for submitting and reviewing purchase orders, see idempotency.py
+IDEMPOTENCY_TTL_HOURS = int(os.getenv('IDEMPOTENCY_TTL_HOURS', 24))
+IDEMPOTENCY_WAIT_SECONDS = float(os.getenv('IDEMPOTENCY_WAIT_SECONDS', 30))
+
+# server-sent purchase order events, see events.py
+EVENT_HEARTBEAT_SECONDS = float(os.getenv('EVENT_HEARTBEAT_SECONDS', 15))
+EVENT_RETRY_SECONDS = float(os.getenv('EVENT_RETRY_SECONDS', 5))
+EVENT_QUEUE_SIZE = int(os.getenv('EVENT_QUEUE_SIZE', 100))
+EVENT_MAX_STREAMS = int(os.getenv('EVENT_MAX_STREAMS', 5000))
+
+# line items per purchase order, and per page on the purchase order view
+MAX_PURCHASE_ORDER_ITEMS = int(os.getenv('MAX_PURCHASE_ORDER_ITEMS', 20000))
+ITEM_PAGE_SIZE = int(os.getenv('ITEM_PAGE_SIZE', 100))
+
+# encrypted purchase order attachments, see attachments.py
+ATTACHMENT_CHUNK_SIZE = int(os.getenv('ATTACHMENT_CHUNK_SIZE', 64 * 1024))
+ATTACHMENT_MAX_BYTES = int(os.getenv('ATTACHMENT_MAX_BYTES', 100 * 1024 * 1024))
+ATTACHMENT_LINK_MINUTES = int(os.getenv('ATTACHMENT_LINK_MINUTES', 30))
+
+# purchase order partitions and archival, see helper.archive_closed_purchase_orders
+PARTITION_MONTHS_AHEAD = int(os.getenv('PARTITION_MONTHS_AHEAD', 3))
+ARCHIVE_AFTER_DAYS = int(os.getenv('ARCHIVE_AFTER_DAYS', 365))
+ARCHIVE_BATCH_SIZE = int(os.getenv('ARCHIVE_BATCH_SIZE', 500))
+
+# per-request span traces, see tracing.py; the fraction of requests traced besides those sent with X-Trace
+TRACE_SAMPLE_RATE = float(os.getenv('TRACE_SAMPLE_RATE', 0))
+TRACE_ROOT = os.getenv('TRACE_ROOT', os.path.join(APP_ROOT, 'traces'))
+
 TEMPLATE_FOLDER = '{}templates'.format(APP_ROOT)
 
 conf = ConnectionConfig(
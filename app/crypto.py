@@ -0,0 +1,333 @@
+import asyncio
+import contextlib
+import time
+import pgpy
+
+from concurrent.futures import ProcessPoolExecutor
+from pgpy import PGPKey, PGPMessage
+from pgpy.constants import PubKeyAlgorithm, EllipticCurveOID, KeyFlags, HashAlgorithm, SymmetricKeyAlgorithm, \
+    CompressionAlgorithm
+
+import exceptions
+import constants
+import kdf
+import tracing
+
+# Key profiles for new users. RSA profiles use a single primary key that both signs and encrypts, which is what every
+# existing user has. Elliptic curve profiles use a signing primary key plus an ECDH encryption subkey; PGPy picks the
+# subkey automatically when encrypting to or decrypting with such a key, so keys of different profiles can be mixed
+# freely within one purchase order.
+#
+# Each profile is (primary algorithm, primary size or curve, encryption subkey algorithm, subkey curve).
+
+KEY_PROFILES = {
+    "rsa2048": (PubKeyAlgorithm.RSAEncryptOrSign, 2048, None, None),
+    "rsa3072": (PubKeyAlgorithm.RSAEncryptOrSign, 3072, None, None),
+    "ed25519": (PubKeyAlgorithm.EdDSA, EllipticCurveOID.Ed25519, PubKeyAlgorithm.ECDH, EllipticCurveOID.Curve25519),
+    "p256": (PubKeyAlgorithm.ECDSA, EllipticCurveOID.NIST_P256, PubKeyAlgorithm.ECDH, EllipticCurveOID.NIST_P256),
+}
+
+
+def generate_key(name: str, email: str, profile: str = None):
+    # Generates an unprotected private key for a user using the given key profile, or the deployment default.
+    profile = profile or constants.KEY_PROFILE
+    if profile not in KEY_PROFILES:
+        raise exceptions.API_400_BAD_REQUEST_EXCEPTION
+    algorithm, size, subkey_algorithm, subkey_size = KEY_PROFILES[profile]
+
+    key = PGPKey.new(algorithm, size)
+    uid = pgpy.PGPUID.new(name, email=email)
+
+    if subkey_algorithm is None:
+        usage = {KeyFlags.Sign, KeyFlags.EncryptCommunications}
+    else:
+        usage = {KeyFlags.Sign, KeyFlags.Certify}
+
+    key.add_uid(uid, usage=usage, hashes=[HashAlgorithm.SHA256], ciphers=[SymmetricKeyAlgorithm.AES256],
+                compression=[CompressionAlgorithm.ZLIB])
+
+    if subkey_algorithm is not None:
+        subkey = PGPKey.new(subkey_algorithm, subkey_size)
+        key.add_subkey(subkey, usage={KeyFlags.EncryptCommunications, KeyFlags.EncryptStorage})
+
+    return key
+
+
+def sign_and_encrypt(content: str, signers, recipients, cipher=SymmetricKeyAlgorithm.AES256):
+    # Signs content with each unlocked signer key in turn, then encrypts it once with a fresh session key and adds a
+    # session key packet for every recipient public key, as submitting and reviewing a purchase order do. Returns the
+    # armored message.
+    message = PGPMessage.new(content)
+    for signer in signers:
+        message |= signer.sign(message)
+    return encrypt(message, recipients, cipher)
+
+
+def encrypt(message, recipients, cipher=SymmetricKeyAlgorithm.AES256):
+    # Encrypts a (signed) message once with a fresh session key and adds a session key packet for every recipient public
+    # key. Returns the armored message.
+    sessionkey = cipher.gen_key()
+    for recipient in recipients:
+        message = recipient.encrypt(message, cipher=cipher, sessionkey=sessionkey)
+    del sessionkey
+
+    return str(message)
+
+
+def key_ids(key):
+    # Ids of a key and its subkeys, to match against PGPMessage.encrypters.
+    return {key.fingerprint.keyid} | set(key.subkeys)
+
+
+# Process pool for the PGP work of submitting, opening and reviewing purchase orders. PGPy is pure Python, so signing,
+# encryption and decryption run in CRYPTO_WORKERS worker processes instead of on the event loop. Handlers send armored
+# keys, the user's password and KDF record, and armored messages, and get armored messages or plaintext back; private
+# keys are only ever unlocked inside a worker. Workers cache parsed keys (still locked) and the server keys.
+#
+# Each worker function returns (result, phases); phases are the timings of its steps, which `run` adds to the current
+# request trace.
+
+_executor = None
+_keys = {}
+_server_keys = None
+
+
+def executor():
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(constants.CRYPTO_WORKERS)
+    return _executor
+
+
+def shutdown():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False)
+        _executor = None
+
+
+async def run(func, *args):
+    # Runs a worker function in the pool and returns its result.
+    loop = asyncio.get_running_loop()
+    with tracing.span("crypto.{}".format(func.__name__)):
+        result, phases = await loop.run_in_executor(executor(), func, *args)
+        tracing.add_phases(phases)
+    return result
+
+
+def parsed_key(armored: str):
+    # Parses an armored key, caching it per process. Cached private keys stay locked.
+    key = _keys.get(armored)
+    if key is None:
+        if len(_keys) > constants.CRYPTO_KEY_CACHE_SIZE:
+            _keys.clear()
+        key = _keys[armored] = PGPKey()
+        key.parse(armored)
+    return key
+
+
+def server_keys():
+    global _server_keys
+    if _server_keys is None:
+        private_key, _ = PGPKey.from_file(constants.SERVER_PRIVATE_KEY)
+        public_key, _ = PGPKey.from_file(constants.SERVER_PUBLIC_KEY)
+        _server_keys = private_key, public_key
+    return _server_keys
+
+
+class Phases:
+    # Wall clock timings of a worker function's steps: (name, start, duration, tags).
+
+    def __init__(self):
+        self.phases = []
+
+    @contextlib.contextmanager
+    def phase(self, name: str, **tags):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.phases.append((name, start, time.time() - start, tags))
+
+    def unlock(self, stack, key, passphrase, label: str):
+        # Unlocks a key for the rest of the ExitStack, timing only the unlock itself.
+        with self.phase("key.unlock", key=label):
+            stack.enter_context(key.unlock(passphrase))
+
+
+def user_key(phases, private_key: str, password: str, salt: str, retired=None, message=None):
+    # Parses a user's private key and derives its passphrase. While the user's key is being rotated, messages not yet
+    # re-encrypted are only readable with the retired key, given as (private key, salt).
+    with phases.phase("key.parse", keys="user private"):
+        key = parsed_key(private_key)
+        if retired is not None and message is not None and not key_ids(key) & set(message.encrypters):
+            private_key, salt = retired
+            key = parsed_key(private_key)
+    with phases.phase("kdf.derive_key"):
+        derived_key = kdf.derive_key(password, salt)
+    return key, derived_key
+
+
+def submit_order(private_key: str, password: str, salt: str, contents, recipients):
+    # Worker: signs each content with the sender's key and encrypts it to the recipients, as submitting a purchase
+    # order does. The server's part is a batched timestamp, see timestamping.py. Returns the armored messages.
+    phases = Phases()
+    sender_key, derived_key = user_key(phases, private_key, password, salt)
+    with phases.phase("key.parse", keys="public"):
+        recipient_keys = [parsed_key(armored) for armored in recipients]
+
+    with contextlib.ExitStack() as stack:
+        phases.unlock(stack, sender_key, derived_key, "sender")
+        with phases.phase("pgp.sign_and_encrypt", messages=len(contents), recipients=len(recipient_keys)):
+            sealed = [sign_and_encrypt(content, [sender_key], recipient_keys) for content in contents]
+    return sealed, phases.phases
+
+
+def open_order(private_key: str, password: str, salt: str, message: str, sender_public_key: str,
+               supervisor_public_key: str, retired=None, wrapped_keys=()):
+    # Worker: decrypts a message with the user's key and checks the sender, server and supervisor signatures, and
+    # unwraps the order's attachment keys. Returns (plaintext, valid sender, valid server, valid supervisor, attachment
+    # keys), with None for keys the user cannot unwrap. Only orders sealed before batched timestamps carry a server
+    # signature.
+    phases = Phases()
+    message = PGPMessage.from_blob(message)
+    user_private_key, derived_key = user_key(phases, private_key, password, salt, retired, message)
+    with phases.phase("key.parse", keys="public"):
+        verifiers = [parsed_key(sender_public_key), server_keys()[1], parsed_key(supervisor_public_key)]
+
+    with contextlib.ExitStack() as stack:
+        phases.unlock(stack, user_private_key, derived_key, "user")
+        with phases.phase("pgp.decrypt"):
+            decrypted = user_private_key.decrypt(message)
+        with phases.phase("pgp.unwrap_keys", keys=len(wrapped_keys)):
+            file_keys = [unwrap_key(user_private_key, wrapped) for wrapped in wrapped_keys]
+
+    valid = []
+    with phases.phase("pgp.verify", signatures=len(verifiers)):
+        for verifier in verifiers:
+            try:
+                valid.append(bool(verifier.verify(decrypted)))
+            except Exception:
+                valid.append(False)
+    return (decrypted.message, *valid, file_keys), phases.phases
+
+
+def review_order(private_key: str, password: str, salt: str, messages, recipients, retired=None, wrapped_keys=()):
+    # Worker: decrypts each message with the supervisor's key, signs the plaintext with the supervisor key and
+    # encrypts it to the recipients, as reviewing a purchase order does, and re-wraps the order's attachment keys for
+    # the recipients. Returns (armored messages, armored attachment keys with None where the supervisor could not
+    # unwrap a key, plaintext of the first message).
+    phases = Phases()
+    messages = [PGPMessage.from_blob(message) for message in messages]
+    supervisor_key, derived_key = user_key(phases, private_key, password, salt, retired, messages[0])
+    with phases.phase("key.parse", keys="public"):
+        recipient_keys = [parsed_key(armored) for armored in recipients]
+
+    with contextlib.ExitStack() as stack:
+        phases.unlock(stack, supervisor_key, derived_key, "supervisor")
+        with phases.phase("pgp.decrypt", messages=len(messages)):
+            plaintexts = [supervisor_key.decrypt(message).message for message in messages]
+        with phases.phase("pgp.sign_and_encrypt", messages=len(plaintexts), recipients=len(recipient_keys)):
+            sealed = [sign_and_encrypt(plaintext, [supervisor_key], recipient_keys) for plaintext in plaintexts]
+        with phases.phase("pgp.rewrap_keys", keys=len(wrapped_keys)):
+            file_keys = [unwrap_key(supervisor_key, wrapped) for wrapped in wrapped_keys]
+            rewrapped = [None if file_key is None else wrap(file_key, recipient_keys) for file_key in file_keys]
+    return (sealed, rewrapped, plaintexts[0]), phases.phases
+
+
+def sign_timestamp(statement: str):
+    # Worker: signs the statement of a timestamp batch with the server key. Returns the armored detached signature.
+    phases = Phases()
+    with phases.phase("key.load_server"):
+        server_private_key, _ = server_keys()
+    with contextlib.ExitStack() as stack:
+        phases.unlock(stack, server_private_key, constants.SERVER_PRIVATE_KEY_PW, "server")
+        with phases.phase("pgp.sign"):
+            signature = str(server_private_key.sign(statement))
+    return signature, phases.phases
+
+
+def verify_timestamp(statement: str, signature: str):
+    # Worker: checks the server's signature of a timestamp batch statement.
+    phases = Phases()
+    with phases.phase("pgp.verify", signatures=1):
+        try:
+            valid = bool(server_keys()[1].verify(statement, pgpy.PGPSignature.from_blob(signature)))
+        except Exception:
+            valid = False
+    return valid, phases.phases
+
+
+def wrap(file_key: bytes, recipient_keys):
+    # Encrypts an attachment's file key to the recipient keys, unsigned.
+    return encrypt(PGPMessage.new(file_key.hex()), recipient_keys)
+
+
+def unwrap_key(key, wrapped: str):
+    # The file key of a wrapped attachment key, decrypted with an unlocked private key, or None if it is not encrypted
+    # to that key.
+    message = PGPMessage.from_blob(wrapped)
+    if not key_ids(key) & set(message.encrypters):
+        return None
+    return bytes.fromhex(key.decrypt(message).message)
+
+
+def wrap_key(file_key: bytes, recipients):
+    # Worker: wraps a new attachment's file key for the order's participants, given as armored public keys. Returns
+    # the armored message.
+    phases = Phases()
+    with phases.phase("key.parse", keys="public"):
+        recipient_keys = [parsed_key(armored) for armored in recipients]
+    with phases.phase("pgp.wrap_key", recipients=len(recipient_keys)):
+        wrapped = wrap(file_key, recipient_keys)
+    return wrapped, phases.phases
+
+
+def reseal_orders(private_key: str, passphrase, orders, resign_server: bool):
+    # Worker for key rotation: decrypts the messages of each order, given as (id, armored messages, recipient public
+    # keys), with the private key and re-encrypts them to the recipients, keeping their signatures and optionally adding
+    # one by the current server key. Orders whose messages are not encrypted to the private key (already re-encrypted)
+    # come back as (id, None).
+    phases = Phases()
+    with phases.phase("key.parse", keys="rotating private"):
+        key = parsed_key(private_key)
+    ids = key_ids(key)
+    server_private_key, _ = server_keys()
+
+    resealed = []
+    with contextlib.ExitStack() as stack:
+        phases.unlock(stack, key, passphrase, "rotating")
+        if resign_server:
+            phases.unlock(stack, server_private_key, constants.SERVER_PRIVATE_KEY_PW, "server")
+        with phases.phase("pgp.reseal", orders=len(orders)):
+            for po_id, messages, recipients in orders:
+                messages = [PGPMessage.from_blob(message) for message in messages]
+                if not all(ids & set(message.encrypters) for message in messages):
+                    resealed.append((po_id, None))
+                    continue
+                recipient_keys = [parsed_key(armored) for armored in recipients]
+                sealed = []
+                for message in messages:
+                    # a decrypted message still holds its integrity packet, so it is rebuilt from the plaintext
+                    decrypted = key.decrypt(message)
+                    rebuilt = PGPMessage.new(decrypted.message)
+                    for signature in decrypted.signatures:
+                        rebuilt |= signature
+                    if resign_server:
+                        rebuilt |= server_private_key.sign(rebuilt)
+                    sealed.append(encrypt(rebuilt, recipient_keys))
+                resealed.append((po_id, sealed))
+    return resealed, phases.phases
+
+
+def can_open(private_key: str, password: str, salt: str, message: str):
+    # Worker: whether a message decrypts with the user's key, to check re-encrypted messages before they are stored.
+    phases = Phases()
+    key, derived_key = user_key(phases, private_key, password, salt)
+    try:
+        with key.unlock(derived_key):
+            key.decrypt(PGPMessage.from_blob(message))
+        opened = True
+    except Exception:
+        opened = False
+    return opened, phases.phases
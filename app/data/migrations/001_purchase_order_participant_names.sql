@@ -0,0 +1,47 @@
+-- Participant display names are captured on the purchase order row at submit and review time, so the list page reads a
+-- single table instead of joining users three times.
+
+alter table public.purchase_orders add column if not exists sender_name varchar(201);
+alter table public.purchase_orders add column if not exists recipient_name varchar(201);
+alter table public.purchase_orders add column if not exists purchaser_name varchar(201);
+
+update public.purchase_orders po
+set sender_name = u.first_name || ' ' || u.last_name
+from public.users u
+where u.user_id = po.sender_id and po.sender_name is null;
+
+update public.purchase_orders po
+set recipient_name = u.first_name || ' ' || u.last_name
+from public.users u
+where u.user_id = po.recipient_id and po.recipient_name is null;
+
+update public.purchase_orders po
+set purchaser_name = u.first_name || ' ' || u.last_name
+from public.users u
+where u.user_id = po.purchaser_id and po.purchaser_name is null;
+
+-- keep the captured names current if a user is renamed
+create or replace function public.purchase_orders_refresh_names() returns trigger as
+$$
+begin
+    update public.purchase_orders set sender_name = new.first_name || ' ' || new.last_name
+    where sender_id = new.user_id;
+    update public.purchase_orders set recipient_name = new.first_name || ' ' || new.last_name
+    where recipient_id = new.user_id;
+    update public.purchase_orders set purchaser_name = new.first_name || ' ' || new.last_name
+    where purchaser_id = new.user_id;
+    return new;
+end;
+$$ language plpgsql;
+
+drop trigger if exists users_refresh_purchase_order_names on public.users;
+create trigger users_refresh_purchase_order_names
+    after update of first_name, last_name on public.users
+    for each row
+    when (old.first_name is distinct from new.first_name or old.last_name is distinct from new.last_name)
+execute procedure public.purchase_orders_refresh_names();
+
+create index if not exists purchase_orders_number_idx on public.purchase_orders (purchase_order_number desc);
+create index if not exists purchase_orders_sender_idx on public.purchase_orders (sender_id, purchase_order_number desc);
+create index if not exists purchase_orders_recipient_idx on public.purchase_orders (recipient_id, purchase_order_number desc);
+create index if not exists purchase_orders_purchaser_idx on public.purchase_orders (purchaser_id, purchase_order_number desc);
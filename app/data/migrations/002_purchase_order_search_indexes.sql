@@ -0,0 +1,12 @@
+-- Indexes for searching purchase order metadata. Participant lookups use the (participant, number) indexes from
+-- 001_purchase_order_participant_names.sql; these cover status and date range filters, all ordered or bounded so the
+-- newest-first keyset pages of the search stay index scans.
+
+create index if not exists purchase_orders_pending_recipient_idx
+    on public.purchase_orders (recipient_id, purchase_order_number desc) where status is null;
+create index if not exists purchase_orders_status_idx
+    on public.purchase_orders (status, purchase_order_number desc);
+create index if not exists purchase_orders_sent_timestamp_idx
+    on public.purchase_orders (sent_timestamp);
+create index if not exists purchase_orders_reviewed_timestamp_idx
+    on public.purchase_orders (reviewed_timestamp) where reviewed_timestamp is not null;
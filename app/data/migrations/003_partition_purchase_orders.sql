@@ -0,0 +1,151 @@
+-- Range-partitions purchase_orders by month of sent_timestamp, so date-bounded scans only touch the months they need
+-- and old months can be vacuumed, archived or detached on their own. The primary key gains sent_timestamp because a
+-- partitioned table's unique constraints must include the partition key. Rows whose month has no partition yet land
+-- in purchase_orders_default; helper.ensure_purchase_order_partitions creates the coming months ahead of time.
+--
+-- Reviewed orders older than ARCHIVE_AFTER_DAYS are moved to purchase_orders_archive by `python manage.py
+-- archive-orders`; lookups by id fall back to it.
+
+create or replace function public.create_purchase_order_partition(month date) returns void as
+$$
+declare
+    first_day date := date_trunc('month', month)::date;
+    partition_name text := format('purchase_orders_%s', to_char(first_day, 'YYYY_MM'));
+begin
+    if to_regclass('public.' || partition_name) is not null then
+        return;
+    end if;
+    -- a new partition may not overlap rows already in the default partition
+    if exists(select 1 from public.purchase_orders_default
+              where sent_timestamp >= first_day and sent_timestamp < first_day + interval '1 month') then
+        raise notice 'rows for % are in purchase_orders_default, not creating %', first_day, partition_name;
+        return;
+    end if;
+    execute format('create table public.%I partition of public.purchase_orders for values from (%L) to (%L)',
+                   partition_name, first_day, (first_day + interval '1 month')::date);
+end;
+$$ language plpgsql;
+
+do
+$$
+declare
+    number_sequence text;
+    primary_key text;
+    first_month date;
+    month date;
+begin
+    if (select relkind from pg_class where oid = 'public.purchase_orders'::regclass) = 'p' then
+        return;
+    end if;
+
+    number_sequence := pg_get_serial_sequence('public.purchase_orders', 'purchase_order_number');
+    primary_key := (select conname from pg_constraint
+                    where conrelid = 'public.purchase_orders'::regclass and contype = 'p');
+
+    alter table public.purchase_orders rename to purchase_orders_unpartitioned;
+    -- free the primary key's index name for the new table
+    execute format('alter table public.purchase_orders_unpartitioned rename constraint %I to %I', primary_key,
+                   'purchase_orders_unpartitioned_pkey');
+    update public.purchase_orders_unpartitioned set sent_timestamp = now() where sent_timestamp is null;
+
+    execute format($create$
+    create table public.purchase_orders
+    (
+        purchase_order_id     uuid         not null default gen_random_uuid(),
+        purchase_order_number integer      not null default nextval(%L::regclass),
+        sender_id             uuid references public.users (user_id) on delete cascade,
+        recipient_id          uuid references public.users (user_id) on delete cascade,
+        purchaser_id          uuid references public.users (user_id) on delete cascade,
+        email_content         text,
+        json_content          text,
+        sent_timestamp        timestamp    not null default now(),
+        reviewed_timestamp    timestamp,
+        status                boolean,
+        sender_name           varchar(201),
+        recipient_name        varchar(201),
+        purchaser_name        varchar(201),
+        primary key (purchase_order_id, purchase_order_number, sent_timestamp)
+    ) partition by range (sent_timestamp)
+    $create$, number_sequence);
+
+    create table public.purchase_orders_default partition of public.purchase_orders default;
+
+    first_month := coalesce((select min(sent_timestamp) from public.purchase_orders_unpartitioned), now())::date;
+    month := date_trunc('month', first_month)::date;
+    while month <= (now() + interval '3 months')::date
+        loop
+            perform public.create_purchase_order_partition(month);
+            month := (month + interval '1 month')::date;
+        end loop;
+
+    insert into public.purchase_orders (purchase_order_id, purchase_order_number, sender_id, recipient_id, purchaser_id,
+                                        email_content, json_content, sent_timestamp, reviewed_timestamp, status,
+                                        sender_name, recipient_name, purchaser_name)
+    select purchase_order_id, purchase_order_number, sender_id, recipient_id, purchaser_id, email_content,
+           json_content, sent_timestamp, reviewed_timestamp, status, sender_name, recipient_name, purchaser_name
+    from public.purchase_orders_unpartitioned;
+
+    -- keep the order number sequence when its original owner is dropped
+    execute format('alter sequence %s owned by public.purchase_orders.purchase_order_number', number_sequence);
+    drop table public.purchase_orders_unpartitioned;
+end;
+$$;
+
+-- indexes from 001 and 002, now created on every partition; lookups by id use the primary key
+create index if not exists purchase_orders_number_idx on public.purchase_orders (purchase_order_number desc);
+create index if not exists purchase_orders_sender_idx on public.purchase_orders (sender_id, purchase_order_number desc);
+create index if not exists purchase_orders_recipient_idx on public.purchase_orders (recipient_id, purchase_order_number desc);
+create index if not exists purchase_orders_purchaser_idx on public.purchase_orders (purchaser_id, purchase_order_number desc);
+create index if not exists purchase_orders_pending_recipient_idx
+    on public.purchase_orders (recipient_id, purchase_order_number desc) where status is null;
+create index if not exists purchase_orders_status_idx
+    on public.purchase_orders (status, purchase_order_number desc);
+create index if not exists purchase_orders_sent_timestamp_idx
+    on public.purchase_orders (sent_timestamp);
+create index if not exists purchase_orders_reviewed_timestamp_idx
+    on public.purchase_orders (reviewed_timestamp) where reviewed_timestamp is not null;
+
+create table if not exists public.purchase_orders_archive
+(
+    purchase_order_id     uuid primary key,
+    purchase_order_number integer   not null,
+    sender_id             uuid references public.users (user_id) on delete cascade,
+    recipient_id          uuid references public.users (user_id) on delete cascade,
+    purchaser_id          uuid references public.users (user_id) on delete cascade,
+    email_content         text,
+    json_content          text,
+    sent_timestamp        timestamp not null,
+    reviewed_timestamp    timestamp,
+    status                boolean,
+    sender_name           varchar(201),
+    recipient_name        varchar(201),
+    purchaser_name        varchar(201),
+    archived_timestamp    timestamp not null default now()
+);
+
+create index if not exists purchase_orders_archive_sender_idx
+    on public.purchase_orders_archive (sender_id, purchase_order_number);
+create index if not exists purchase_orders_archive_recipient_idx
+    on public.purchase_orders_archive (recipient_id, purchase_order_number);
+create index if not exists purchase_orders_archive_purchaser_idx
+    on public.purchase_orders_archive (purchaser_id, purchase_order_number);
+
+-- the rename trigger from 001 keeps names current in the archive too
+create or replace function public.purchase_orders_refresh_names() returns trigger as
+$$
+begin
+    update public.purchase_orders set sender_name = new.first_name || ' ' || new.last_name
+    where sender_id = new.user_id;
+    update public.purchase_orders set recipient_name = new.first_name || ' ' || new.last_name
+    where recipient_id = new.user_id;
+    update public.purchase_orders set purchaser_name = new.first_name || ' ' || new.last_name
+    where purchaser_id = new.user_id;
+    update public.purchase_orders_archive set sender_name = new.first_name || ' ' || new.last_name
+    where sender_id = new.user_id;
+    update public.purchase_orders_archive set recipient_name = new.first_name || ' ' || new.last_name
+    where recipient_id = new.user_id;
+    update public.purchase_orders_archive set purchaser_name = new.first_name || ' ' || new.last_name
+    where purchaser_id = new.user_id;
+    return new;
+end;
+$$ language plpgsql;
@@ -0,0 +1,104 @@
+-- Per-user purchase order counters for the home page, kept current by triggers on purchase_orders so reading them is a
+-- primary key lookup:
+--
+--   purchase_order_counters.pending_review        orders waiting for the user's review as supervisor
+--   purchase_order_counters.awaiting_purchase     accepted orders assigned to the user as purchaser
+--   purchase_order_submissions.submitted          orders the user submitted, per month of sent_timestamp
+--
+-- Archiving an order deletes it from purchase_orders and so takes it out of the counters. `python manage.py
+-- reconcile-counters` rebuilds both tables from purchase_orders.
+
+create table if not exists public.purchase_order_counters
+(
+    user_id           uuid primary key references public.users (user_id) on delete cascade,
+    pending_review    integer not null default 0,
+    awaiting_purchase integer not null default 0
+);
+
+create table if not exists public.purchase_order_submissions
+(
+    user_id   uuid    not null references public.users (user_id) on delete cascade,
+    month     date    not null,
+    submitted integer not null default 0,
+    primary key (user_id, month)
+);
+
+-- takes the columns rather than the row, since the trigger fires with each partition's own row type
+create or replace function public.count_purchase_order(status boolean, sender_id uuid, recipient_id uuid,
+                                                       purchaser_id uuid, sent_timestamp timestamp,
+                                                       delta integer) returns void as
+$$
+begin
+    if status is null and recipient_id is not null then
+        insert into public.purchase_order_counters as c (user_id, pending_review) values (recipient_id, delta)
+        on conflict (user_id) do update set pending_review = c.pending_review + delta;
+    end if;
+    if status and purchaser_id is not null then
+        insert into public.purchase_order_counters as c (user_id, awaiting_purchase) values (purchaser_id, delta)
+        on conflict (user_id) do update set awaiting_purchase = c.awaiting_purchase + delta;
+    end if;
+    if sender_id is not null then
+        insert into public.purchase_order_submissions as s (user_id, month, submitted)
+        values (sender_id, date_trunc('month', sent_timestamp)::date, delta)
+        on conflict (user_id, month) do update set submitted = s.submitted + delta;
+    end if;
+end;
+$$ language plpgsql;
+
+create or replace function public.purchase_orders_count() returns trigger as
+$$
+begin
+    if tg_op in ('UPDATE', 'DELETE') then
+        perform public.count_purchase_order(old.status, old.sender_id, old.recipient_id, old.purchaser_id,
+                                            old.sent_timestamp, -1);
+    end if;
+    if tg_op in ('INSERT', 'UPDATE') then
+        perform public.count_purchase_order(new.status, new.sender_id, new.recipient_id, new.purchaser_id,
+                                            new.sent_timestamp, 1);
+    end if;
+    return null;
+end;
+$$ language plpgsql;
+
+drop trigger if exists purchase_orders_count_insert_delete on public.purchase_orders;
+create trigger purchase_orders_count_insert_delete
+    after insert or delete on public.purchase_orders
+    for each row
+execute procedure public.purchase_orders_count();
+
+-- content-only updates (reviews re-encrypting, key rotation) leave the counters alone
+drop trigger if exists purchase_orders_count_update on public.purchase_orders;
+create trigger purchase_orders_count_update
+    after update of status, sender_id, recipient_id, purchaser_id, sent_timestamp on public.purchase_orders
+    for each row
+    when (old.status is distinct from new.status or old.sender_id is distinct from new.sender_id or
+          old.recipient_id is distinct from new.recipient_id or old.purchaser_id is distinct from new.purchaser_id or
+          old.sent_timestamp is distinct from new.sent_timestamp)
+execute procedure public.purchase_orders_count();
+
+create or replace function public.reconcile_purchase_order_counters() returns void as
+$$
+begin
+    -- block order writes for the rebuild so no trigger update is lost between the delete and the insert
+    lock table public.purchase_orders in share mode;
+    delete from public.purchase_order_counters;
+    delete from public.purchase_order_submissions;
+
+    insert into public.purchase_order_counters (user_id, pending_review, awaiting_purchase)
+    select user_id, sum(pending_review), sum(awaiting_purchase)
+    from (select recipient_id as user_id, count(*) as pending_review, 0 as awaiting_purchase
+          from public.purchase_orders where status is null and recipient_id is not null group by recipient_id
+          union all
+          select purchaser_id, 0, count(*)
+          from public.purchase_orders where status and purchaser_id is not null group by purchaser_id) counts
+    group by user_id;
+
+    insert into public.purchase_order_submissions (user_id, month, submitted)
+    select sender_id, date_trunc('month', sent_timestamp)::date, count(*)
+    from public.purchase_orders
+    where sender_id is not null
+    group by sender_id, date_trunc('month', sent_timestamp)::date;
+end;
+$$ language plpgsql;
+
+select public.reconcile_purchase_order_counters();
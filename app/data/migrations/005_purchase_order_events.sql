@@ -0,0 +1,35 @@
+-- Notifies the `purchase_order_events` channel when an order is submitted or its status changes, for the /events
+-- stream (see events.py). Notifications are delivered when the transaction commits, to every listening worker.
+-- Sessions that set `purchase_orders.notify` to off (bulk fixture loads) send none.
+
+create or replace function public.purchase_orders_notify() returns trigger as
+$$
+begin
+    if current_setting('purchase_orders.notify', true) = 'off' then
+        return null;
+    end if;
+    perform pg_notify('purchase_order_events', json_build_object(
+        'event', case when tg_op = 'INSERT' then 'submitted' else 'reviewed' end,
+        'purchase_order_id', new.purchase_order_id,
+        'purchase_order_number', new.purchase_order_number,
+        'status', case when new.status is null then 'pending' when new.status then 'accepted' else 'rejected' end,
+        'sender_id', new.sender_id,
+        'recipient_id', new.recipient_id,
+        'purchaser_id', new.purchaser_id
+    )::text);
+    return null;
+end;
+$$ language plpgsql;
+
+drop trigger if exists purchase_orders_notify_insert on public.purchase_orders;
+create trigger purchase_orders_notify_insert
+    after insert on public.purchase_orders
+    for each row
+execute procedure public.purchase_orders_notify();
+
+drop trigger if exists purchase_orders_notify_review on public.purchase_orders;
+create trigger purchase_orders_notify_review
+    after update of status on public.purchase_orders
+    for each row
+    when (old.status is distinct from new.status)
+execute procedure public.purchase_orders_notify();
@@ -0,0 +1,18 @@
+-- Merkle timestamp proofs of purchase orders, see timestamping.py. Orders submitted before this carry a server
+-- signature instead and keep these columns null.
+
+alter table public.purchase_orders
+    add column if not exists order_digest       varchar(64),
+    add column if not exists timestamp_batch_id bigint,
+    add column if not exists timestamp_proof    text,
+    add column if not exists review_digest      varchar(64),
+    add column if not exists review_batch_id    bigint,
+    add column if not exists review_proof       text;
+
+alter table public.purchase_orders_archive
+    add column if not exists order_digest       varchar(64),
+    add column if not exists timestamp_batch_id bigint,
+    add column if not exists timestamp_proof    text,
+    add column if not exists review_digest      varchar(64),
+    add column if not exists review_batch_id    bigint,
+    add column if not exists review_proof       text;
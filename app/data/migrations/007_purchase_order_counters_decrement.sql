@@ -0,0 +1,40 @@
+-- Decrements only update existing counter rows. Deleting a user cascades to their orders, and the delete trigger then
+-- runs after the user's counter rows may already be gone; inserting them again violated the foreign key to users.
+-- A decrement always has a row to update otherwise, since the increment that it reverses created it.
+
+create or replace function public.count_purchase_order(status boolean, sender_id uuid, recipient_id uuid,
+                                                       purchaser_id uuid, sent_timestamp timestamp,
+                                                       delta integer) returns void as
+$$
+begin
+    if delta < 0 then
+        if status is null and recipient_id is not null then
+            update public.purchase_order_counters set pending_review = pending_review + delta
+            where user_id = recipient_id;
+        end if;
+        if status and purchaser_id is not null then
+            update public.purchase_order_counters set awaiting_purchase = awaiting_purchase + delta
+            where user_id = purchaser_id;
+        end if;
+        if sender_id is not null then
+            update public.purchase_order_submissions set submitted = submitted + delta
+            where user_id = sender_id and month = date_trunc('month', sent_timestamp)::date;
+        end if;
+        return;
+    end if;
+
+    if status is null and recipient_id is not null then
+        insert into public.purchase_order_counters as c (user_id, pending_review) values (recipient_id, delta)
+        on conflict (user_id) do update set pending_review = c.pending_review + delta;
+    end if;
+    if status and purchaser_id is not null then
+        insert into public.purchase_order_counters as c (user_id, awaiting_purchase) values (purchaser_id, delta)
+        on conflict (user_id) do update set awaiting_purchase = c.awaiting_purchase + delta;
+    end if;
+    if sender_id is not null then
+        insert into public.purchase_order_submissions as s (user_id, month, submitted)
+        values (sender_id, date_trunc('month', sent_timestamp)::date, delta)
+        on conflict (user_id, month) do update set submitted = s.submitted + delta;
+    end if;
+end;
+$$ language plpgsql;
@@ -1,12 +1,350 @@
+import asyncio
+import collections
+import contextvars
+import hashlib
+import json
+import logging
+import re
+import time
+
 import databases
 import sqlalchemy
 
+from datetime import datetime
+from sqlalchemy.dialects import postgresql
+
 from tables import metadata
 
 import constants
+import metrics
+import tracing
 
 # Initiates the database connection
 
-database = databases.Database(constants.DB_URL)
+logger = logging.getLogger(__name__)
+
+QUERY_TIME = metrics.Histogram("db_query_seconds", "Statement latency per normalized statement fingerprint",
+                               ["fingerprint"])
+SLOW_QUERIES = metrics.Counter("db_slow_queries_total", "Statements slower than SLOW_QUERY_MS per fingerprint",
+                               ["fingerprint"])
+READS = metrics.Counter("db_routed_reads_total", "Routed reads per database that served them", ["database"])
+REPLICA_FALLBACKS = metrics.Counter("db_replica_fallbacks_total",
+                                    "Routed reads retried on the primary after a replica error")
+REPLICA_LAG = metrics.Gauge("db_replica_lag_seconds", "Replication lag of the read replica at the last check, -1 if "
+                                                      "it is not used")
+
+LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+PLACEHOLDER_LISTS = re.compile(r"\((?:\s*(?:\?|%\([^)]+\)s|:\w+|\$\d+)\s*,)+\s*(?:\?|%\([^)]+\)s|:\w+|\$\d+)\s*\)")
+PYFORMAT = re.compile(r"%\(([^)]+)\)s")
+CALLS = re.compile(r"([\w.]+)\s*\(")
+
+# functions EXPLAIN ANALYZE may run; a statement calling anything else could have side effects and is only EXPLAINed
+READ_ONLY_FUNCTIONS = {
+    "count", "sum", "min", "max", "avg", "coalesce", "nullif", "lower", "upper", "greatest", "least", "now",
+    "date_trunc", "cast", "row_number", "exists", "any",
+}
+# keywords followed by a parenthesis that are not function calls
+KEYWORDS = {
+    "select", "from", "join", "as", "on", "where", "and", "or", "not", "in", "all", "values", "over", "union",
+    "using", "by", "lateral", "when", "then", "else", "filter", "with",
+}
+STATEMENT_CACHE_SIZE = 5000
+
+
+def statement(query, values=None):
+    # Returns (sql, params) for a SQLAlchemy query or a raw SQL string with :name parameters.
+    if isinstance(query, str):
+        return query, dict(values or {})
+    compiled = query.compile(dialect=postgresql.dialect(), compile_kwargs={"render_postcompile": True})
+    return PYFORMAT.sub(r":\1", compiled.string), dict(compiled.params)
+
+
+def cache_key(query):
+    # A key identifying a statement's SQL regardless of its values: the string itself, or SQLAlchemy's cache key. None
+    # for statements SQLAlchemy cannot cache, which are compiled on every call.
+    if isinstance(query, str):
+        return query
+    try:
+        key = query._generate_cache_key()
+    except AttributeError:
+        return None
+    return None if key is None else key.key
+
+
+def analyzable(sql: str):
+    # Whether EXPLAIN ANALYZE can safely run a statement again: a plain SELECT calling only read-only functions.
+    if not sql.lstrip().lower().startswith("select"):
+        return False
+    calls = CALLS.findall(LITERALS.sub("?", sql).lower())
+    return all(call in READ_ONLY_FUNCTIONS or call in KEYWORDS for call in calls)
+
+
+def normalize(sql: str):
+    # Strips literals, collapses placeholder lists and whitespace so that statements differing only in their values
+    # share a fingerprint.
+    sql = LITERALS.sub("?", sql)
+    sql = PLACEHOLDER_LISTS.sub("(...)", sql)
+    return " ".join(sql.split())
+
+
+def fingerprint(normalized: str):
+    return hashlib.sha1(normalized.encode("utf-8")).hexdigest()[:12]
+
+
+def bound_sql(query, sql: str, params: dict):
+    # The statement with its values inlined, for the slow query log. Falls back to the parameters alongside the SQL
+    # for values SQLAlchemy cannot render as literals.
+    if not isinstance(query, str):
+        try:
+            return str(query.compile(dialect=postgresql.dialect(), compile_kwargs={"literal_binds": True}))
+        except Exception:
+            pass
+    return "{} -- {}".format(sql, {key: str(value) for key, value in params.items()})
+
+
+class InstrumentedDatabase(databases.Database):
+    # Database that times every execute/fetch call per statement fingerprint. Statements slower than SLOW_QUERY_MS are
+    # written to SLOW_QUERY_LOG (one JSON object per line) with their bound SQL and, for SELECTs, their plan. The plan
+    # is captured in the background and at most once per fingerprint every SLOW_QUERY_EXPLAIN_INTERVAL seconds, with
+    # EXPLAIN (ANALYZE, BUFFERS) for plain SELECTs, which it re-runs, and a plain EXPLAIN for SELECTs calling other
+    # functions, which might have side effects. `iterate` streams are not timed.
+    #
+    # Fingerprints are cached per statement shape, so only statements SQLAlchemy cannot cache and slow ones are
+    # compiled a second time.
+
+    def __init__(self, url, name: str = "primary", **options):
+        super().__init__(url, **options)
+        self.name = name
+        self.statements = {}
+        self.slow_queries = collections.deque(maxlen=constants.SLOW_QUERY_KEEP)
+        self.explained = {}
+        self.shapes = {}
+
+    async def execute(self, query, values=None):
+        return await self.timed(super().execute, query, values)
+
+    async def execute_many(self, query, values):
+        return await self.timed(super().execute_many, query, values, many=True)
+
+    async def fetch_one(self, query, values=None):
+        return await self.timed(super().fetch_one, query, values)
+
+    async def fetch_all(self, query, values=None):
+        return await self.timed(super().fetch_all, query, values)
+
+    async def fetch_val(self, query, values=None, column=0):
+        return await self.timed(super().fetch_val, query, values, column=column)
+
+    async def timed(self, call, query, values, many=False, **kwargs):
+        with tracing.span("db.{}".format(call.__name__), database=self.name) as span:
+            start = time.perf_counter()
+            try:
+                return await call(query, values, **kwargs)
+            finally:
+                key = self.record(query, None if many else values, time.perf_counter() - start)
+                tracing.tag(span, fingerprint=key)
+
+    def shape(self, query, values):
+        # (normalized statement, fingerprint) of a query, from the cache when its shape was seen before.
+        shape_key = cache_key(query)
+        shape = self.shapes.get(shape_key) if shape_key is not None else None
+        if shape is None:
+            sql, _ = statement(query, values)
+            normalized = normalize(sql)
+            shape = normalized, fingerprint(normalized)
+            if shape_key is not None:
+                if len(self.shapes) >= STATEMENT_CACHE_SIZE:
+                    self.shapes.clear()
+                self.shapes[shape_key] = shape
+        return shape
+
+    def record(self, query, values, elapsed: float):
+        # Records a statement's latency, logging it if slow. Returns its fingerprint.
+        try:
+            normalized, key = self.shape(query, values)
+        except Exception:
+            return None
+        if self.name == "primary" and not normalized.lower().startswith("select"):
+            wrote()
+        self.statements.setdefault(key, normalized)
+        QUERY_TIME.observe(elapsed, fingerprint=key)
+
+        if elapsed * 1000 < constants.SLOW_QUERY_MS:
+            return key
+        SLOW_QUERIES.inc(fingerprint=key)
+        try:
+            sql, params = statement(query, values)
+        except Exception:
+            return key
+        entry = {
+            "timestamp": datetime.utcnow().isoformat(),
+            "fingerprint": key,
+            "elapsed_ms": round(elapsed * 1000, 2),
+            "statement": normalized,
+            "bound": bound_sql(query, sql, params),
+            "plan": None,
+        }
+        self.slow_queries.appendleft(entry)
+
+        last = self.explained.get(key, 0)
+        if sql.lstrip().lower().startswith("select") and time.monotonic() - last >= \
+                constants.SLOW_QUERY_EXPLAIN_INTERVAL:
+            self.explained[key] = time.monotonic()
+            asyncio.get_running_loop().create_task(self.explain(entry, sql, params))
+        else:
+            self.write(entry)
+        return key
+
+    async def explain(self, entry, sql: str, params: dict):
+        try:
+            prefix = "EXPLAIN (ANALYZE, BUFFERS) " if analyzable(sql) else "EXPLAIN "
+            query = sqlalchemy.text(prefix + sql).bindparams(**params)
+            async with self.connection() as connection:
+                rows = await connection.fetch_all(query)
+            entry["plan"] = "\n".join(row[0] for row in rows)
+        except Exception as e:
+            logger.warning(f"EXPLAIN of slow query {entry['fingerprint']} failed: {e}")
+            entry["plan"] = "EXPLAIN failed: {}".format(e)
+        self.write(entry)
+
+    def write(self, entry):
+        if not constants.SLOW_QUERY_LOG:
+            return
+        try:
+            with open(constants.SLOW_QUERY_LOG, "a") as file:
+                file.write(json.dumps(entry) + "\n")
+        except OSError as e:
+            logger.warning(f"writing the slow query log failed: {e}")
+
+    def statement_stats(self):
+        # Per fingerprint (fingerprint, statement, count, total seconds, mean ms), slowest total first.
+        stats = []
+        for key, normalized in self.statements.items():
+            _, total, count = QUERY_TIME.snapshot(fingerprint=key)
+            stats.append({
+                "fingerprint": key,
+                "statement": normalized,
+                "count": count,
+                "total": total,
+                "mean_ms": total / count * 1000 if count else 0,
+                "slow": SLOW_QUERIES.values.get((key,), 0),
+            })
+        return sorted(stats, key=lambda stat: stat["total"], reverse=True)
+
+
+# Read replica routing. With DB_REPLICA_URL set, the read-only calls that go through `reads` instead of `database` are
+# served by the replica while it is at most REPLICA_MAX_LAG_SECONDS behind, and by the primary otherwise or when the
+# replica fails. A request that writes pins its session to the primary for READ_YOUR_WRITES_SECONDS (a cookie set by
+# the read_routing middleware), so users always see their own changes. Everything else uses the primary.
+
+_session = contextvars.ContextVar("read_session", default=None)
+
+
+class ReadSession:
+    # Per-request routing state, shared with the route's task so writes made there are seen by the middleware.
+
+    def __init__(self, pinned: bool):
+        self.pinned = pinned
+        self.wrote = False
+
+
+def begin_session(pinned: bool):
+    return _session.set(ReadSession(pinned))
+
+
+def end_session(token):
+    # Ends the request's session and returns it.
+    session = _session.get()
+    _session.reset(token)
+    return session
+
+
+def wrote():
+    session = _session.get()
+    if session is not None:
+        session.wrote = True
+
+
+class ReadRouter:
+
+    def __init__(self, primary: InstrumentedDatabase, replica: InstrumentedDatabase = None):
+        self.primary = primary
+        self.replica = replica
+        self.lag = None
+
+    def usable(self):
+        return self.replica is not None and self.lag is not None and self.lag <= constants.REPLICA_MAX_LAG_SECONDS
+
+    def target(self, primary: bool):
+        session = _session.get()
+        if primary or not self.usable() or (session is not None and (session.pinned or session.wrote)):
+            return self.primary
+        return self.replica
+
+    async def read(self, method: str, query, values=None, primary: bool = False, **kwargs):
+        # Runs a read on the replica or the primary. A failed replica read is retried on the primary, and the replica
+        # is not used again until the next lag check succeeds.
+        target = self.target(primary)
+        READS.inc(database=target.name)
+        if target is self.primary:
+            return await getattr(target, method)(query, values, **kwargs)
+        try:
+            return await getattr(target, method)(query, values, **kwargs)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            REPLICA_FALLBACKS.inc()
+            logger.warning(f"replica read failed, using the primary: {e}")
+            self.lag = None
+            return await getattr(self.primary, method)(query, values, **kwargs)
+
+    async def fetch_one(self, query, values=None, primary: bool = False):
+        return await self.read("fetch_one", query, values, primary)
+
+    async def fetch_all(self, query, values=None, primary: bool = False):
+        return await self.read("fetch_all", query, values, primary)
+
+    async def fetch_val(self, query, values=None, primary: bool = False, column=0):
+        return await self.read("fetch_val", query, values, primary, column=column)
+
+    async def connect(self):
+        if self.replica is not None:
+            await self.replica.connect()
+            await self.check_lag()
+
+    async def disconnect(self):
+        if self.replica is not None:
+            await self.replica.disconnect()
+
+    async def check_lag(self):
+        # The replica is current when it has replayed the primary's WAL position; otherwise its lag is the age of the
+        # last transaction it replayed. A replica that is not replaying WAL, or not reachable, is not used.
+        if self.replica is None:
+            return
+        try:
+            position = await self.primary.fetch_val("select pg_current_wal_lsn()::text")
+            row = await self.replica.fetch_one(
+                "select pg_wal_lsn_diff(cast(:position as pg_lsn), pg_last_wal_replay_lsn()) as behind, "
+                "extract(epoch from now() - pg_last_xact_replay_timestamp()) as age",
+                {"position": position}
+            )
+            if row is None or row['behind'] is None:
+                self.lag = None
+            else:
+                self.lag = 0.0 if row['behind'] <= 0 else float(row['age'] or 0)
+        except Exception as e:
+            logger.warning(f"replica lag check failed: {e}")
+            self.lag = None
+        REPLICA_LAG.set(-1 if self.lag is None else self.lag)
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(constants.REPLICA_LAG_CHECK_SECONDS)
+            await self.check_lag()
+
+
+database = InstrumentedDatabase(constants.DB_URL)
+reads = ReadRouter(database, InstrumentedDatabase(constants.DB_REPLICA_URL, name="replica")
+                   if constants.DB_REPLICA_URL else None)
 engine = sqlalchemy.create_engine(constants.DB_URL, echo=False)
 metadata.create_all(engine)
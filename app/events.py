@@ -0,0 +1,151 @@
+import asyncio
+import json
+import logging
+
+import asyncpg
+
+import auth
+import constants
+import metrics
+
+# Server-sent events for purchase orders. A trigger on purchase_orders (migration 005) sends a NOTIFY on the
+# `purchase_order_events` channel when an order is submitted or reviewed; each worker holds one LISTEN connection and
+# forwards the notification to the /events streams of the order's participants and of administrators. Events only
+# carry the order's id, number and status, so the page can tell the user without reloading the order list.
+#
+# Every stream has a bounded queue. A client that falls EVENT_QUEUE_SIZE events behind has its queue replaced by a
+# single `resync` event (reload the list) rather than buffering without limit, and so does every client when the
+# LISTEN connection was lost, since notifications sent meanwhile are gone. Idle streams get a comment line every
+# EVENT_HEARTBEAT_SECONDS, which keeps proxies from closing them and notices closed clients and expired tokens.
+
+CHANNEL = "purchase_order_events"
+RESYNC = {"event": "resync"}
+
+logger = logging.getLogger(__name__)
+
+STREAMS = metrics.Gauge("event_streams", "Open /events streams in this worker")
+DELIVERED = metrics.Counter("events_delivered_total", "Events queued for /events streams per event", ["event"])
+OVERFLOWS = metrics.Counter("event_stream_overflows_total", "Streams that fell behind and were sent a resync")
+
+
+class Subscriber:
+
+    def __init__(self, user):
+        self.user_id = str(user['user_id'])
+        self.admin = user['role'] == "Admin"
+        self.queue = asyncio.Queue(maxsize=constants.EVENT_QUEUE_SIZE)
+
+    def deliver(self, event: dict):
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            OVERFLOWS.inc()
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait(RESYNC)
+
+
+class EventHub:
+
+    def __init__(self):
+        self.subscribers = {}
+        self.admins = set()
+        self.count = 0
+
+    def subscribe(self, user):
+        # Returns a Subscriber for the user, or None when the worker already serves EVENT_MAX_STREAMS streams.
+        if self.count >= constants.EVENT_MAX_STREAMS:
+            return None
+        subscriber = Subscriber(user)
+        if subscriber.admin:
+            self.admins.add(subscriber)
+        else:
+            self.subscribers.setdefault(subscriber.user_id, set()).add(subscriber)
+        self.count += 1
+        STREAMS.set(self.count)
+        return subscriber
+
+    def unsubscribe(self, subscriber: Subscriber):
+        if subscriber.admin:
+            self.admins.discard(subscriber)
+        else:
+            streams = self.subscribers.get(subscriber.user_id, set())
+            streams.discard(subscriber)
+            if not streams:
+                self.subscribers.pop(subscriber.user_id, None)
+        self.count -= 1
+        STREAMS.set(self.count)
+
+    def dispatch(self, event: dict):
+        participants = {event.get(key) for key in ("sender_id", "recipient_id", "purchaser_id")} - {None}
+        targets = set(self.admins)
+        for user_id in participants:
+            targets.update(self.subscribers.get(user_id, ()))
+        for subscriber in targets:
+            subscriber.deliver(event)
+        if targets:
+            DELIVERED.inc(len(targets), event=event.get("event", ""))
+
+    def resync(self):
+        for streams in [self.admins] + list(self.subscribers.values()):
+            for subscriber in streams:
+                subscriber.deliver(RESYNC)
+
+    def notified(self, connection, pid, channel, payload):
+        try:
+            event = json.loads(payload)
+        except ValueError:
+            logger.warning(f"ignoring malformed {channel} notification: {payload!r}")
+            return
+        self.dispatch(event)
+
+    async def run(self):
+        # Keeps a LISTEN connection open, reconnecting with backoff. The connection is checked every heartbeat.
+        delay = 1
+        connected_before = False
+        while True:
+            connection = None
+            try:
+                connection = await asyncpg.connect(constants.DB_URL)
+                await connection.add_listener(CHANNEL, self.notified)
+                if connected_before:
+                    self.resync()
+                connected_before = True
+                delay = 1
+                while True:
+                    await asyncio.sleep(constants.EVENT_HEARTBEAT_SECONDS)
+                    await connection.execute("select 1")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"event listener connection failed: {e}")
+            finally:
+                if connection is not None and not connection.is_closed():
+                    await connection.close()
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 30)
+
+
+hub = EventHub()
+
+
+def encode(event: dict):
+    return "event: {}\ndata: {}\n\n".format(event.get("event", "message"), json.dumps(event))
+
+
+async def stream(request, subscriber: Subscriber):
+    # The text/event-stream body of one /events connection. Ends when the client disconnects or its token expires or
+    # is revoked; browsers reconnect by themselves, and a reconnect without a valid token is refused.
+    try:
+        yield "retry: {}\n\n".format(int(constants.EVENT_RETRY_SECONDS * 1000))
+        while True:
+            try:
+                event = await asyncio.wait_for(subscriber.queue.get(), constants.EVENT_HEARTBEAT_SECONDS)
+            except asyncio.TimeoutError:
+                if await request.is_disconnected() or await auth.get_current_user(request) is None:
+                    return
+                yield ": heartbeat\n\n"
+                continue
+            yield encode(event)
+    finally:
+        hub.unsubscribe(subscriber)
@@ -13,6 +13,16 @@ API_401_CREDENTIALS_EXCEPTION = HTTPException(
     headers={"WWW-Authenticate": "Bearer"},
 )
 
+API_403_FORBIDDEN_EXCEPTION = HTTPException(
+    status_code=status.HTTP_403_FORBIDDEN,
+    detail="Not Authorized",
+)
+
+API_403_WRONG_PASSWORD_EXCEPTION = HTTPException(
+    status_code=status.HTTP_403_FORBIDDEN,
+    detail="Wrong Password",
+)
+
 API_404_NOT_FOUND_EXCEPTION = HTTPException(
     status_code=404,
     detail="Not Found",
@@ -23,6 +33,26 @@ API_409_USERNAME_CONFLICT_EXCEPTION = HTTPException(
     detail="Username Already Exists"
 )
 
+API_409_IDEMPOTENCY_IN_PROGRESS_EXCEPTION = HTTPException(
+    status_code=status.HTTP_409_CONFLICT,
+    detail="A Request With This Idempotency Key Is In Progress"
+)
+
+API_422_IDEMPOTENCY_KEY_REUSED_EXCEPTION = HTTPException(
+    status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+    detail="Idempotency Key Was Used For A Different Request"
+)
+
+API_422_INVALID_IDEMPOTENCY_KEY_EXCEPTION = HTTPException(
+    status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+    detail="Idempotency Key Must Be 1 To 100 Printable ASCII Characters Without Spaces"
+)
+
+API_413_ATTACHMENT_TOO_LARGE_EXCEPTION = HTTPException(
+    status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+    detail="Attachment Is Too Large"
+)
+
 API_500_SIGNATURE_EXCEPTION = HTTPException(
     status_code=500,
     detail="Internal Server Error",
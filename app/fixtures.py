@@ -0,0 +1,266 @@
+import asyncio
+import json
+import random
+import secrets
+import time
+import uuid
+
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+from pgpy.constants import HashAlgorithm, SymmetricKeyAlgorithm
+
+import constants
+import crypto
+import kdf
+import helper
+import methods
+import timestamping
+
+from database import database
+
+# Bulk fixture loader for staging and load tests. Users get real keys and orders are really signed and encrypted, so
+# every page works against the loaded data; key generation and order encryption run in a process pool and rows are
+# bulk-loaded with COPY. Each chunk of orders is timestamped like submitted and reviewed orders are, with one Merkle
+# batch over its order and review digests whose root the server key signs once.
+#
+# All fixture users share one password, so the password hash and private key KDF record are computed once. Orders are
+# exchanged within a pool of at most ACTIVE_POOL users of each role, whose private keys are the only ones kept in
+# memory after loading.
+
+FIXTURE_DOMAIN = "fixtures.example.com"
+ACTIVE_POOL = 200
+
+USER_COLUMNS = ["user_id", "email", "first_name", "last_name", "public_key", "password"]
+PRIVATE_KEY_COLUMNS = ["user_id", "private_key", "salt"]
+USER_ROLE_COLUMNS = ["role_name", "user_id"]
+PURCHASE_ORDER_COLUMNS = [
+    "purchase_order_id", "sender_id", "recipient_id", "purchaser_id", "sender_name", "recipient_name",
+    "purchaser_name", "email_content", "json_content", "sent_timestamp", "reviewed_timestamp", "status",
+    "order_digest", "timestamp_batch_id", "timestamp_proof", "review_digest", "review_batch_id", "review_proof",
+]
+
+
+def role_for(index: int):
+    if index % 10 == 0:
+        return "Supervisor"
+    if index % 10 == 1:
+        return "Purchaser"
+    return "User"
+
+
+def synthetic_order(item_count: int, sender_name="Bench Sender", recipient_name="Bench Supervisor", timestamp=None):
+    # A purchase order payload in the same shape submit_purchase_order builds.
+    timestamp = timestamp or datetime.utcnow()
+    items = [
+        {
+            "item_number": "PART-{:06d}".format(i),
+            "item_quantity": i % 50 + 1,
+            "item_price": round(1.5 + i * 0.25, 2),
+            "item_url": "https://supplier.example.com/parts/{}".format(i),
+            "item_details": "Synthetic line item {}".format(i),
+        }
+        for i in range(item_count)
+    ]
+    return {
+        "sender_name": sender_name,
+        "recipient_name": recipient_name,
+        "purchase_order": {
+            "supplier_name": "Example Supplies Ltd.",
+            "supplier_contact": "orders@supplier.example.com",
+            "supplier_address": "1 Example Road, Springfield",
+            "items": items
+        },
+        "created_timestamp": timestamp.isoformat(),
+        "readable_timestamp": timestamp.strftime("%B %d, %Y, %H:%M"),
+        "nonce": secrets.token_hex(16)
+    }
+
+
+def generate_users(start: int, count: int, profile: str, password_hash: str, salt: str, derived_key: bytes):
+    # Worker: generates and protects keys for users start .. start + count - 1.
+    users = []
+    for index in range(start, start + count):
+        first_name, last_name = "Fixture", "User{}".format(index)
+        email = "user{}@{}".format(index, FIXTURE_DOMAIN)
+        key = crypto.generate_key("{} {}".format(first_name, last_name), email, profile)
+        public_key = str(key.pubkey)
+        key.protect(derived_key, SymmetricKeyAlgorithm.AES256, HashAlgorithm.SHA256)
+        users.append({
+            "user_id": uuid.uuid4(),
+            "email": email,
+            "first_name": first_name,
+            "last_name": last_name,
+            "public_key": public_key,
+            "password": password_hash,
+            "private_key": str(key),
+            "salt": salt,
+            "role": role_for(index),
+        })
+    return users
+
+
+def generate_orders(count: int, sender, recipient, purchaser, derived_key: bytes, item_count: int):
+    # Worker: signs and encrypts `count` orders from sender to recipient exactly as submit_purchase_order does, and
+    # reviews two thirds of them (accepted or rejected, naming purchaser) exactly as review_purchase_order does. The
+    # order and review digests are timestamped in one batch. Returns (batch, orders) with the batch's
+    # timestamp_batches columns and each order's purchase_orders columns but the batch ids, which the loader adds.
+    sender_key = crypto.parsed_key(sender['private_key'])
+    recipient_key = crypto.parsed_key(recipient['private_key'])
+    sender_public_key = sender_key.pubkey
+    recipient_public_key = recipient_key.pubkey
+    purchaser_public_key = crypto.parsed_key(purchaser['public_key'])
+
+    sender_name = "{} {}".format(sender['first_name'], sender['last_name'])
+    recipient_name = "{} {}".format(recipient['first_name'], recipient['last_name'])
+    purchaser_name = "{} {}".format(purchaser['first_name'], purchaser['last_name'])
+    now = datetime.utcnow()
+
+    orders = []
+    with sender_key.unlock(derived_key), recipient_key.unlock(derived_key):
+        for _ in range(count):
+            po_id = uuid.uuid4()
+            sent = now - timedelta(minutes=random.randint(0, 60 * 24 * 365 * 3))
+            data = synthetic_order(item_count, sender_name, recipient_name, sent)
+            review_url = "{}/purchase_orders/{}".format(constants.SERVER_ADDRESS, po_id)
+            email = methods.format_purchase_order(data, review_url)
+            content = json.dumps(data)
+            order_digest = timestamping.digest_of(content)
+            status = random.choice([None, True, False])
+
+            if status is None:
+                signers = [sender_key]
+                recipients = [sender_public_key, recipient_public_key]
+                reviewed = None
+                review_digest = None
+            else:
+                signers = [recipient_key]
+                recipients = [recipient_public_key, purchaser_public_key, sender_public_key]
+                reviewed = sent + timedelta(minutes=random.randint(1, 60 * 24 * 7))
+                review_digest = timestamping.review_digest(po_id, order_digest, status,
+                                                           purchaser['user_id'] if status else None, reviewed)
+
+            orders.append({
+                "purchase_order_id": po_id,
+                "sender_id": sender['user_id'],
+                "recipient_id": recipient['user_id'],
+                "purchaser_id": purchaser['user_id'] if status else None,
+                "sender_name": sender_name,
+                "recipient_name": recipient_name,
+                "purchaser_name": purchaser_name if status else None,
+                "email_content": crypto.sign_and_encrypt(email, signers, recipients),
+                "json_content": crypto.sign_and_encrypt(content, signers, recipients),
+                "sent_timestamp": sent,
+                "reviewed_timestamp": reviewed,
+                "status": status,
+                "order_digest": order_digest,
+                "review_digest": review_digest,
+            })
+
+    digests = [order["order_digest"] for order in orders] + \
+        [order["review_digest"] for order in orders if order["review_digest"]]
+    root, proofs = timestamping.merkle_tree(digests)
+    proofs = iter(proofs)
+    for order in orders:
+        order["timestamp_proof"] = json.dumps(next(proofs))
+    for order in orders:
+        order["review_proof"] = json.dumps(next(proofs)) if order["review_digest"] else None
+
+    sealed = datetime.utcnow()
+    signature, _ = crypto.sign_timestamp(timestamping.statement(root, len(digests), sealed))
+    batch = {"root": root, "leaf_count": len(digests), "sealed_timestamp": sealed, "signature": signature}
+    return batch, orders
+
+
+async def completed(pool, func, calls, window: int):
+    # Runs func over the argument tuples in the process pool with at most `window` calls in flight, yielding results
+    # as they complete.
+    loop = asyncio.get_running_loop()
+    pending = set()
+    for args in calls:
+        pending.add(loop.run_in_executor(pool, func, *args))
+        if len(pending) >= window:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+    while pending:
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        for future in done:
+            yield future.result()
+
+
+def report(label: str, done: int, total: int, start: float):
+    elapsed = time.perf_counter() - start
+    print("{}: {}/{} rows, {:.1f}s, {:.0f} rows/s".format(label, done, total, elapsed, done / elapsed if elapsed else 0),
+          flush=True)
+
+
+async def load(user_count: int, order_count: int, workers: int, profile: str, password: str, item_count: int,
+               chunk_size: int):
+    # Generates and loads user_count users and order_count purchase orders, reporting throughput as it goes.
+    password_hash = kdf.hash_password(password)
+    salt = kdf.new_salt()
+    derived_key = kdf.derive_key(password, salt)
+    window = workers * 2
+
+    pools = {"User": [], "Supervisor": [], "Purchaser": []}
+
+    async with database.connection() as connection:
+        raw_connection = connection.raw_connection
+        with ProcessPoolExecutor(workers) as pool:
+            start = time.perf_counter()
+            loaded = 0
+            calls = (
+                (first, min(chunk_size, user_count - first), profile, password_hash, salt, derived_key)
+                for first in range(0, user_count, chunk_size)
+            )
+            async for users in completed(pool, generate_users, calls, window):
+                await raw_connection.copy_records_to_table(
+                    "users", columns=USER_COLUMNS, records=[tuple(u[c] for c in USER_COLUMNS) for u in users])
+                await raw_connection.copy_records_to_table(
+                    "private_keys", columns=PRIVATE_KEY_COLUMNS,
+                    records=[tuple(u[c] for c in PRIVATE_KEY_COLUMNS) for u in users])
+                await raw_connection.copy_records_to_table(
+                    "user_roles", columns=USER_ROLE_COLUMNS, records=[(u["role"], u["user_id"]) for u in users])
+
+                for user in users:
+                    role_pool = pools[user["role"]]
+                    if len(role_pool) < ACTIVE_POOL:
+                        role_pool.append({k: user[k] for k in
+                                          ("user_id", "first_name", "last_name", "public_key", "private_key")})
+
+                loaded += len(users)
+                report("users", loaded, user_count, start)
+
+            if order_count and not all(pools.values()):
+                print("orders: skipped, need at least one user of each role (load more users)")
+                return
+
+            # orders are backdated up to three years
+            await helper.ensure_purchase_order_partitions(months_back=37)
+
+            # no /events notification per fixture order
+            await raw_connection.execute("set purchase_orders.notify = off")
+            start = time.perf_counter()
+            loaded = 0
+            calls = (
+                (min(chunk_size, order_count - first), random.choice(pools["User"]),
+                 random.choice(pools["Supervisor"]), random.choice(pools["Purchaser"]), derived_key, item_count)
+                for first in range(0, order_count, chunk_size)
+            )
+            async for batch, orders in completed(pool, generate_orders, calls, window):
+                batch_id = await raw_connection.fetchval(
+                    "insert into public.timestamp_batches (root, leaf_count, sealed_timestamp, signature) "
+                    "values ($1, $2, $3, $4) returning batch_id",
+                    batch["root"], batch["leaf_count"], batch["sealed_timestamp"], batch["signature"])
+                for order in orders:
+                    order["timestamp_batch_id"] = batch_id
+                    order["review_batch_id"] = batch_id if order["review_digest"] else None
+                await raw_connection.copy_records_to_table(
+                    "purchase_orders", columns=PURCHASE_ORDER_COLUMNS,
+                    records=[tuple(order[c] for c in PURCHASE_ORDER_COLUMNS) for order in orders])
+                loaded += len(orders)
+                report("orders", loaded, order_count, start)
+
+        await raw_connection.execute("reset purchase_orders.notify")
+        await raw_connection.execute("analyze public.users, public.private_keys, public.user_roles, "
+                                     "public.purchase_orders, public.timestamp_batches")
@@ -1,9 +1,14 @@
 import os.path
+import shutil
 
 from sqlalchemy.sql import delete, select, insert, update
 from database import database
 
-from constants import DATA_ROOT
+from datetime import datetime, timedelta
+
+from constants import DATA_ROOT, MIGRATIONS_ROOT
+
+import constants
 
 import tables
 import auth
@@ -13,62 +18,135 @@ import models
 
 # This file is for helper methods, used for utility purposes
 
+MIGRATIONS_LOCK = 7301
+PARTITIONS_LOCK = 7302
+
+
+async def run_migrations():
+    # Applies the SQL files in MIGRATIONS_ROOT that have not been applied yet, in file name order, each in its own
+    # transaction. metadata.create_all only creates missing tables, so column, index and trigger changes to existing
+    # tables live here. An advisory lock keeps concurrently starting workers from applying the same file twice.
+    async with database.connection() as connection:
+        raw_connection = connection.raw_connection
+        await raw_connection.execute("select pg_advisory_lock({})".format(MIGRATIONS_LOCK))
+        try:
+            rows = await raw_connection.fetch("select name from public.schema_migrations")
+            applied = {row['name'] for row in rows}
+
+            for name in sorted(os.listdir(MIGRATIONS_ROOT)):
+                if not name.endswith(".sql") or name in applied:
+                    continue
+                with open(os.path.join(MIGRATIONS_ROOT, name), 'r') as file:
+                    commands = file.read()
+                async with raw_connection.transaction():
+                    await raw_connection.execute(commands)
+                    await raw_connection.execute("insert into public.schema_migrations (name) values ($1)", name)
+                print("Applied migration {}".format(name))
+        finally:
+            await raw_connection.execute("select pg_advisory_unlock({})".format(MIGRATIONS_LOCK))
+
+
+SEED_FILES = ["roles.sql", "users.sql", "user_roles.sql", "private_keys.sql"]
+
 
 async def reset_database():
     # Resets the database by deleting all existing data from the tables and re-populating them using SQL files stored
     # in DATA_ROOT. This function is used for initializing or restoring the database to a default state.
-    # print("Resetting database...")
-    # await database.execute(delete(tables.communities))
-    # await database.execute(delete(tables.following_communities))
-    # await database.execute(delete(tables.activity))
-    # await database.execute(delete(tables.post_images))
-    # await database.execute(delete(tables.post_locations))
-    # await database.execute(delete(tables.likes))
-    # await database.execute(delete(tables.comments))
-    # await database.execute(delete(tables.posts))
-    # await database.execute(delete(tables.following))
-    # await database.execute(delete(tables.followers))
-    # await database.execute(delete(tables.user_credentials))
-    # await database.execute(delete(tables.users))
-    #
-    # with open(os.path.join(DATA_ROOT, "users.sql"), 'r') as file:
-    #     user_commands = file.read()
-    #     await database.execute(user_commands)
-    #
-    # with open(os.path.join(DATA_ROOT, "user_credentials.sql"), 'r') as file:
-    #     user_commands = file.read()
-    #     await database.execute(user_commands)
-    #
-    # with open(os.path.join(DATA_ROOT, "followers.sql"), 'r') as file:
-    #     user_commands = file.read()
-    #     await database.execute(user_commands)
-    #
-    # with open(os.path.join(DATA_ROOT, "following.sql"), 'r') as file:
-    #     user_commands = file.read()
-    #     await database.execute(user_commands)
-    #
-    # with open(os.path.join(DATA_ROOT, "posts.sql"), 'r') as file:
-    #     user_commands = file.read()
-    #     await database.execute(user_commands)
-    #
-    # with open(os.path.join(DATA_ROOT, "comments.sql"), 'r') as file:
-    #     user_commands = file.read()
-    #     await database.execute(user_commands)
-    #
-    # with open(os.path.join(DATA_ROOT, "likes.sql"), 'r') as file:
-    #     user_commands = file.read()
-    #     await database.execute(user_commands)
-    #
-    # with open(os.path.join(DATA_ROOT, "post_locations.sql"), 'r') as file:
-    #     user_commands = file.read()
-    #     await database.execute(user_commands)
-    #
-    # with open(os.path.join(DATA_ROOT, "post_images.sql"), 'r') as file:
-    #     user_commands = file.read()
-    #     await database.execute(user_commands)
-    #
-    # with open(os.path.join(DATA_ROOT, "activity.sql"), 'r') as file:
-    #     user_commands = file.read()
-    #     await database.execute(user_commands)
-
-    print("Database Reset Complete")
\ No newline at end of file
+    print("Resetting database...")
+    async with database.connection() as connection:
+        raw_connection = connection.raw_connection
+        async with raw_connection.transaction():
+            # tokens are authorized from their claims alone, so every token issued before the reset is revoked; the
+            # seeded users keep their ids, and token_revocations is kept for the users about to be deleted
+            await raw_connection.execute(
+                "insert into public.token_revocations (user_id, token_version) "
+                "select user_id, 1 from public.users "
+                "on conflict (user_id) do update "
+                "set token_version = public.token_revocations.token_version + 1, revoked_timestamp = now()"
+            )
+            await raw_connection.execute(
+                "truncate public.purchase_orders, public.purchase_orders_archive, public.idempotency_keys, "
+                "public.key_rotations, public.purchase_order_counters, public.purchase_order_submissions, "
+                "public.purchase_order_attachments, public.timestamp_batches, "
+                "public.private_keys, public.user_roles, public.users, public.roles "
+                "restart identity cascade"
+            )
+            for name in SEED_FILES:
+                with open(os.path.join(DATA_ROOT, name), 'r') as file:
+                    await raw_connection.execute(file.read())
+
+    await auth.revocations.refresh()
+    # the attachment rows are gone, so are their encrypted files
+    shutil.rmtree(os.path.join(constants.MEDIA_ROOT, "attachments"), ignore_errors=True)
+    print("Database Reset Complete")
+
+
+async def reconcile_purchase_order_counters():
+    # Rebuilds the home page counters from purchase_orders, e.g. after orders were changed with triggers disabled.
+    async with database.transaction():
+        await database.execute("select public.reconcile_purchase_order_counters()")
+
+
+async def ensure_purchase_order_partitions(months_ahead: int = None, months_back: int = 0):
+    # Creates the monthly purchase_orders partitions from months_back months ago to months_ahead months from now, so
+    # new orders never land in the default partition. An advisory lock keeps concurrently starting workers from
+    # creating the same partition twice.
+    months_ahead = constants.PARTITION_MONTHS_AHEAD if months_ahead is None else months_ahead
+    async with database.transaction():
+        await database.execute("select pg_advisory_xact_lock({})".format(PARTITIONS_LOCK))
+        await database.execute(
+            "select public.create_purchase_order_partition("
+            "(date_trunc('month', now()) + make_interval(months => m))::date) "
+            "from generate_series(cast(:months_back as int), cast(:months_ahead as int)) as m",
+            {"months_back": -months_back, "months_ahead": months_ahead}
+        )
+
+
+ARCHIVE_BATCH = """
+with batch as (
+    select purchase_order_id, sent_timestamp from public.purchase_orders
+    where status is not null and reviewed_timestamp < $1
+    order by sent_timestamp
+    limit $2
+    for update skip locked
+), moved as (
+    delete from public.purchase_orders po using batch
+    where po.purchase_order_id = batch.purchase_order_id and po.sent_timestamp = batch.sent_timestamp
+    returning po.*
+)
+insert into public.purchase_orders_archive (
+    purchase_order_id, purchase_order_number, sender_id, recipient_id, purchaser_id, email_content, json_content,
+    sent_timestamp, reviewed_timestamp, status, sender_name, recipient_name, purchaser_name, order_digest,
+    timestamp_batch_id, timestamp_proof, review_digest, review_batch_id, review_proof
+)
+select purchase_order_id, purchase_order_number, sender_id, recipient_id, purchaser_id, email_content, json_content,
+       sent_timestamp, reviewed_timestamp, status, sender_name, recipient_name, purchaser_name, order_digest,
+       timestamp_batch_id, timestamp_proof, review_digest, review_batch_id, review_proof
+from moved
+"""
+
+
+async def archive_closed_purchase_orders(older_than_days: int = None, batch_size: int = None):
+    # Moves purchase orders reviewed more than older_than_days ago from purchase_orders to purchase_orders_archive,
+    # batch_size rows per transaction so live traffic is never blocked for long; rows locked by a running review are
+    # skipped and picked up next time. Also creates upcoming partitions. Returns the number of orders moved.
+    older_than_days = constants.ARCHIVE_AFTER_DAYS if older_than_days is None else older_than_days
+    batch_size = batch_size or constants.ARCHIVE_BATCH_SIZE
+    cutoff = datetime.utcnow() - timedelta(days=older_than_days)
+
+    await ensure_purchase_order_partitions()
+
+    moved = 0
+    async with database.connection() as connection:
+        raw_connection = connection.raw_connection
+        while True:
+            async with raw_connection.transaction():
+                result = await raw_connection.execute(ARCHIVE_BATCH, cutoff, batch_size)
+            count = int(result.split()[-1])
+            moved += count
+            if count:
+                print("Archived {} purchase orders".format(moved), flush=True)
+            if count < batch_size:
+                break
+        await raw_connection.execute("analyze public.purchase_orders, public.purchase_orders_archive")
+    return moved
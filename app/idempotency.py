@@ -0,0 +1,114 @@
+import asyncio
+import hashlib
+import json
+import re
+import time
+
+from datetime import datetime, timedelta
+from sqlalchemy.sql import select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+import constants
+import exceptions
+import tables
+
+from database import database
+
+# Idempotency keys for purchase order submission and review. The forms carry a key generated when they are rendered
+# and API clients send an Idempotency-Key header. The first request with a key claims it and runs; a retry with the same
+# key gets the stored result instead of repeating the KDF, signing, encryption, insert and email. A retry arriving
+# while the first request is still running waits for its result. Keys are scoped to the user and expire after
+# IDEMPOTENCY_TTL_HOURS.
+#
+# A failed request (e.g. a wrong password) releases its key so the user can retry it.
+
+IN_PROGRESS = "in_progress"
+COMPLETED = "completed"
+
+# printable ASCII without spaces, at most as long as the idempotency_key column
+KEY_PATTERN = re.compile(r"[\x21-\x7e]{{1,{}}}".format(tables.idempotency_keys.c.idempotency_key.type.length))
+
+_last_prune = 0.0
+
+
+def fingerprint(*fields):
+    # Hash of a request's inputs, so a key reused for a different request is rejected. Never include the password.
+    return hashlib.sha256(json.dumps(fields, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+async def claim(user_id, key: str, operation: str, request_hash: str):
+    # Claims a key, returning None, or returns the row of the request that already holds it. Expired keys can be
+    # claimed again.
+    await prune()
+    keys = tables.idempotency_keys
+    expired = datetime.utcnow() - timedelta(hours=constants.IDEMPOTENCY_TTL_HOURS)
+    query = pg_insert(keys).values(
+        user_id=user_id, idempotency_key=key, operation=operation, request_hash=request_hash, status=IN_PROGRESS
+    )
+    query = query.on_conflict_do_update(
+        index_elements=[keys.c.user_id, keys.c.idempotency_key],
+        set_={"operation": operation, "request_hash": request_hash, "status": IN_PROGRESS, "result": None,
+              "created_timestamp": datetime.utcnow()},
+        where=keys.c.created_timestamp < expired
+    ).returning(keys.c.idempotency_key)
+    if await database.fetch_val(query) is not None:
+        return None
+    return await existing(user_id, key)
+
+
+async def existing(user_id, key: str):
+    keys = tables.idempotency_keys
+    query = select([keys]).where(keys.c.user_id == user_id).where(keys.c.idempotency_key == key)
+    return await database.fetch_one(query)
+
+
+async def complete(user_id, key: str, result):
+    keys = tables.idempotency_keys
+    await database.execute(keys.update().where(keys.c.user_id == user_id).where(keys.c.idempotency_key == key).values(
+        status=COMPLETED, result=json.dumps(result)
+    ))
+
+
+async def release(user_id, key: str):
+    keys = tables.idempotency_keys
+    await database.execute(keys.delete().where(keys.c.user_id == user_id).where(keys.c.idempotency_key == key))
+
+
+async def prune():
+    # Deletes expired keys, at most once a minute per worker.
+    global _last_prune
+    if time.monotonic() - _last_prune < 60:
+        return
+    _last_prune = time.monotonic()
+    expired = datetime.utcnow() - timedelta(hours=constants.IDEMPOTENCY_TTL_HOURS)
+    await database.execute(tables.idempotency_keys.delete().where(tables.idempotency_keys.c.created_timestamp < expired))
+
+
+async def once(user_id, key: str, operation: str, request_hash: str, run):
+    # Runs the coroutine function `run` once per key and returns its JSON-serializable result, or the stored result of
+    # the request that already ran with this key.
+    if not KEY_PATTERN.fullmatch(key):
+        raise exceptions.API_422_INVALID_IDEMPOTENCY_KEY_EXCEPTION
+    row = await claim(user_id, key, operation, request_hash)
+    if row is None:
+        try:
+            result = await run()
+        except BaseException:
+            await release(user_id, key)
+            raise
+        await complete(user_id, key, result)
+        return result
+
+    deadline = time.monotonic() + constants.IDEMPOTENCY_WAIT_SECONDS
+    while True:
+        if row is None:
+            # the first request failed and released the key
+            return await once(user_id, key, operation, request_hash, run)
+        if row['operation'] != operation or row['request_hash'] != request_hash:
+            raise exceptions.API_422_IDEMPOTENCY_KEY_REUSED_EXCEPTION
+        if row['status'] == COMPLETED:
+            return json.loads(row['result'])
+        if time.monotonic() >= deadline:
+            raise exceptions.API_409_IDEMPOTENCY_IN_PROGRESS_EXCEPTION
+        await asyncio.sleep(0.25)
+        row = await existing(user_id, key)
@@ -0,0 +1,191 @@
+import hashlib
+import hmac
+import os
+import time
+
+import bcrypt
+
+from base64 import urlsafe_b64encode, b64encode, b64decode
+from hashlib import sha256
+
+import constants
+
+try:
+    from argon2 import low_level as argon2
+except ImportError:
+    argon2 = None
+
+# Versioned, parameterized key derivation. Every stored credential is a self-describing record in modular crypt format,
+# so the scheme and parameters travel with each user and can be changed per deployment without a migration:
+#
+#   users.password        $2b$12$<salt><hash>                         bcrypt (the original format)
+#                         $scrypt$ln=15,r=8,p=1$<salt>$<hash>
+#                         $argon2id$v=19$m=65536,t=3,p=1$<salt>$<hash>
+#
+#   private_keys.salt     $2b$12$<salt>                               bcrypt, then sha256 (the original format)
+#                         $scrypt$ln=15,r=8,p=1$<salt>
+#                         $argon2id$v=19$m=65536,t=3,p=1$<salt>
+#
+# The private key record has no hash part; the derived key is the passphrase protecting the user's PGP private key and
+# is never stored.
+
+SCHEMES = ("bcrypt", "scrypt", "argon2id")
+
+DERIVED_KEY_LENGTH = 32
+
+
+def current_params():
+    # Returns the KDF parameters configured for this deployment.
+    scheme = constants.KDF_SCHEME
+    if scheme == "bcrypt":
+        return {"scheme": "bcrypt", "rounds": constants.BCRYPT_ROUNDS}
+    if scheme == "scrypt":
+        return {"scheme": "scrypt", "ln": constants.SCRYPT_LN, "r": constants.SCRYPT_R, "p": constants.SCRYPT_P}
+    if scheme == "argon2id":
+        return {"scheme": "argon2id", "m": constants.ARGON2_MEMORY_COST, "t": constants.ARGON2_TIME_COST,
+                "p": constants.ARGON2_PARALLELISM}
+    raise ValueError("Unknown KDF scheme {}".format(scheme))
+
+
+def _b64(data: bytes):
+    return b64encode(data).decode('ascii').rstrip('=')
+
+
+def _unb64(data: str):
+    return b64decode(data + '=' * (-len(data) % 4))
+
+
+def _format_params(params):
+    if params["scheme"] == "scrypt":
+        return "$scrypt$ln={ln},r={r},p={p}".format(**params)
+    return "$argon2id$v=19$m={m},t={t},p={p}".format(**params)
+
+
+def parse(record: str):
+    # Splits a password hash or private key record into (params, salt, hash). The salt and hash are bytes for scrypt
+    # and argon2id; for bcrypt the salt is the 29 character bcrypt salt string as bytes, which is what bcrypt expects.
+    if record.startswith("$2"):
+        rounds = int(record[4:6])
+        return {"scheme": "bcrypt", "rounds": rounds}, record[:29].encode('utf-8'), record[29:].encode('utf-8')
+
+    fields = record.split("$")
+    if fields[1] == "scrypt":
+        settings = dict(item.split("=") for item in fields[2].split(","))
+        params = {"scheme": "scrypt", "ln": int(settings["ln"]), "r": int(settings["r"]), "p": int(settings["p"])}
+        rest = fields[3:]
+    elif fields[1] == "argon2id":
+        settings = dict(item.split("=") for item in fields[3].split(","))
+        params = {"scheme": "argon2id", "m": int(settings["m"]), "t": int(settings["t"]), "p": int(settings["p"])}
+        rest = fields[4:]
+    else:
+        raise ValueError("Unknown KDF record")
+
+    salt = _unb64(rest[0])
+    digest = _unb64(rest[1]) if len(rest) > 1 else b""
+    return params, salt, digest
+
+
+def _raw(password: str, params, salt: bytes):
+    # The raw KDF output for scrypt and argon2id.
+    if params["scheme"] == "scrypt":
+        n = 2 ** params["ln"]
+        return hashlib.scrypt(password.encode('utf-8'), salt=salt, n=n, r=params["r"], p=params["p"],
+                              maxmem=256 * n * params["r"] + 1024 * 1024, dklen=DERIVED_KEY_LENGTH)
+    if params["scheme"] == "argon2id":
+        if argon2 is None:
+            raise RuntimeError("argon2id requires the argon2-cffi package")
+        return argon2.hash_secret_raw(password.encode('utf-8'), salt, time_cost=params["t"],
+                                      memory_cost=params["m"], parallelism=params["p"],
+                                      hash_len=DERIVED_KEY_LENGTH, type=argon2.Type.ID)
+    raise ValueError("Unknown KDF scheme {}".format(params["scheme"]))
+
+
+def new_salt(params=None):
+    # Generates a private key record (a salt with its parameters) for the given or current parameters.
+    params = params or current_params()
+    if params["scheme"] == "bcrypt":
+        return bcrypt.gensalt(params["rounds"]).decode('utf-8')
+    return "{}${}".format(_format_params(params), _b64(os.urandom(16)))
+
+
+def hash_password(password: str, params=None):
+    params = params or current_params()
+    if params["scheme"] == "bcrypt":
+        return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(params["rounds"])).decode('utf-8')
+    salt = os.urandom(16)
+    return "{}${}${}".format(_format_params(params), _b64(salt), _b64(_raw(password, params, salt)))
+
+
+def verify_password(password: str, hashed: str):
+    params, salt, digest = parse(hashed)
+    if params["scheme"] == "bcrypt":
+        return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
+    return hmac.compare_digest(_raw(password, params, salt), digest)
+
+
+def derive_key(password: str, record: str):
+    # Derives the passphrase protecting a user's private key from their password and private key record.
+    params, salt, _ = parse(record)
+    if params["scheme"] == "bcrypt":
+        return urlsafe_b64encode(sha256(bcrypt.hashpw(password.encode('utf-8'), salt)).digest())
+    return urlsafe_b64encode(_raw(password, params, salt))
+
+
+def needs_update(record: str, params=None):
+    # True when a password hash or private key record was made with parameters other than the current ones.
+    return parse(record)[0] != (params or current_params())
+
+
+def time_params(params, rounds=3):
+    # Median time in milliseconds of one derivation with the given parameters.
+    salt = new_salt(params)
+    samples = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        derive_key("calibration-password", salt)
+        samples.append((time.perf_counter() - start) * 1000)
+    return sorted(samples)[len(samples) // 2]
+
+
+def candidates(scheme):
+    # Parameter sets of increasing cost for calibration.
+    if scheme == "bcrypt":
+        for rounds in range(4, 32):
+            yield {"scheme": "bcrypt", "rounds": rounds}
+    elif scheme == "scrypt":
+        for ln in range(10, 25):
+            yield {"scheme": "scrypt", "ln": ln, "r": 8, "p": 1}
+    elif scheme == "argon2id":
+        for t in range(1, 65):
+            yield {"scheme": "argon2id", "m": constants.ARGON2_MEMORY_COST, "t": t, "p": constants.ARGON2_PARALLELISM}
+    else:
+        raise ValueError("Unknown KDF scheme {}".format(scheme))
+
+
+def calibrate(scheme: str, target_ms: float):
+    # Returns the most expensive parameters of the scheme whose derivation time on this machine stays within the
+    # target, together with the measured time. Falls back to the cheapest parameters if even those exceed it.
+    best = None
+    for params in candidates(scheme):
+        elapsed = time_params(params)
+        if elapsed > target_ms:
+            break
+        best = (params, elapsed)
+    if best is None:
+        params = next(candidates(scheme))
+        best = (params, time_params(params))
+    return best
+
+
+def environment(params):
+    # The .env lines that select the given parameters.
+    lines = ["KDF_SCHEME={}".format(params["scheme"])]
+    if params["scheme"] == "bcrypt":
+        lines.append("BCRYPT_ROUNDS={}".format(params["rounds"]))
+    elif params["scheme"] == "scrypt":
+        lines += ["SCRYPT_LN={}".format(params["ln"]), "SCRYPT_R={}".format(params["r"]),
+                  "SCRYPT_P={}".format(params["p"])]
+    else:
+        lines += ["ARGON2_MEMORY_COST={}".format(params["m"]), "ARGON2_TIME_COST={}".format(params["t"]),
+                  "ARGON2_PARALLELISM={}".format(params["p"])]
+    return lines
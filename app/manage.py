@@ -0,0 +1,137 @@
+import argparse
+import asyncio
+import getpass
+import os
+
+import kdf
+import crypto
+import attachments
+import helper
+import fixtures
+import rotation
+import constants
+import timestamping
+
+from database import database
+
+# Maintenance commands. Run them inside the server container, e.g.
+#
+#   docker compose exec server python manage.py calibrate --target-ms 250
+#   docker compose exec server python manage.py load-fixtures --users 100000 --orders 1000000 --profile ed25519
+#   docker compose exec server python manage.py archive-orders --older-than-days 365
+#   docker compose exec server python manage.py rotate-key --email alice@example.com --profile ed25519
+
+
+async def with_database(coroutine):
+    await database.connect()
+    try:
+        return await coroutine
+    finally:
+        await database.disconnect()
+
+
+def calibrate(args):
+    # Picks the most expensive KDF parameters whose derivation stays within the target latency on this machine and
+    # prints the .env lines that select them. Logins take roughly twice this (password check plus key derivation when
+    # the private key is used).
+    params, elapsed = kdf.calibrate(args.scheme, args.target_ms)
+    print("# {} derivation takes {:.1f}ms on this machine (target {}ms)".format(params["scheme"], elapsed,
+                                                                              args.target_ms))
+    for line in kdf.environment(params):
+        print(line)
+
+
+def reset_database(args):
+    # Truncates every table and reloads the seed data in DATA_ROOT.
+    asyncio.run(with_database(helper.reset_database()))
+
+
+def archive_orders(args):
+    # Moves old reviewed purchase orders to the archive table and creates upcoming partitions. Run it from cron.
+    asyncio.run(with_database(helper.archive_closed_purchase_orders(args.older_than_days, args.batch_size)))
+
+
+def reconcile_counters(args):
+    # Rebuilds the per-user purchase order counters of the home page from purchase_orders.
+    asyncio.run(with_database(helper.reconcile_purchase_order_counters()))
+
+
+def sweep_attachments(args):
+    # Removes attachments without an order and stored files without an attachment.
+    removed, files = asyncio.run(with_database(attachments.sweep(args.min_age_hours * 3600)))
+    print("removed {} orphaned attachments and {} unreferenced files".format(removed, files))
+
+
+def resign_timestamps(args):
+    # Re-signs the purchase order timestamp batches with the current server key.
+    count = asyncio.run(with_database(timestamping.resign_batches()))
+    print("re-signed {} timestamp batches".format(count))
+
+
+def rotate_key(args):
+    # Replaces a user's key (or, with --keep-key --resign-server, keeps it) and re-encrypts their purchase orders.
+    password = getpass.getpass("Password of {}: ".format(args.email))
+    asyncio.run(with_database(rotation.rotate(
+        args.email, password, args.profile, args.keep_key, args.resign_server, args.workers, args.batch_size
+    )))
+
+
+def load_fixtures(args):
+    # Bulk-loads synthetic users with real keys and signed, encrypted purchase orders, reporting rows/s.
+    asyncio.run(with_database(fixtures.load(
+        args.users, args.orders, args.workers, args.profile, args.password, args.items, args.chunk_size
+    )))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Secure Purchase Order maintenance commands.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    command = commands.add_parser("calibrate", help="pick KDF parameters for a target latency")
+    command.add_argument("--scheme", choices=kdf.SCHEMES, default="bcrypt")
+    command.add_argument("--target-ms", type=float, default=250)
+    command.set_defaults(func=calibrate)
+
+    command = commands.add_parser("reset-database", help="truncate all tables and reload the seed data")
+    command.set_defaults(func=reset_database)
+
+    command = commands.add_parser("archive-orders", help="move old reviewed purchase orders to the archive table")
+    command.add_argument("--older-than-days", type=int, default=constants.ARCHIVE_AFTER_DAYS)
+    command.add_argument("--batch-size", type=int, default=constants.ARCHIVE_BATCH_SIZE)
+    command.set_defaults(func=archive_orders)
+
+    command = commands.add_parser("reconcile-counters", help="rebuild the home page purchase order counters")
+    command.set_defaults(func=reconcile_counters)
+
+    command = commands.add_parser("rotate-key", help="replace a user's key and re-encrypt their purchase orders")
+    command.add_argument("--email", required=True)
+    command.add_argument("--profile", choices=list(crypto.KEY_PROFILES), default=constants.KEY_PROFILE)
+    command.add_argument("--keep-key", action="store_true", help="keep the user's key, only re-sign")
+    command.add_argument("--resign-server", action="store_true", help="add a signature by the current server key")
+    command.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    command.add_argument("--batch-size", type=int, default=50, help="orders per worker task and transaction")
+    command.set_defaults(func=rotate_key)
+
+    command = commands.add_parser("sweep-attachments", help="remove attachments and files left without an order")
+    command.add_argument("--min-age-hours", type=float, default=1, help="keep younger files, which may be uploading")
+    command.set_defaults(func=sweep_attachments)
+
+    command = commands.add_parser("resign-timestamps", help="re-sign timestamp batches with the current server key")
+    command.set_defaults(func=resign_timestamps)
+
+    command = commands.add_parser("load-fixtures", help="bulk-load synthetic users and purchase orders")
+    command.add_argument("--users", type=int, default=1000)
+    command.add_argument("--orders", type=int, default=10000)
+    command.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    command.add_argument("--profile", choices=list(crypto.KEY_PROFILES), default=constants.KEY_PROFILE)
+    command.add_argument("--password", default="password", help="password of every fixture user")
+    command.add_argument("--items", type=int, default=5, help="line items per order")
+    command.add_argument("--chunk-size", type=int, default=50, help="rows generated per worker task")
+    command.set_defaults(func=load_fixtures)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,13 @@
 import uuid
 
+import io
+import codecs
+import time
+import asyncio
+import csv
+import tarfile
+import hashlib
+import secrets
 import pgpy
 import json
 import os.path
@@ -8,38 +16,44 @@ import requests
 
 from uuid import UUID
 from fastapi_mail import FastMail, MessageSchema, ConnectionConfig, MessageType
-from fastapi import Request, BackgroundTasks
+from fastapi import Request, BackgroundTasks, HTTPException
 from fastapi.responses import StreamingResponse, RedirectResponse
 from sqlalchemy.sql import select, insert, update, or_, delete
-from sqlalchemy import func, desc
+from sqlalchemy import func, desc, true, false, union_all
 from pgpy import PGPKey, PGPMessage
+from pgpy.errors import PGPDecryptionError
 from pgpy.constants import PubKeyAlgorithm, KeyFlags, HashAlgorithm, SymmetricKeyAlgorithm, CompressionAlgorithm
 from typing import List
 from datetime import datetime, timedelta
+from pydantic import ValidationError
 
 import auth
+import attachments
+import crypto
+import idempotency
 import tables
 import exceptions
 import models
+import metrics
+import tracing
+import timestamping
 import constants
 
-from database import database
+from database import database, reads
 from constants import MEDIA_ROOT
 
 
-async def create_user(first_name: str, last_name: str, role: str, email: str, password: str):
+async def create_user(first_name: str, last_name: str, role: str, email: str, password: str, key_profile: str = None):
     query = tables.users.select().where(tables.users.c.email == email)
     existing_user = await database.execute(query)
     if existing_user:
         raise exceptions.API_409_USERNAME_CONFLICT_EXCEPTION
+    elif key_profile and key_profile not in crypto.KEY_PROFILES:
+        raise exceptions.API_400_BAD_REQUEST_EXCEPTION
     else:
         async with (database.transaction()):
             try:
-                key = PGPKey.new(PubKeyAlgorithm.RSAEncryptOrSign, 2048)
-                uid = pgpy.PGPUID.new(first_name + ' ' + last_name, email=email)
-                key.add_uid(uid, usage={KeyFlags.Sign, KeyFlags.EncryptCommunications},
-                            hashes=[HashAlgorithm.SHA256], ciphers=[SymmetricKeyAlgorithm.AES256],
-                            compression=[CompressionAlgorithm.ZLIB])
+                key = crypto.generate_key(first_name + ' ' + last_name, email, key_profile)
 
                 query = tables.users.insert().values(
                     email=email,
@@ -71,11 +85,16 @@ async def create_user(first_name: str, last_name: str, role: str, email: str, pa
             except Exception as e:
                 print(e)
                 await database.rollback()
+        role_directory.invalidate()
 
 
 async def delete_user(user_id):
+    # Deletes a user, which deletes their orders, and the attachments of those orders.
     query = tables.users.delete().where(tables.users.c.user_id == user_id)
     await database.execute(query)
+    await attachments.remove_orphans()
+    await auth.revocations.revoke(user_id)
+    role_directory.invalidate()
 
 
 async def get_private_key_and_salt(user_id):
@@ -84,73 +103,347 @@ async def get_private_key_and_salt(user_id):
     return pkey['private_key'], pkey['salt']
 
 
+async def get_retired_key(user_id):
+    # The (private key, salt) a user had before a key rotation still in progress, or None.
+    query = select([tables.key_rotations.c.retired_private_key, tables.key_rotations.c.retired_salt]).where(
+        tables.key_rotations.c.user_id == user_id)
+    row = await database.fetch_one(query)
+    return (row['retired_private_key'], row['retired_salt']) if row else None
+
+
 async def get_users():
     query = select([tables.users, tables.roles]).select_from(
         tables.users.join(tables.user_roles).join(tables.roles)
     )
-    return await database.fetch_all(query)
+    return await reads.fetch_all(query)
 
 
 async def get_public_key(user_id):
     query = select([tables.users.c.public_key]).where(tables.users.c.user_id == user_id)
-    return await database.execute(query)
+    return await reads.fetch_val(query)
+
+
+ROLE_DIRECTORY_LOOKUPS = metrics.Counter("role_directory_lookups_total",
+                                         "Role directory lookups by result (hit, miss or coalesced)", ["result"])
+
+
+class RoleDirectory:
+    # Cache of the users holding a role (plus Admins), for the supervisor and purchaser pickers. Concurrent lookups of
+    # a role that is not cached share a single query (single-flight). Entries live until create_user or delete_user
+    # invalidates them, or at most ROLE_DIRECTORY_TTL_SECONDS so other worker processes pick up changes too.
+
+    def __init__(self):
+        self.entries = {}
+        self.pending = {}
+        self.generation = 0
+        self.invalidated = 0.0
+
+    async def get(self, role_name: str):
+        entry = self.entries.get(role_name)
+        if entry is not None and time.monotonic() - entry[0] < constants.ROLE_DIRECTORY_TTL_SECONDS:
+            ROLE_DIRECTORY_LOOKUPS.inc(result="hit")
+            return entry[1]
+
+        future = self.pending.get(role_name)
+        if future is None:
+            ROLE_DIRECTORY_LOOKUPS.inc(result="miss")
+            future = self.pending[role_name] = asyncio.ensure_future(self.load(role_name))
+            future.add_done_callback(lambda done: self.pending.pop(role_name, None)
+                                     if self.pending.get(role_name) is done else None)
+        else:
+            ROLE_DIRECTORY_LOOKUPS.inc(result="coalesced")
+        # shielded so a cancelled request does not cancel the query other requests are waiting for
+        return await asyncio.shield(future)
+
+    async def load(self, role_name: str):
+        generation = self.generation
+        query = select([tables.users.c.user_id, tables.users.c.first_name, tables.users.c.last_name]).select_from(
+            tables.users.join(tables.user_roles).join(tables.roles)
+        ).where(or_(tables.roles.c.role_name == role_name, tables.roles.c.role_name == "Admin")).order_by(
+            tables.users.c.last_name, tables.users.c.first_name)
+        # right after a change, read from the primary so a lagging replica cannot put stale rows in the cache
+        rows = await reads.fetch_all(query, primary=time.monotonic() - self.invalidated <
+                                     constants.READ_YOUR_WRITES_SECONDS)
+        # a query started before an invalidation may have missed the change
+        if generation == self.generation:
+            self.entries[role_name] = (time.monotonic(), rows)
+        return rows
+
+    def invalidate(self):
+        self.generation += 1
+        self.invalidated = time.monotonic()
+        self.entries.clear()
+        self.pending.clear()
+
+
+role_directory = RoleDirectory()
 
 
 async def get_users_by_role(role_name: str):
-    query = select([tables.users]).select_from(
-        tables.users.join(tables.user_roles).join(tables.roles)
-    ).where(or_(tables.roles.c.role_name == role_name, tables.roles.c.role_name == "Admin"))
-    return await database.fetch_all(query)
+    return await role_directory.get(role_name)
+
+
+PURCHASE_ORDER_COLUMNS = [column.name for column in tables.purchase_orders.columns]
 
 
 async def get_purchase_order(po_id: uuid):
-    query = select([tables.purchase_orders]).where(tables.purchase_orders.c.purchase_order_id == po_id)
-    return await database.fetch_one(query)
+    # Looks an order up in purchase_orders and, only when it is not there, in purchase_orders_archive. The row's
+    # `archived` column says which table it came from.
+    current = select(
+        [tables.purchase_orders.c[name] for name in PURCHASE_ORDER_COLUMNS] + [false().label('archived')]
+    ).where(tables.purchase_orders.c.purchase_order_id == po_id)
+    archived = select(
+        [tables.purchase_orders_archive.c[name] for name in PURCHASE_ORDER_COLUMNS] + [true().label('archived')]
+    ).where(tables.purchase_orders_archive.c.purchase_order_id == po_id)
+    return await database.fetch_one(union_all(current, archived).limit(1))
+
+
+SEARCH_PAGE_LIMIT = 200
+
+PURCHASE_ORDER_LIST_COLUMNS = [
+    tables.purchase_orders.c.purchase_order_id,
+    tables.purchase_orders.c.purchase_order_number,
+    tables.purchase_orders.c.sender_id,
+    tables.purchase_orders.c.recipient_id,
+    tables.purchase_orders.c.purchaser_id,
+    tables.purchase_orders.c.sender_name,
+    tables.purchase_orders.c.recipient_name,
+    tables.purchase_orders.c.purchaser_name,
+    tables.purchase_orders.c.sent_timestamp,
+    tables.purchase_orders.c.reviewed_timestamp,
+    tables.purchase_orders.c.status,
+]
+
+
+def restrict_to_participant(query, user):
+    # Limits a purchase order query to orders the user takes part in, unless the user is an Admin.
+    if user['role'] == "Admin":
+        return query
+    return query.where(
+        or_(
+            tables.purchase_orders.c.sender_id == user['user_id'],
+            tables.purchase_orders.c.recipient_id == user['user_id'],
+            tables.purchase_orders.c.purchaser_id == user['user_id'],
+        )
+    )
+
+
+def filter_purchase_orders(query, filters: models.PurchaseOrderFilter):
+    # Applies metadata filters to a purchase order query. Date ranges are inclusive of whole days.
+    po = tables.purchase_orders.c
+
+    if filters.number_from is not None:
+        query = query.where(po.purchase_order_number >= filters.number_from)
+    if filters.number_to is not None:
+        query = query.where(po.purchase_order_number <= filters.number_to)
+    if filters.sent_from is not None:
+        query = query.where(po.sent_timestamp >= filters.sent_from)
+    if filters.sent_to is not None:
+        query = query.where(po.sent_timestamp < filters.sent_to + timedelta(days=1))
+    if filters.reviewed_from is not None:
+        query = query.where(po.reviewed_timestamp >= filters.reviewed_from)
+    if filters.reviewed_to is not None:
+        query = query.where(po.reviewed_timestamp < filters.reviewed_to + timedelta(days=1))
+
+    if filters.status == models.PurchaseOrderStatus.pending:
+        query = query.where(po.status.is_(None))
+    elif filters.status == models.PurchaseOrderStatus.accepted:
+        query = query.where(po.status.is_(True))
+    elif filters.status == models.PurchaseOrderStatus.rejected:
+        query = query.where(po.status.is_(False))
+
+    if filters.participant_id is not None:
+        query = query.where(
+            or_(
+                po.sender_id == filters.participant_id,
+                po.recipient_id == filters.participant_id,
+                po.purchaser_id == filters.participant_id,
+            )
+        )
+    return query
 
 
 async def get_purchase_orders_by_user(user):
-    sender = tables.users.alias('sender')
-    recipient = tables.users.alias('receiver')
-    purchaser = tables.users.alias('purchaser')
+    # Lists purchase order metadata from the purchase order table alone: participant names are captured on the row at
+    # submit and review time, and the encrypted contents are not needed for the list.
+    query = select(PURCHASE_ORDER_LIST_COLUMNS).order_by(desc(tables.purchase_orders.c.purchase_order_number))
+    query = restrict_to_participant(query, user)
+    return await reads.fetch_all(query)
+
+
+async def get_purchase_order_counters(user_id):
+    # The home page counters of a user: orders waiting for their review, accepted orders they are to purchase and
+    # orders they submitted this month. Triggers on purchase_orders keep the counter tables current, so these are two
+    # primary key lookups whatever the number of orders.
+    counters = await database.fetch_one(select([
+        tables.purchase_order_counters.c.pending_review, tables.purchase_order_counters.c.awaiting_purchase
+    ]).where(tables.purchase_order_counters.c.user_id == user_id))
+    month = datetime.utcnow().date().replace(day=1)
+    submitted = await database.fetch_val(select([tables.purchase_order_submissions.c.submitted]).where(
+        tables.purchase_order_submissions.c.user_id == user_id).where(
+        tables.purchase_order_submissions.c.month == month))
+    return {
+        "pending_review": counters['pending_review'] if counters else 0,
+        "awaiting_purchase": counters['awaiting_purchase'] if counters else 0,
+        "submitted_this_month": submitted or 0,
+        "month": month,
+    }
 
-    if user['role'] == "Admin":
-        query = select([
-            tables.purchase_orders,
-            sender.c.first_name.label('sender_first_name'),
-            sender.c.last_name.label('sender_last_name'),
-            recipient.c.first_name.label('receiver_first_name'),
-            recipient.c.last_name.label('receiver_last_name'),
-            purchaser.c.first_name.label('purchaser_first_name'),
-            purchaser.c.last_name.label('purchaser_last_name'),
-        ]).select_from(
-            tables.purchase_orders
-            .join(sender, tables.purchase_orders.c.sender_id == sender.c.user_id)
-            .join(recipient, tables.purchase_orders.c.recipient_id == recipient.c.user_id)
-            .outerjoin(purchaser, tables.purchase_orders.c.purchaser_id == purchaser.c.user_id)
-        ).order_by(desc(tables.purchase_orders.c.purchase_order_number))
-        return await database.fetch_all(query)
+
+async def search_purchase_orders(user, filters: models.PurchaseOrderFilter, before: int = None, limit: int = 50):
+    # Returns one page of matching purchase orders, newest first, and the cursor for the next page (None on the last
+    # page). Pages are keyed on the purchase order number so every page is an index range scan, however deep.
+    po = tables.purchase_orders.c
+    limit = max(1, min(limit, SEARCH_PAGE_LIMIT))
+
+    query = select(PURCHASE_ORDER_LIST_COLUMNS)
+    query = restrict_to_participant(query, user)
+    query = filter_purchase_orders(query, filters)
+    if before is not None:
+        query = query.where(po.purchase_order_number < before)
+    query = query.order_by(desc(po.purchase_order_number)).limit(limit + 1)
+
+    rows = await reads.fetch_all(query)
+    if len(rows) > limit:
+        return rows[:limit], rows[limit - 1]['purchase_order_number']
+    return rows, None
+
+
+EXPORT_CHUNK_ROWS = 1000
+
+EXPORT_FIELDS = [
+    "purchase_order_number", "purchase_order_id", "status", "sent_timestamp", "reviewed_timestamp",
+    "sender_id", "sender_name", "recipient_id", "recipient_name", "purchaser_id", "purchaser_name",
+]
+
+
+def status_of(row):
+    # The status of a purchase order row as a PurchaseOrderStatus.
+    if row['status'] is None:
+        return models.PurchaseOrderStatus.pending
+    elif row['status']:
+        return models.PurchaseOrderStatus.accepted
+    return models.PurchaseOrderStatus.rejected
+
+
+def export_record(row):
+    # Flattens a purchase order row into export values.
+    record = {field: row[field] for field in EXPORT_FIELDS if field != "status"}
+    for field in ("purchase_order_id", "sender_id", "recipient_id", "purchaser_id"):
+        if record[field] is not None:
+            record[field] = str(record[field])
+    for field in ("sent_timestamp", "reviewed_timestamp"):
+        if record[field] is not None:
+            record[field] = record[field].isoformat()
+    record["status"] = status_of(row).value
+    return record
+
+
+async def export_purchase_orders(user, filters: models.PurchaseOrderFilter, export_format: str):
+    # Streams purchase order metadata matching the filters as CSV or NDJSON. Rows come from a server-side cursor and
+    # are sent in chunks of EXPORT_CHUNK_ROWS, so memory use stays constant however large the table is.
+    query = select(PURCHASE_ORDER_LIST_COLUMNS)
+    query = restrict_to_participant(query, user)
+    query = filter_purchase_orders(query, filters)
+    query = query.order_by(tables.purchase_orders.c.purchase_order_number)
+
+    def encode_csv(records, header=False):
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, fieldnames=EXPORT_FIELDS)
+        if header:
+            writer.writeheader()
+        writer.writerows(records)
+        return buffer.getvalue()
+
+    def encode_ndjson(records):
+        return "".join(json.dumps(record) + "\n" for record in records)
+
+    async def iterrows():
+        if export_format == "csv":
+            yield encode_csv([], header=True)
+        chunk = []
+        async for row in database.iterate(query):
+            chunk.append(export_record(row))
+            if len(chunk) >= EXPORT_CHUNK_ROWS:
+                yield encode_csv(chunk) if export_format == "csv" else encode_ndjson(chunk)
+                chunk = []
+        if chunk:
+            yield encode_csv(chunk) if export_format == "csv" else encode_ndjson(chunk)
+
+    if export_format == "csv":
+        media_type = "text/csv"
+    elif export_format == "ndjson":
+        media_type = "application/x-ndjson"
     else:
-        query = select([
-            tables.purchase_orders,
-            sender.c.first_name.label('sender_first_name'),
-            sender.c.last_name.label('sender_last_name'),
-            recipient.c.first_name.label('receiver_first_name'),
-            recipient.c.last_name.label('receiver_last_name'),
-            purchaser.c.first_name.label('purchaser_first_name'),
-            purchaser.c.last_name.label('purchaser_last_name'),
-        ]).select_from(
-            tables.purchase_orders
-            .join(sender, tables.purchase_orders.c.sender_id == sender.c.user_id)
-            .join(recipient, tables.purchase_orders.c.recipient_id == recipient.c.user_id)
-            .outerjoin(purchaser, tables.purchase_orders.c.purchaser_id == purchaser.c.user_id)
-        ).where(
-            or_(
-                tables.purchase_orders.c.sender_id == user['user_id'],
-                tables.purchase_orders.c.recipient_id == user['user_id'],
-                tables.purchase_orders.c.purchaser_id == user['user_id'],
-            )
-        ).order_by(desc(tables.purchase_orders.c.purchase_order_number))
-        return await database.fetch_all(query)
+        raise exceptions.API_400_BAD_REQUEST_EXCEPTION
+
+    return StreamingResponse(iterrows(), media_type=media_type, headers={
+        "Content-Disposition": "attachment; filename=purchase_orders.{}".format(export_format)
+    })
+
+
+def tar_member(name: str, data: bytes, mtime: float):
+    # Encodes one regular file as a tar header plus its contents padded to the tar block size.
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mtime = mtime
+    info.mode = 0o644
+    return info.tobuf(format=tarfile.PAX_FORMAT) + data + b"\0" * (-len(data) % tarfile.BLOCKSIZE)
+
+
+async def archive_purchase_orders(user_id):
+    # Streams a tar archive of the stored, still signed and encrypted contents of every purchase order a user takes
+    # part in, straight from a database cursor. Nothing is decrypted. Each order becomes a directory with email.asc,
+    # json.asc and MANIFEST.json, which records the order's number, id, timestamps, status and the SHA-256 digest of
+    # each file. Every order is written as soon as it is read, so memory use does not grow with the number of orders.
+    def participating(table):
+        po = table.c
+        return select([
+            po.purchase_order_id, po.purchase_order_number, po.sent_timestamp, po.reviewed_timestamp, po.status,
+            po.email_content, po.json_content
+        ]).where(or_(po.sender_id == user_id, po.recipient_id == user_id, po.purchaser_id == user_id))
+
+    query = union_all(
+        participating(tables.purchase_orders_archive), participating(tables.purchase_orders)
+    ).order_by('purchase_order_number')
+
+    async def iterfile():
+        async for row in database.iterate(query):
+            directory = "PO-{:06d}".format(row['purchase_order_number'])
+            mtime = (row['reviewed_timestamp'] or row['sent_timestamp'] or datetime.utcnow()).timestamp()
+            digests = {}
+            chunk = b""
+            for name, content in (("email.asc", row['email_content']), ("json.asc", row['json_content'])):
+                data = (content or "").encode('utf-8')
+                digests[name] = hashlib.sha256(data).hexdigest()
+                chunk += tar_member("{}/{}".format(directory, name), data, mtime)
+            manifest = json.dumps({
+                "purchase_order_number": row['purchase_order_number'],
+                "purchase_order_id": str(row['purchase_order_id']),
+                "sent_timestamp": row['sent_timestamp'].isoformat() if row['sent_timestamp'] else None,
+                "reviewed_timestamp": row['reviewed_timestamp'].isoformat() if row['reviewed_timestamp'] else None,
+                "status": row['status'],
+                "sha256": digests
+            }, indent=2).encode('utf-8')
+            yield chunk + tar_member("{}/MANIFEST.json".format(directory), manifest, mtime)
+
+        yield b"\0" * (tarfile.BLOCKSIZE * 2)
+
+    return StreamingResponse(iterfile(), media_type="application/x-tar", headers={
+        "Content-Disposition": "attachment; filename=purchase_orders_{}.tar".format(user_id)
+    })
+
+
+def parse_purchase_order_filter(request: Request):
+    # Builds search filters from the query string, ignoring the empty fields an HTML form submits.
+    values = {
+        key: value for key, value in request.query_params.items()
+        if value != "" and key in models.PurchaseOrderFilter.__fields__
+    }
+    try:
+        return models.PurchaseOrderFilter(**values)
+    except ValidationError:
+        raise exceptions.API_400_BAD_REQUEST_EXCEPTION
 
 
 async def download_private_key(user, password: str, request, templates):
@@ -199,61 +492,130 @@ async def send_email(sender, body, recipient):
         subtype=MessageType.plain)
 
     fm = FastMail(constants.conf)
-    await fm.send_message(message)
+    with tracing.span("email.send"):
+        await fm.send_message(message)
 
 
 def format_purchase_order(data, review_url):
-    formatted_text = f"Purchase Order Summary\n"
-    formatted_text += f"Date Requested: {data['readable_timestamp']}\n\n"
-    formatted_text += f"Requested by: {data['sender_name']}\n"
-    formatted_text += f"Sent to: {data['recipient_name']}\n\n"
-    formatted_text += "Supplier Information:\n"
-    formatted_text += f"Name: {data['purchase_order']['supplier_name']}\n"
-    formatted_text += f"Contact: {data['purchase_order']['supplier_contact']}\n"
-    formatted_text += f"Address: {data['purchase_order']['supplier_address']}\n\n"
-    formatted_text += "Items Ordered:\n"
+    # Builds the email body as a list of lines joined once, so its cost grows linearly with the number of items.
+    po = data['purchase_order']
+    lines = [
+        "Purchase Order Summary",
+        "Date Requested: {}".format(data['readable_timestamp']),
+        "",
+        "Requested by: {}".format(data['sender_name']),
+        "Sent to: {}".format(data['recipient_name']),
+        "",
+        "Supplier Information:",
+        "Name: {}".format(po['supplier_name']),
+        "Contact: {}".format(po['supplier_contact']),
+        "Address: {}".format(po['supplier_address']),
+        "",
+        "Items Ordered:",
+    ]
+    for idx, item in enumerate(po['items'], start=1):
+        lines.append(ITEM_TEMPLATE.format(idx, item['item_details'], item['item_number'], item['item_quantity'],
+                                          item['item_price'], item['item_url']))
+    lines.append("Review Purchase Order: {}".format(review_url))
+    lines.append("")
+    return "\n".join(lines)
 
-    for idx, item in enumerate(data['purchase_order']['items'], start=1):
-        formatted_text += f"Item {idx}:\n"
-        formatted_text += f"  - Details: {item['item_details']}\n"
-        formatted_text += f"  - Number: {item['item_number']}\n"
-        formatted_text += f"  - Quantity: {item['item_quantity']}\n"
-        formatted_text += f"  - Price: ${item['item_price']}\n"
-        formatted_text += f"  - URL: {item['item_url']}\n\n"
 
-    formatted_text += f"Review Purchase Order: {review_url}\n"
+ITEM_TEMPLATE = "Item {}:\n  - Details: {}\n  - Number: {}\n  - Quantity: {}\n  - Price: ${}\n  - URL: {}\n"
 
-    return formatted_text
+ITEM_FIELDS = ["item_number", "item_quantity", "item_price", "item_url", "item_details"]
 
 
-async def submit_purchase_order(
-        request: Request,
-        templates,
-        user: models.UserSys,
-        supervisor_id: str,
+def invalid_items(detail: str):
+    return HTTPException(status_code=422, detail="Invalid Line Items: {}".format(detail))
+
+
+def validate_item(row: dict, position: int):
+    # A line item dict from one uploaded or submitted row, checked against PurchaseOrderItem.
+    try:
+        return models.PurchaseOrderItem(**{field: row.get(field) for field in ITEM_FIELDS}).dict()
+    except ValidationError as e:
+        raise invalid_items("item {}: {}".format(position, "; ".join(
+            "{} {}".format(".".join(str(loc) for loc in error["loc"]), error["msg"]) for error in e.errors())))
+
+
+def check_item_count(count: int):
+    if count > constants.MAX_PURCHASE_ORDER_ITEMS:
+        raise invalid_items("more than {} items".format(constants.MAX_PURCHASE_ORDER_ITEMS))
+
+
+def items_from_form(item_number, item_quantity, item_price, item_url, item_details):
+    # Line items from the repeated form fields, skipping rows left completely empty.
+    items = []
+    for row in zip(item_number, item_quantity, item_price, item_url, item_details):
+        if not any(value.strip() for value in row):
+            continue
+        items.append(validate_item(dict(zip(ITEM_FIELDS, row)), len(items) + 1))
+        check_item_count(len(items))
+    return items
+
+
+def items_from_upload(upload):
+    # Line items from an uploaded CSV file (a header row naming the item fields, then one row per item) or JSON file
+    # (an array of item objects). The CSV is read row by row from the spooled upload, not loaded as a whole.
+    name = (upload.filename or "").lower()
+    upload.file.seek(0)
+    if name.endswith(".json") or upload.content_type == "application/json":
+        try:
+            rows = json.load(upload.file)
+        except ValueError as e:
+            raise invalid_items("not valid JSON ({})".format(e))
+        if not isinstance(rows, list):
+            raise invalid_items("the JSON file must contain an array of items")
+        check_item_count(len(rows))
+        return [validate_item(row if isinstance(row, dict) else {}, position)
+                for position, row in enumerate(rows, start=1)]
+
+    try:
+        reader = csv.DictReader(codecs.iterdecode(upload.file, "utf-8-sig"))
+        missing = set(ITEM_FIELDS) - set(reader.fieldnames or [])
+        if missing:
+            raise invalid_items("the CSV header is missing {}".format(", ".join(sorted(missing))))
+        items = []
+        for row in reader:
+            if not any(isinstance(value, str) and value.strip() for value in row.values()):
+                continue
+            items.append(validate_item(row, len(items) + 1))
+            check_item_count(len(items))
+        return items
+    except (UnicodeDecodeError, csv.Error) as e:
+        raise invalid_items("not a valid CSV file ({})".format(e))
+
+
+async def create_purchase_order(
+        user,
+        supervisor_id,
         supplier_name: str,
         supplier_contact: str,
         supplier_address: str,
-        item_number: List[str],
-        item_quantity: List[int],
-        item_price: List[float],
-        item_url: List[str],
-        item_details: List[str],
-        password: str
+        items: List[dict],
+        password: str,
+        idempotency_key: str = None
 ):
-    items = [
-        {
-            "item_number": num,
-            "item_quantity": qty,
-            "item_price": price,
-            "item_url": url,
-            "item_details": details,
-        }
-        for num, qty, price, url, details in zip(item_number, item_quantity, item_price, item_url, item_details)
-    ]
-
+    # Signs a new purchase order with the sender key, encrypts it to the sender and supervisor, timestamps its digest,
+    # stores it and emails it to the supervisor. Returns the new order's id and number. Retries with the same
+    # idempotency key return the first request's order.
+    if idempotency_key:
+        async def submit():
+            po_id, po_number = await create_purchase_order(
+                user, supervisor_id, supplier_name, supplier_contact, supplier_address, items, password)
+            return {"purchase_order_id": str(po_id), "purchase_order_number": po_number}
+
+        request_hash = idempotency.fingerprint(str(supervisor_id), supplier_name, supplier_contact, supplier_address,
+                                               items)
+        result = await idempotency.once(user['user_id'], idempotency_key, "submit", request_hash, submit)
+        return UUID(result["purchase_order_id"]), result["purchase_order_number"]
+
+    check_item_count(len(items))
     sender = await auth.get_user_by_id(user['user_id'])
     recipient = await auth.get_user_by_id(supervisor_id)
+    if recipient is None:
+        raise exceptions.API_404_NOT_FOUND_EXCEPTION
 
     purchase_order = {
         "supplier_name": supplier_name,
@@ -271,252 +633,294 @@ async def submit_purchase_order(
         "recipient_name": recipient_name,
         "purchase_order": purchase_order,
         "created_timestamp": time.isoformat(),
-        "readable_timestamp": time.strftime("%B %d, %Y, %H:%M")
+        "readable_timestamp": time.strftime("%B %d, %Y, %H:%M"),
+        # keeps the stored digest from revealing guessable order contents
+        "nonce": secrets.token_hex(16)
     }
 
-    recipient_public_key = PGPKey()
-    recipient_public_key.parse(recipient.public_key)
-
-    sender_public_key = PGPKey()
-    sender_public_key.parse(sender.public_key)
-
     private_key, salt = await get_private_key_and_salt(sender.user_id)
 
-    derived_key = await auth.get_derived_key(password, salt.encode('utf-8'))
-
-    sender_private_key = PGPKey()
-    sender_private_key.parse(private_key)
-    assert sender_private_key.is_unlocked is False
-
-    server_private_key, _ = pgpy.PGPKey.from_file(constants.SERVER_PRIVATE_KEY)
-    assert server_private_key.is_unlocked is False
+    po_id = uuid.uuid4()
+    email = format_purchase_order(data, "{}/purchase_orders/{}".format(constants.SERVER_ADDRESS, po_id))
+    content = json.dumps(data)
+    order_digest = timestamping.digest_of(content)
 
     try:
-        with sender_private_key.unlock(derived_key):
-            with server_private_key.unlock(constants.SERVER_PRIVATE_KEY_PW):
-                po_id = uuid.uuid4()
-
-                email_content = PGPMessage.new(
-                    format_purchase_order(data, "{}/purchase_orders/{}".format(constants.SERVER_ADDRESS, po_id)))
-                json_content = PGPMessage.new(json.dumps(data))
-
-                email_content |= server_private_key.sign(email_content)
-                json_content |= server_private_key.sign(json_content)
-
-                email_content |= sender_private_key.sign(email_content)
-                json_content |= sender_private_key.sign(json_content)
-
-                cipher = pgpy.constants.SymmetricKeyAlgorithm.AES256
-                sessionkey = cipher.gen_key()
-
-                encrypted_json = sender_public_key.encrypt(json_content, cipher=cipher, sessionkey=sessionkey)
-                encrypted_json = recipient_public_key.encrypt(encrypted_json, cipher=cipher, sessionkey=sessionkey)
-                # encrypted_json = purchaser_public_key.encrypt(decrypted_json)
+        encrypted_email, encrypted_json = await crypto.run(
+            crypto.submit_order, private_key, password, salt, [email, content],
+            [sender.public_key, recipient.public_key]
+        )
+    except PGPDecryptionError:
+        raise exceptions.API_403_WRONG_PASSWORD_EXCEPTION
+    # only orders signed with the right password are timestamped
+    batch_id, proof = await timestamping.stamp(order_digest)
+
+    query = tables.purchase_orders.insert().values(
+        purchase_order_id=po_id,
+        sender_id=sender.user_id,
+        recipient_id=recipient.user_id,
+        sender_name=sender_name,
+        recipient_name=recipient_name,
+        email_content=str(encrypted_email),
+        json_content=str(encrypted_json),
+        order_digest=order_digest,
+        timestamp_batch_id=batch_id,
+        timestamp_proof=proof,
+    )
+    await database.execute(query)
 
-                encrypted_email = sender_public_key.encrypt(email_content, cipher=cipher, sessionkey=sessionkey)
-                encrypted_email = recipient_public_key.encrypt(encrypted_email, cipher=cipher, sessionkey=sessionkey)
+    query = select([tables.purchase_orders.c.purchase_order_number]).where(
+        tables.purchase_orders.c.purchase_order_id == po_id
+    )
+    po_number = await database.execute(query)
 
-                del sessionkey
+    await send_email(
+        sender=sender_name,
+        body=str(encrypted_email),
+        recipient=recipient.email
+    )
 
-                query = tables.purchase_orders.insert().values(
-                    purchase_order_id=po_id,
-                    sender_id=sender.user_id,
-                    recipient_id=recipient.user_id,
-                    email_content=str(encrypted_email),
-                    json_content=str(encrypted_json),
-                )
-                await database.execute(query)
+    return po_id, po_number
 
-                query = select([tables.purchase_orders.c.purchase_order_number]).where(
-                    tables.purchase_orders.c.purchase_order_id == po_id
-                )
-                po_number = await database.execute(query)
 
-                await send_email(
-                    sender=sender_name,
-                    body=str(encrypted_email),
-                    recipient=recipient.email
-                )
-                del derived_key
-                del private_key
-
-                return templates.TemplateResponse("message.html", {
-                    "request": request,
-                    "user": user,
-                    "title": "Submit Success",
-                    "header": "Success",
-                    "message": "Purchase Order #{} Successfully Submitted".format(po_number)
-                })
+async def submit_purchase_order(
+        request: Request,
+        templates,
+        user: models.UserSys,
+        supervisor_id: str,
+        supplier_name: str,
+        supplier_contact: str,
+        supplier_address: str,
+        item_number: List[str],
+        item_quantity: List[str],
+        item_price: List[str],
+        item_url: List[str],
+        item_details: List[str],
+        password: str,
+        idempotency_key: str = None,
+        items_file=None
+):
+    # Submits the purchase order form. Line items come from the uploaded CSV or JSON file when one is attached, and
+    # from the repeated item fields otherwise.
+    try:
+        if items_file is not None and items_file.filename:
+            items = items_from_upload(items_file)
+        else:
+            items = items_from_form(item_number, item_quantity, item_price, item_url, item_details)
+        if not items:
+            raise invalid_items("the order has no items")
+        _, po_number = await create_purchase_order(
+            user, supervisor_id, supplier_name, supplier_contact, supplier_address, items, password, idempotency_key)
+    except HTTPException as e:
+        if e.status_code == exceptions.API_403_WRONG_PASSWORD_EXCEPTION.status_code:
+            return await message(request, user, templates, "Wrong Password", "Wrong Password")
+        return await message(request, user, templates, "Not Submitted", e.detail)
     except Exception as e:
-        return await message(request, user, templates, "Wrong Password", "Wrong Password")
         print(e)
+        return await message(request, user, templates, "Wrong Password", "Wrong Password")
 
-
-def prepare_items_with_index(items):
-    for index, item in enumerate(items, start=1):
-        item['index'] = index
-    return items
+    return templates.TemplateResponse("message.html", {
+        "request": request,
+        "user": user,
+        "title": "Submit Success",
+        "header": "Success",
+        "message": "Purchase Order #{} Successfully Submitted".format(po_number)
+    })
 
 
-async def view_purchase_order(request, templates, po_id, user, password: str):
-    po = await get_purchase_order(po_id)
+async def open_purchase_order(po, user, password: str):
+    # Decrypts a purchase order with the user's private key and checks which of the sender, server and supervisor
+    # signatures it carries. Returns the decrypted contents, the signature results and the order's attachments with
+    # download links. For timestamped orders the server's part is the inclusion of the order's digest, and of its
+    # review's, in batches with a valid server signature; older orders carry a server signature instead.
     sender = await auth.get_user_by_id(po.sender_id)
     supervisor = await auth.get_user_by_id(po.recipient_id)
 
     private_key, salt = await get_private_key_and_salt(user['user_id'])
-    derived_key = await auth.get_derived_key(password, salt.encode('utf-8'))
-    user_private_key = PGPKey()
-    user_private_key.parse(private_key)
+    retired = await get_retired_key(user['user_id'])
+    attachment_rows = await attachments.attachments_of(po.purchase_order_id)
+
+    try:
+        message, valid_sender_signature, valid_server_signature, valid_supervisor_signature, file_keys = \
+            await crypto.run(
+                crypto.open_order, private_key, password, salt, po.json_content, sender.public_key,
+                supervisor.public_key, retired, [row['wrapped_key'] for row in attachment_rows]
+            )
+    except PGPDecryptionError:
+        raise exceptions.API_403_WRONG_PASSWORD_EXCEPTION
+
+    content = json.loads(message)
+    timestamped = bool(po.timestamp_proof or po.review_proof)
+    if timestamped:
+        valid_server_signature = await verify_timestamps(po, timestamping.digest_of(message))
+
+    return {
+        "content": content,
+        "valid_sender_signature": valid_sender_signature,
+        "valid_server_signature": valid_server_signature,
+        "timestamped": timestamped,
+        "valid_supervisor_signature": valid_supervisor_signature,
+        "attachments": attachments.links(user['user_id'], attachment_rows, file_keys),
+    }
 
-    sender_public_key = PGPKey()
-    sender_public_key.parse(sender.public_key)
-    server_public_key, _ = pgpy.PGPKey.from_file(constants.SERVER_PUBLIC_KEY)
 
-    supervisor_public_key = PGPKey()
-    supervisor_public_key.parse(supervisor.public_key)
+async def verify_timestamps(po, content_digest: str):
+    # Whether the order's submission and review timestamps, whichever it has, match its decrypted contents.
+    checks = []
+    if po.timestamp_proof:
+        checks.append(content_digest == po.order_digest and
+                      await timestamping.verify(po.order_digest, po.timestamp_batch_id, po.timestamp_proof))
+    if po.review_proof:
+        digest = timestamping.review_digest(po.purchase_order_id, content_digest, po.status, po.purchaser_id,
+                                            po.reviewed_timestamp)
+        checks.append(digest == po.review_digest and
+                      await timestamping.verify(po.review_digest, po.review_batch_id, po.review_proof))
+    return all(checks)
+
+
+async def add_attachment(po, user, upload):
+    # Stores an uploaded file as an encrypted attachment of the order, readable by the order's current participants.
+    participants = [po.sender_id, po.recipient_id, po.purchaser_id]
+    if user['user_id'] not in participants:
+        raise exceptions.API_403_FORBIDDEN_EXCEPTION
+    recipients = [await get_public_key(user_id) for user_id in participants if user_id is not None]
+    return await attachments.store(upload, po, user['user_id'], recipients)
 
-    assert user_private_key.is_unlocked is False
+
+async def view_purchase_order(request, templates, po_id, user, password: str):
+    po = await get_purchase_order(po_id)
 
     try:
-        with user_private_key.unlock(derived_key):
-            encrypted_message = PGPMessage.from_blob(po.json_content)
+        opened = await open_purchase_order(po, user, password)
+    except Exception as e:
+        print(e)
+        return await message(request, user, templates, "Wrong Password", "Wrong Password")
 
-            decrypted_message = user_private_key.decrypt(encrypted_message)
+    content = opened['content']
+    timestamp = ""
 
-            content = json.loads(decrypted_message.message)
-            items = prepare_items_with_index(content['purchase_order']['items'])
-            timestamp = ""
+    if po.reviewed_timestamp is not None:
+        timestamp = po.reviewed_timestamp.strftime('%Y-%m-%d %H:%M:%S')
 
-            if po.reviewed_timestamp is not None:
-                timestamp = po.reviewed_timestamp.strftime('%Y-%m-%d %H:%M:%S')
+    purchasers = await get_users_by_role("Purchaser")
 
-            purchasers = await get_users_by_role("Purchaser")
+    return templates.TemplateResponse("purchase_order.html", {
+        "request": request,
+        "user": user,
+        "title": "Purchase Order {}".format(po.purchase_order_number),
+        "header": "Purchase Order {}".format(po.purchase_order_number),
+        "recipient_id": po.recipient_id,
+        "data": content,
+        "valid_sender_signature": opened['valid_sender_signature'],
+        "valid_server_signature": opened['valid_server_signature'],
+        "valid_supervisor_signature": opened['valid_supervisor_signature'],
+        "timestamped": opened['timestamped'],
+        "item_page_size": constants.ITEM_PAGE_SIZE,
+        "attachments": opened['attachments'],
+        "purchasers": purchasers,
+        "po_id": po_id,
+        "idempotency_key": uuid.uuid4(),
+        "status": po.status,
+        "reviewed_timestamp": timestamp
+    })
 
-            valid_sender_signature = False
-            valid_server_signature = False
-            valid_supervisor_signature = False
-            try:
-                valid_sender_signature = bool(sender_public_key.verify(decrypted_message))
-            except Exception as e:
-                pass
-            try:
-                valid_server_signature = bool(server_public_key.verify(decrypted_message))
-            except Exception as e:
-                pass
-            try:
-                valid_supervisor_signature = bool(supervisor_public_key.verify(decrypted_message))
-            except Exception as e:
-                pass
-
-            return templates.TemplateResponse("purchase_order.html", {
-                "request": request,
-                "user": user,
-                "title": "Purchase Order {}".format(po.purchase_order_number),
-                "header": "Purchase Order {}".format(po.purchase_order_number),
-                "recipient_id": po.recipient_id,
-                "data": content,
-                "valid_sender_signature": valid_sender_signature,
-                "valid_server_signature": valid_server_signature,
-                "valid_supervisor_signature": valid_supervisor_signature,
-                "items": items,
-                "purchasers": purchasers,
-                "po_id": po_id,
-                "status": po.status,
-                "reviewed_timestamp": timestamp
-            })
 
-    except Exception as e:
-        return await message(request, user, templates, "Wrong Password", "Wrong Password")
-        print(e)
+async def review(po, user, purchaser_id, password: str, accept: bool, idempotency_key: str = None):
+    # Re-signs a purchase order with the supervisor key, re-encrypts it to the supervisor, purchaser and sender, and
+    # records the decision with a timestamp of the decision and the reviewed contents. Accepted orders are assigned to
+    # the purchaser and emailed to them. Retries with the same idempotency key do nothing.
+    if idempotency_key:
+        async def review_once():
+            await review(po, user, purchaser_id, password, accept)
+            return {"purchase_order_id": str(po.purchase_order_id), "accept": accept}
 
+        request_hash = idempotency.fingerprint(str(po.purchase_order_id), str(purchaser_id), accept)
+        await idempotency.once(user['user_id'], idempotency_key, "review", request_hash, review_once)
+        return
 
-async def review_purchase_order(request, templates, po_id, user, purchaser_id, password, accept):
-    po = await get_purchase_order(po_id)
     purchaser = await auth.get_user_by_id(purchaser_id)
     sender = await auth.get_user_by_id(po.sender_id)
+    if purchaser is None:
+        raise exceptions.API_404_NOT_FOUND_EXCEPTION
 
     private_key, salt = await get_private_key_and_salt(user['user_id'])
-    derived_key = await auth.get_derived_key(password, salt.encode('utf-8'))
-    supervisor_private_key = PGPKey()
-    supervisor_private_key.parse(private_key)
-
-    supervisor_public_key = PGPKey()
-    supervisor_public_key.parse(user['public_key'])
-
-    purchaser_public_key = PGPKey()
-    purchaser_public_key.parse(purchaser.public_key)
+    retired = await get_retired_key(user['user_id'])
+    supervisor = await auth.get_user_by_id(user['user_id'])
+    attachment_rows = await attachments.attachments_of(po.purchase_order_id)
 
-    sender_public_key = PGPKey()
-    sender_public_key.parse(sender.public_key)
+    try:
+        (encrypted_json, encrypted_email), rewrapped, content = await crypto.run(
+            crypto.review_order, private_key, password, salt, [po.json_content, po.email_content],
+            [supervisor.public_key, purchaser.public_key, sender.public_key], retired,
+            [row['wrapped_key'] for row in attachment_rows]
+        )
+    except PGPDecryptionError:
+        raise exceptions.API_403_WRONG_PASSWORD_EXCEPTION
+
+    # attachment keys are re-wrapped so the purchaser can read them too
+    for row, wrapped_key in zip(attachment_rows, rewrapped):
+        if wrapped_key is None:
+            continue
+        await database.execute(tables.purchase_order_attachments.update().where(
+            tables.purchase_order_attachments.c.attachment_id == row['attachment_id']).where(
+            tables.purchase_order_attachments.c.wrapped_key == row['wrapped_key']).values(wrapped_key=wrapped_key))
 
-    server_private_key, _ = pgpy.PGPKey.from_file(constants.SERVER_PRIVATE_KEY)
-    assert server_private_key.is_unlocked is False
+    time = datetime.utcnow()
+    table = tables.purchase_orders_archive if po.archived else tables.purchase_orders
+    digest = timestamping.review_digest(po.purchase_order_id, timestamping.digest_of(content), accept,
+                                        purchaser.user_id if accept else po.purchaser_id, time)
+    batch_id, proof = await timestamping.stamp(digest)
+
+    if accept:
+        query = table.update().where(table.c.purchase_order_id == po.purchase_order_id).where(
+            table.c.sent_timestamp == po.sent_timestamp).values(
+            purchaser_id=purchaser.user_id,
+            purchaser_name="{} {}".format(purchaser.first_name, purchaser.last_name),
+            email_content=str(encrypted_email),
+            json_content=str(encrypted_json),
+            reviewed_timestamp=time,
+            status=accept,
+            review_digest=digest,
+            review_batch_id=batch_id,
+            review_proof=proof
+        )
+        await database.execute(query)
+
+        sender_name = "{} {}".format(user['first_name'], user['last_name'])
+        await send_email(
+            sender=sender_name,
+            body=str(encrypted_email),
+            recipient=purchaser.email
+        )
+    else:
+        query = table.update().where(table.c.purchase_order_id == po.purchase_order_id).where(
+            table.c.sent_timestamp == po.sent_timestamp).values(
+            email_content=str(encrypted_email),
+            json_content=str(encrypted_json),
+            reviewed_timestamp=time,
+            status=accept,
+            review_digest=digest,
+            review_batch_id=batch_id,
+            review_proof=proof
+        )
+        await database.execute(query)
+
+
+async def review_purchase_order(request, templates, po_id, user, purchaser_id, password, accept,
+                                idempotency_key: str = None):
+    po = await get_purchase_order(po_id)
 
     try:
-        with supervisor_private_key.unlock(derived_key):
-            with server_private_key.unlock(constants.SERVER_PRIVATE_KEY_PW):
-                json_content = PGPMessage.from_blob(po.json_content)
-                email_content = PGPMessage.from_blob(po.email_content)
-
-                decrypted_json = supervisor_private_key.decrypt(json_content)
-                decrypted_email = supervisor_private_key.decrypt(email_content)
-
-                json_content = PGPMessage.new(decrypted_json.message)
-                email_content = PGPMessage.new(decrypted_email.message)
-
-                json_content |= supervisor_private_key.sign(json_content)
-                email_content |= supervisor_private_key.sign(email_content)
-
-                json_content |= server_private_key.sign(json_content)
-                email_content |= server_private_key.sign(email_content)
-
-                cipher = pgpy.constants.SymmetricKeyAlgorithm.AES256
-                sessionkey = cipher.gen_key()
-
-                encrypted_json = supervisor_public_key.encrypt(json_content, cipher=cipher, sessionkey=sessionkey)
-                encrypted_json = purchaser_public_key.encrypt(encrypted_json, cipher=cipher, sessionkey=sessionkey)
-                encrypted_json = sender_public_key.encrypt(encrypted_json, cipher=cipher, sessionkey=sessionkey)
-
-                encrypted_email = supervisor_public_key.encrypt(email_content, cipher=cipher, sessionkey=sessionkey)
-                encrypted_email = purchaser_public_key.encrypt(encrypted_email, cipher=cipher, sessionkey=sessionkey)
-                encrypted_email = sender_public_key.encrypt(encrypted_email, cipher=cipher, sessionkey=sessionkey)
-
-                del sessionkey
-
-                time = datetime.utcnow()
-
-                if accept:
-                    query = tables.purchase_orders.update().where(
-                        tables.purchase_orders.c.purchase_order_id == po_id).values(
-                        purchaser_id=purchaser.user_id,
-                        email_content=str(encrypted_email),
-                        json_content=str(encrypted_json),
-                        reviewed_timestamp=time,
-                        status=accept
-                    )
-                    await database.execute(query)
-
-                    sender_name = "{} {}".format(user['first_name'], user['last_name'])
-                    await send_email(
-                        sender=sender_name,
-                        body=str(encrypted_email),
-                        recipient=purchaser.email
-                    )
-                else:
-                    query = tables.purchase_orders.update().where(
-                        tables.purchase_orders.c.purchase_order_id == po_id).values(
-                        email_content=str(encrypted_email),
-                        json_content=str(encrypted_json),
-                        reviewed_timestamp=time,
-                        status=accept
-                    )
-                    await database.execute(query)
-
-                return RedirectResponse(url="/purchase_orders", status_code=301)
-
+        await review(po, user, purchaser_id, password, accept, idempotency_key)
+    except HTTPException as e:
+        if e.status_code == exceptions.API_403_WRONG_PASSWORD_EXCEPTION.status_code:
+            return await message(request, user, templates, "Wrong Password", "Wrong Password")
+        return await message(request, user, templates, "Not Reviewed", e.detail)
     except Exception as e:
-        return await message(request, user, templates, "Wrong Password", "Wrong Password")
         print(e)
+        return await message(request, user, templates, "Wrong Password", "Wrong Password")
+
+    return RedirectResponse(url="/purchase_orders", status_code=301)
 
 
 async def message(request, user, templates, header, message):
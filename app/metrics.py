@@ -0,0 +1,112 @@
+import bisect
+import threading
+
+# In-process metrics in the Prometheus text format, served at /metrics. Each worker process keeps its own values;
+# scrape every worker, or run a single worker, to see the whole picture.
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+registry = []
+
+
+def _labels(names, values):
+    if not names:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(n, str(v).replace('"', '\\"')) for n, v in zip(names, values)) + "}"
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name: str, description: str, labels=()):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def key(self, labels):
+        return tuple(labels.get(name, "") for name in self.label_names)
+
+    def samples(self):
+        with self.lock:
+            return [(self.name, key, value) for key, value in self.values.items()]
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.description), "# TYPE {} {}".format(self.name, self.kind)]
+        for name, key, value in self.samples():
+            lines.append("{}{} {}".format(name, _labels(self.label_names, key), value))
+        return lines
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, description: str, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, description, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            state = self.values.get(key)
+            if state is None:
+                state = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][bisect.bisect_left(self.buckets, value)] += 1
+            state[1] += value
+            state[2] += 1
+
+    def snapshot(self, **labels):
+        # Returns (bucket counts, sum, count) for one label set.
+        with self.lock:
+            state = self.values.get(self.key(labels))
+            if state is None:
+                return [0] * (len(self.buckets) + 1), 0.0, 0
+            return list(state[0]), state[1], state[2]
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.description), "# TYPE {} histogram".format(self.name)]
+        with self.lock:
+            items = [(key, list(state[0]), state[1], state[2]) for key, state in self.values.items()]
+        for key, counts, total, count in items:
+            cumulative = 0
+            for bound, bucket in zip(self.buckets + ("+Inf",), counts):
+                cumulative += bucket
+                lines.append("{}_bucket{} {}".format(
+                    self.name, _labels(self.label_names + ("le",), key + (bound,)), cumulative))
+            lines.append("{}_sum{} {}".format(self.name, _labels(self.label_names, key), total))
+            lines.append("{}_count{} {}".format(self.name, _labels(self.label_names, key), count))
+        return lines
+
+
+def render():
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
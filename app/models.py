@@ -19,6 +19,11 @@ class Token(BaseModel):
 
 class TokenData(BaseModel):
     email: Optional[str] = None
+    user_id: Optional[UUID] = None
+    role: Optional[str] = None
+    version: int = 0
+    first_name: Optional[str] = None
+    last_name: Optional[str] = None
 
 
 # Users
@@ -40,7 +45,104 @@ class UserAuthIn(User):
     password: str
 
 
+class UserOut(User):
+    user_id: UUID
+    role: str
+
+
+class PublicKeyOut(BaseModel):
+    user_id: UUID
+    public_key: str
+
+
 class EmailSchema(BaseModel):
     email: List[EmailStr]
     body: str
-    subject: str
\ No newline at end of file
+    subject: str
+
+
+# Purchase Orders
+class PurchaseOrderStatus(str, enum.Enum):
+    pending = "pending"
+    accepted = "accepted"
+    rejected = "rejected"
+
+
+class PurchaseOrderFilter(BaseModel):
+    number_from: Optional[int] = None
+    number_to: Optional[int] = None
+    sent_from: Optional[datetime.date] = None
+    sent_to: Optional[datetime.date] = None
+    reviewed_from: Optional[datetime.date] = None
+    reviewed_to: Optional[datetime.date] = None
+    status: Optional[PurchaseOrderStatus] = None
+    participant_id: Optional[UUID] = None
+
+
+class PurchaseOrderItem(BaseModel):
+    item_number: str
+    item_quantity: int
+    item_price: float
+    item_url: str
+    item_details: str
+
+
+class PurchaseOrderIn(BaseModel):
+    supervisor_id: UUID
+    supplier_name: str
+    supplier_contact: str
+    supplier_address: str
+    items: List[PurchaseOrderItem]
+    password: str
+
+
+class PasswordIn(BaseModel):
+    password: str
+
+
+class ReviewIn(BaseModel):
+    purchaser_id: UUID
+    accept: bool
+    password: str
+
+
+class PurchaseOrderSummary(BaseModel):
+    purchase_order_id: UUID
+    purchase_order_number: int
+    sender_id: UUID
+    recipient_id: UUID
+    purchaser_id: Optional[UUID] = None
+    sender_name: Optional[str] = None
+    recipient_name: Optional[str] = None
+    purchaser_name: Optional[str] = None
+    sent_timestamp: Optional[datetime.datetime] = None
+    reviewed_timestamp: Optional[datetime.datetime] = None
+    status: PurchaseOrderStatus
+
+
+class PurchaseOrderPage(BaseModel):
+    items: List[PurchaseOrderSummary]
+    next_before: Optional[int] = None
+
+
+class AttachmentOut(BaseModel):
+    attachment_id: UUID
+    file_name: str
+    content_type: str
+    size: int
+    sha256: str
+    url: Optional[str] = None
+
+
+class PurchaseOrderDetail(PurchaseOrderSummary):
+    content: Dict[str, Any]
+    valid_sender_signature: bool
+    valid_server_signature: bool
+    valid_supervisor_signature: bool
+    # valid_server_signature checks batched timestamps instead of a server signature
+    timestamped: bool = False
+    attachments: List[AttachmentOut] = []
+
+
+class Error(BaseModel):
+    detail: str
@@ -0,0 +1,84 @@
+import os
+import re
+import time
+
+from datetime import datetime
+
+import constants
+
+try:
+    from pyinstrument import Profiler
+    from pyinstrument.renderers import SpeedscopeRenderer
+except ImportError:
+    Profiler = None
+
+# On-demand profiling of single requests. An administrator adds `X-Profile: html` (or `speedscope`) to a request, or
+# `profile=html` to its query string, and log_requests runs a sampling profiler around just that request. The report
+# is written to PROFILE_ROOT and listed at /profiles. Requests without the flag only pay for the header and query
+# lookups in `requested`.
+#
+# The profiler samples the event loop thread. The PGP work and private key derivation of purchase orders run in the
+# crypto process pool (crypto.run), so their time shows up as the await on it; the worker processes are not sampled.
+
+FORMATS = {
+    "html": "html",
+    "speedscope": "speedscope.json",
+}
+
+# report names are generated here; anything else requested from /profiles is rejected
+REPORT_NAME = re.compile(r"^[0-9]{8}T[0-9]{6}-[A-Z0-9]{6}-[a-z0-9_]+\.(html|speedscope\.json)$")
+
+
+def requested(request):
+    # Returns the report format asked for by the request, or None.
+    flag = request.headers.get("x-profile") or request.query_params.get("profile")
+    if flag is None:
+        return None
+    return flag if flag in FORMATS else "html"
+
+
+def available():
+    return Profiler is not None
+
+
+def start():
+    profiler = Profiler(interval=constants.PROFILE_INTERVAL, async_mode="enabled")
+    profiler.start()
+    return profiler
+
+
+def save(profiler, report_format: str, rid: str, path: str):
+    # Stops the profiler and writes its report, returning the report name.
+    profiler.stop()
+    slug = re.sub(r"[^a-z0-9]+", "_", path.lower()).strip("_")[:60] or "root"
+    name = "{}-{}-{}.{}".format(time.strftime("%Y%m%dT%H%M%S", time.gmtime()), rid, slug, FORMATS[report_format])
+
+    if report_format == "speedscope":
+        report = profiler.output(renderer=SpeedscopeRenderer())
+    else:
+        report = profiler.output_html()
+
+    os.makedirs(constants.PROFILE_ROOT, exist_ok=True)
+    with open(os.path.join(constants.PROFILE_ROOT, name), "w") as file:
+        file.write(report)
+    return name
+
+
+def reports():
+    # Lists stored reports, newest first.
+    if not os.path.isdir(constants.PROFILE_ROOT):
+        return []
+    listing = []
+    for name in os.listdir(constants.PROFILE_ROOT):
+        if REPORT_NAME.match(name):
+            stat = os.stat(os.path.join(constants.PROFILE_ROOT, name))
+            listing.append({"name": name, "size": stat.st_size, "created": datetime.utcfromtimestamp(stat.st_mtime)})
+    return sorted(listing, key=lambda report: report["name"], reverse=True)
+
+
+def report_path(name: str):
+    # Returns the path of a stored report, or None if the name is not one of ours.
+    if not REPORT_NAME.match(name):
+        return None
+    path = os.path.join(constants.PROFILE_ROOT, name)
+    return path if os.path.isfile(path) else None
@@ -0,0 +1,248 @@
+import asyncio
+import time
+
+from concurrent.futures import ProcessPoolExecutor
+from pgpy.constants import HashAlgorithm, SymmetricKeyAlgorithm
+from sqlalchemy import true, false, union_all, or_
+from sqlalchemy.sql import select
+
+import auth
+import crypto
+import kdf
+import methods
+import tables
+
+from database import database
+
+# Re-encryption of stored purchase orders when a user's key is replaced, or re-signing them after the server key was
+# rotated. Orders are only encrypted to their participants, so the pipeline needs the password of one participant.
+#
+# Rotating a user's key first swaps in a new key and keeps the old one in key_rotations, protected as before; from
+# then on new orders use the new key, and opening or reviewing an order not yet re-encrypted falls back to the old one.
+# The user's orders (current and archived) are then streamed in purchase order number order, decrypted with the old
+# key and re-encrypted to the participants' current keys in a process pool, keeping their signatures. Each batch is
+# written back in its own short transaction, and only if the row has not changed since it was read, so live reviews
+# are never blocked or overwritten. The last finished order number is checkpointed, so an interrupted run resumes
+# where it stopped; once every order is done the old key is deleted.
+#
+# With keep_key the user's key is kept and orders are only re-signed by the current server key (resign_server).
+# Finally the wrapped file keys of the orders' attachments are re-encrypted the same way; this pass is not
+# checkpointed, but keys already re-encrypted are skipped when it runs again.
+#
+# Before a batch is written, one of its re-encrypted messages is opened with the user's current key; if that fails
+# the run stops without writing, so the old key (still in key_rotations) can read every order.
+
+
+def participating(table, user_id, after: int, limit: int, archived: bool):
+    po = table.c
+    return select([
+        po.purchase_order_id, po.purchase_order_number, po.sent_timestamp, po.sender_id, po.recipient_id,
+        po.purchaser_id, po.email_content, po.json_content, (true() if archived else false()).label('archived')
+    ]).where(
+        or_(po.sender_id == user_id, po.recipient_id == user_id, po.purchaser_id == user_id)
+    ).where(po.purchase_order_number > after).order_by(po.purchase_order_number).limit(limit)
+
+
+async def next_orders(user_id, after: int, limit: int):
+    # The next `limit` orders of the user after order number `after`, from both the live and the archive table.
+    query = union_all(
+        participating(tables.purchase_orders, user_id, after, limit, False),
+        participating(tables.purchase_orders_archive, user_id, after, limit, True),
+    ).order_by('purchase_order_number').limit(limit)
+    return await database.fetch_all(query)
+
+
+def attachments_participating(table, user_id, after, limit: int):
+    a = tables.purchase_order_attachments.c
+    po = table.c
+    query = select([a.attachment_id, a.wrapped_key, po.sender_id, po.recipient_id, po.purchaser_id]).select_from(
+        tables.purchase_order_attachments.join(table, a.purchase_order_id == po.purchase_order_id)
+    ).where(or_(po.sender_id == user_id, po.recipient_id == user_id, po.purchaser_id == user_id))
+    if after is not None:
+        query = query.where(a.attachment_id > after)
+    return query.order_by(a.attachment_id).limit(limit)
+
+
+async def next_attachments(user_id, after, limit: int):
+    # The next `limit` attachments, by id, of the user's current and archived orders.
+    query = union_all(
+        attachments_participating(tables.purchase_orders, user_id, after, limit),
+        attachments_participating(tables.purchase_orders_archive, user_id, after, limit),
+    ).order_by('attachment_id').limit(limit)
+    return await database.fetch_all(query)
+
+
+async def reseal_attachments(pool, user_id, retired_key: str, passphrase, keys: dict, batch_size: int, current_key,
+                             password: str):
+    # Re-encrypts the wrapped file keys of the user's attachments to the participants' current keys. Returns the
+    # number of keys written.
+    loop = asyncio.get_running_loop()
+    after = None
+    written = 0
+    while True:
+        rows = await next_attachments(user_id, after, batch_size)
+        if not rows:
+            return written
+        await public_keys(rows, keys)
+        resealed, _ = await loop.run_in_executor(pool, crypto.reseal_orders, retired_key, passphrase, [
+            (row['attachment_id'], [row['wrapped_key']], recipients_of(row, keys)) for row in rows
+        ], False)
+        await check_readable(pool, current_key, password, resealed)
+        by_id = {row['attachment_id']: row for row in rows}
+        for attachment_id, sealed in resealed:
+            if sealed is None:
+                continue
+            attachments = tables.purchase_order_attachments
+            query = attachments.update().where(attachments.c.attachment_id == attachment_id).where(
+                attachments.c.wrapped_key == by_id[attachment_id]['wrapped_key']).values(
+                wrapped_key=sealed[0]).returning(attachments.c.attachment_id)
+            if await database.fetch_val(query) is not None:
+                written += 1
+        after = rows[-1]['attachment_id']
+
+
+async def check_readable(pool, current_key, password: str, resealed):
+    # Opens the first re-encrypted message of a batch with the user's current key, raising if it cannot be read.
+    sample = next((sealed[-1] for _, sealed in resealed if sealed is not None), None)
+    if sample is None:
+        return
+    private_key, salt = current_key
+    opened, _ = await asyncio.get_running_loop().run_in_executor(pool, crypto.can_open, private_key, password, salt,
+                                                                 sample)
+    if not opened:
+        raise RuntimeError("re-encrypted messages do not open with the current key; stopped before writing them")
+
+
+async def public_keys(rows, cache: dict):
+    # Current public keys of every participant of the rows, cached across batches.
+    missing = {row[column] for row in rows for column in ('sender_id', 'recipient_id', 'purchaser_id')
+               if row[column] is not None and row[column] not in cache}
+    if missing:
+        query = select([tables.users.c.user_id, tables.users.c.public_key]).where(tables.users.c.user_id.in_(missing))
+        for user in await database.fetch_all(query):
+            cache[user['user_id']] = user['public_key']
+    return cache
+
+
+def recipients_of(row, keys: dict):
+    participants = [row['sender_id'], row['recipient_id'], row['purchaser_id']]
+    return [keys[user_id] for user_id in participants if user_id is not None and user_id in keys]
+
+
+async def write_back(rows, resealed):
+    # Stores the re-encrypted messages of one batch in one transaction. Rows changed since they were read (e.g.
+    # reviewed meanwhile, which re-encrypts them to the current keys anyway) are left alone. Returns the rows written.
+    by_id = {row['purchase_order_id']: row for row in rows}
+    written = 0
+    async with database.transaction():
+        for po_id, sealed in resealed:
+            if sealed is None:
+                continue
+            row = by_id[po_id]
+            table = tables.purchase_orders_archive if row['archived'] else tables.purchase_orders
+            email_content, json_content = sealed
+            query = table.update().where(table.c.purchase_order_id == po_id).where(
+                table.c.sent_timestamp == row['sent_timestamp']).where(
+                table.c.email_content == row['email_content']).where(
+                table.c.json_content == row['json_content']).values(
+                email_content=email_content,
+                json_content=json_content
+            ).returning(table.c.purchase_order_id)
+            if await database.fetch_val(query) is not None:
+                written += 1
+    return written
+
+
+async def start(user, password: str, profile: str, keep_key: bool, resign_server: bool):
+    # Records the rotation and, unless keep_key, swaps in a new key for the user. Returns the key_rotations row.
+    private_key, salt = await methods.get_private_key_and_salt(user.user_id)
+    new_key = None
+    if not keep_key:
+        print("Generating a new {} key for {}".format(profile, user.email), flush=True)
+        new_key = await asyncio.get_running_loop().run_in_executor(
+            None, crypto.generate_key, "{} {}".format(user.first_name, user.last_name), user.email, profile)
+        new_salt = kdf.new_salt()
+        new_key.protect(kdf.derive_key(password, new_salt), SymmetricKeyAlgorithm.AES256, HashAlgorithm.SHA256)
+
+    async with database.transaction():
+        await database.execute(tables.key_rotations.insert().values(
+            user_id=user.user_id,
+            retired_public_key=user.public_key,
+            retired_private_key=private_key,
+            retired_salt=salt,
+            resign_server=resign_server,
+            checkpoint=0
+        ))
+        if new_key is not None:
+            await database.execute(tables.users.update().where(tables.users.c.user_id == user.user_id).values(
+                public_key=str(new_key.pubkey)
+            ))
+            await database.execute(tables.private_keys.update().where(
+                tables.private_keys.c.user_id == user.user_id).values(private_key=str(new_key), salt=new_salt))
+    return await rotation_of(user.user_id)
+
+
+async def rotation_of(user_id):
+    query = select([tables.key_rotations]).where(tables.key_rotations.c.user_id == user_id)
+    return await database.fetch_one(query)
+
+
+async def rotate(email: str, password: str, profile: str, keep_key: bool, resign_server: bool, workers: int,
+                 batch_size: int):
+    user = await auth.get_user_by_email(email)
+    if user is None or not auth.verify_password(password, user.password):
+        print("Unknown user or wrong password")
+        return
+
+    rotation = await rotation_of(user.user_id)
+    if rotation is None:
+        rotation = await start(user, password, profile, keep_key, resign_server)
+    else:
+        print("Resuming the rotation started {} after order {}".format(rotation['started_timestamp'],
+                                                                       rotation['checkpoint']), flush=True)
+
+    retired_key = rotation['retired_private_key']
+    passphrase = kdf.derive_key(password, rotation['retired_salt'])
+    checkpoint = rotation['checkpoint']
+    current_key = await methods.get_private_key_and_salt(user.user_id)
+    keys = {}
+    window = workers * 2
+    done = written = 0
+    begin = time.perf_counter()
+
+    loop = asyncio.get_running_loop()
+    with ProcessPoolExecutor(workers) as pool:
+        while True:
+            rows = await next_orders(user.user_id, checkpoint, batch_size * window)
+            if not rows:
+                break
+            await public_keys(rows, keys)
+            batches = [rows[i:i + batch_size] for i in range(0, len(rows), batch_size)]
+            results = await asyncio.gather(*(
+                loop.run_in_executor(pool, crypto.reseal_orders, retired_key, passphrase, [
+                    (row['purchase_order_id'], [row['email_content'], row['json_content']], recipients_of(row, keys))
+                    for row in batch
+                ], rotation['resign_server'])
+                for batch in batches
+            ))
+            for resealed, _ in results:
+                await check_readable(pool, current_key, password, resealed)
+            for batch, (resealed, _) in zip(batches, results):
+                written += await write_back(batch, resealed)
+
+            checkpoint = rows[-1]['purchase_order_number']
+            await database.execute(tables.key_rotations.update().where(
+                tables.key_rotations.c.user_id == user.user_id).values(checkpoint=checkpoint))
+            done += len(rows)
+            elapsed = time.perf_counter() - begin
+            print("orders: {} read, {} re-encrypted, up to #{}, {:.1f}s, {:.0f} orders/s".format(
+                done, written, checkpoint, elapsed, done / elapsed if elapsed else 0), flush=True)
+
+        if not keep_key:
+            count = await reseal_attachments(pool, user.user_id, retired_key, passphrase, keys, batch_size,
+                                             current_key, password)
+            print("attachments: {} keys re-encrypted".format(count), flush=True)
+
+    await database.execute(tables.key_rotations.delete().where(tables.key_rotations.c.user_id == user.user_id))
+    print("Re-encrypted {} of {} orders; orders already re-encrypted or changed meanwhile were skipped".format(
+        written, done))
@@ -1,34 +1,48 @@
 import uuid
 from uuid import UUID
 
-from fastapi import FastAPI, Depends, status, Request, UploadFile, BackgroundTasks, Form, Response, HTTPException
+from fastapi import FastAPI, Depends, status, Request, UploadFile, BackgroundTasks, Form, Response, HTTPException, \
+    Header, File
 from fastapi.templating import Jinja2Templates
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import HTMLResponse, RedirectResponse, StreamingResponse, PlainTextResponse
+from fastapi.responses import HTMLResponse, RedirectResponse, StreamingResponse, PlainTextResponse, JSONResponse, \
+    FileResponse
 from fastapi.security import OAuth2PasswordRequestForm
-from typing import List
+from typing import List, Optional
 
 import time
+import asyncio
 import logging
 import random
 import string
 import helper
 
+import api
 import models
+import metrics
+import profiling
+import tracing
+import admission
 import database
 import methods
 import auth
+import crypto
+import events
+import attachments
 import constants
 
 
-async def not_found(request: Request, user: models.User = Depends(auth.get_current_user)):
+async def not_found(request: Request, exc):
+    if request.url.path.startswith("/api/"):
+        return JSONResponse({"detail": getattr(exc, "detail", "Not Found")}, status_code=status.HTTP_404_NOT_FOUND)
+    user = await auth.get_current_user(request)
     return templates.TemplateResponse("message.html", {
         "request": request,
         "user": user,
         "title": "Not Found",
         "header": "404",
         "message": "Not Found"
-    })
+    }, status_code=status.HTTP_404_NOT_FOUND)
 
 
 exceptions_handler = {
@@ -36,12 +50,50 @@ exceptions_handler = {
 }
 
 app = FastAPI(exception_handlers=exceptions_handler)
+app.include_router(api.router)
 
 # Configure logging to file 'info.log' with INFO level.
 logging.basicConfig(filename='log.log', level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
+@app.middleware('http')
+async def admission_control(request: Request, call_next):
+    # Middleware to limit concurrent requests to CPU-heavy routes. Requests over capacity are rejected with 503 and
+    # Retry-After rather than queueing without bound.
+    limiter = admission.limiter_for(request.method, request.url.path)
+    if limiter is None:
+        return await call_next(request)
+
+    if not await limiter.acquire():
+        return PlainTextResponse("Server Busy", status_code=status.HTTP_503_SERVICE_UNAVAILABLE, headers={
+            "Retry-After": str(constants.RETRY_AFTER_SECONDS)
+        })
+    try:
+        return await call_next(request)
+    finally:
+        limiter.release()
+
+
+@app.middleware('http')
+async def read_routing(request: Request, call_next):
+    # Middleware to keep a session's reads on the primary database for READ_YOUR_WRITES_SECONDS after it wrote, see
+    # database.ReadRouter.
+    if database.reads.replica is None:
+        return await call_next(request)
+    pinned_until = request.cookies.get("read_primary_until", "")
+    token = database.begin_session(pinned_until.isdigit() and int(pinned_until) > time.time())
+    try:
+        response = await call_next(request)
+    finally:
+        session = database.end_session(token)
+    if session.wrote:
+        until = int(time.time() + constants.READ_YOUR_WRITES_SECONDS)
+        response.set_cookie("read_primary_until", str(until), max_age=int(constants.READ_YOUR_WRITES_SECONDS),
+                            httponly=True, samesite="lax")
+    return response
+
+
 @app.middleware('http')
 async def log_requests(request: Request, call_next):
     # Middleware to log HTTP requests. Generates a unique ID for each request and logs the request path and
@@ -49,27 +101,70 @@ async def log_requests(request: Request, call_next):
     idem = ''.join(random.choices(string.ascii_uppercase + string.digits, k=6))
     logger.info(f"rid={idem} start request path={request.url.path}")
     start_time = time.time()
-    response = await call_next(request)
+    profile = profiling.requested(request)
+    trace = "x-trace" in request.headers
+    if profile or trace:
+        user = await auth.get_current_user(request)
+        if not (user and user['role'] == "Admin"):
+            profile = trace = False
+        elif not profiling.available():
+            profile = None
+    trace = tracing.sampled(trace) and tracing.start(idem, "{} {}".format(request.method, request.url.path))
+    try:
+        with tracing.span("request", path=request.url.path):
+            response = await handle(request, call_next, idem, profile)
+    finally:
+        if trace:
+            logger.info(f"rid={idem} trace={tracing.finish(trace)}")
     process_time = (time.time() - start_time) * 1000
     formatted_process_time = '{0:.2f}'.format(process_time)
     logger.info(f"rid={idem} completed_in={formatted_process_time}ms status_code={response.status_code}")
     return response
 
 
+async def handle(request: Request, call_next, idem: str, profile):
+    # Calls the route, under the profiler when the request asked for a profile.
+    if profile:
+        profiler = profiling.start()
+        try:
+            response = await call_next(request)
+        finally:
+            report = profiling.save(profiler, profile, idem, request.url.path)
+        response.headers["X-Profile-Report"] = "/profiles/{}".format(report)
+        logger.info(f"rid={idem} profile={report}")
+        return response
+    return await call_next(request)
+
+
 @app.on_event("startup")
 async def startup():
-    # Startup event handler to connect to the database when the application starts.
+    # Startup event handler to connect to the database and apply pending migrations when the application starts.
     await database.database.connect()
+    await database.reads.connect()
+    await helper.run_migrations()
+    await helper.ensure_purchase_order_partitions()
+    await auth.revocations.refresh()
+    app.state.revocation_refresh = asyncio.create_task(auth.revocations.run())
+    app.state.event_listener = asyncio.create_task(events.hub.run())
+    app.state.replica_lag_check = None
+    if database.reads.replica is not None:
+        app.state.replica_lag_check = asyncio.create_task(database.reads.run())
 
 
 @app.on_event("shutdown")
 async def shutdown():
     # Shutdown event handler to disconnect from the database when the application stops.
+    app.state.revocation_refresh.cancel()
+    app.state.event_listener.cancel()
+    if app.state.replica_lag_check is not None:
+        app.state.replica_lag_check.cancel()
+    crypto.shutdown()
+    await database.reads.disconnect()
     await database.database.disconnect()
 
 
 app.mount("/static", StaticFiles(directory="{}static".format(constants.APP_ROOT)), name="static")
-templates = Jinja2Templates(directory="{}templates".format(constants.APP_ROOT))
+templates = tracing.TracedTemplates(directory="{}templates".format(constants.APP_ROOT))
 
 
 def format_datetime(value, format='%Y-%m-%d %H:%M:%S'):
@@ -85,9 +180,80 @@ templates.env.filters['format_datetime'] = format_datetime
 # Util --
 
 @app.get("/reset_database")
-async def reset_database():
-    # await methods.send_email()
-    await helper.reset_database()
+async def reset_database(request: Request, user: models.User = Depends(auth.get_current_user)):
+    if user and user['role'] == "Admin":
+        await helper.reset_database()
+        return await methods.message(request, user, templates, "Database Reset",
+                                     "The database has been reset to the seed data.")
+    else:
+        return await methods.message(request, user, templates, "Not Authorized",
+                                     "Only administrators can reset the database.")
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    return metrics.render()
+
+
+@app.get("/events")
+async def purchase_order_events(request: Request, user: models.User = Depends(auth.get_current_user)):
+    # Server-sent events about the user's purchase orders, see events.py.
+    if not user:
+        return PlainTextResponse("Not Authorized", status_code=status.HTTP_401_UNAUTHORIZED)
+    subscriber = events.hub.subscribe(user)
+    if subscriber is None:
+        return PlainTextResponse("Server Busy", status_code=status.HTTP_503_SERVICE_UNAVAILABLE, headers={
+            "Retry-After": str(constants.RETRY_AFTER_SECONDS)
+        })
+    return StreamingResponse(events.stream(request, subscriber), media_type="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no"
+    })
+
+
+@app.get("/slow_queries", response_class=HTMLResponse)
+async def slow_queries(request: Request, user: models.User = Depends(auth.get_current_user)):
+    if user and user['role'] == "Admin":
+        return templates.TemplateResponse("slow_queries.html", {
+            "request": request,
+            "user": user,
+            "title": "Slow Queries",
+            "threshold": constants.SLOW_QUERY_MS,
+            "statements": database.database.statement_stats(),
+            "slow_queries": list(database.database.slow_queries)
+        })
+    else:
+        return await methods.message(request, user, templates, "Not Authorized",
+                                     "Only administrators can view slow queries.")
+
+
+@app.get("/profiles", response_class=HTMLResponse)
+async def profiles(request: Request, user: models.User = Depends(auth.get_current_user)):
+    if user and user['role'] == "Admin":
+        return templates.TemplateResponse("profiles.html", {
+            "request": request,
+            "user": user,
+            "title": "Profiles",
+            "available": profiling.available(),
+            "reports": profiling.reports()
+        })
+    else:
+        return await methods.message(request, user, templates, "Not Authorized",
+                                     "Only administrators can view profiles.")
+
+
+@app.get("/profiles/{name}")
+async def profile_report(request: Request, name: str, user: models.User = Depends(auth.get_current_user)):
+    if user and user['role'] == "Admin":
+        path = profiling.report_path(name)
+        if path is None:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND)
+        if name.endswith(".html"):
+            return FileResponse(path, media_type="text/html")
+        return FileResponse(path, media_type="application/json", filename=name)
+    else:
+        return await methods.message(request, user, templates, "Not Authorized",
+                                     "Only administrators can view profiles.")
 
 
 # Auth --
@@ -122,7 +288,8 @@ async def logout(request: Request, ):
 
 @app.get("/", response_class=HTMLResponse)
 async def homepage(request: Request, user: models.User = Depends(auth.get_current_user)):
-    return templates.TemplateResponse("index.html", {"request": request, "user": user})
+    counters = await methods.get_purchase_order_counters(user['user_id']) if user else None
+    return templates.TemplateResponse("index.html", {"request": request, "user": user, "counters": counters})
 
 
 @app.get("/users", response_class=HTMLResponse)
@@ -146,7 +313,9 @@ async def create_user(request: Request, user: models.User = Depends(auth.get_cur
         return templates.TemplateResponse("create_user.html", {
             "request": request,
             "user": user,
-            "title": "Create User"
+            "title": "Create User",
+            "key_profiles": list(crypto.KEY_PROFILES),
+            "default_key_profile": constants.KEY_PROFILE
         })
     else:
         return await methods.message(request, user, templates, "Not Authenticated", "Please login first.")
@@ -160,14 +329,16 @@ async def create_user(
         first_name: str = Form(...),
         last_name: str = Form(...),
         email: str = Form(...),
-        password: str = Form(...)
+        password: str = Form(...),
+        key_profile: str = Form(None)
 ):
     await methods.create_user(
         first_name,
         last_name,
         role,
         email,
-        password
+        password,
+        key_profile
     )
     success_message = "User successfully created."
 
@@ -260,6 +431,65 @@ async def purchase_orders(request: Request, user: models.User = Depends(auth.get
         return await methods.message(request, user, templates, "Not Authenticated", "Please login first.")
 
 
+@app.get("/purchase_orders/search", response_class=HTMLResponse)
+async def search_purchase_orders(
+        request: Request,
+        user: models.User = Depends(auth.get_current_user),
+        filters: models.PurchaseOrderFilter = Depends(methods.parse_purchase_order_filter),
+        before: Optional[int] = None,
+        limit: int = 50
+):
+    if user:
+        pos, next_before = await methods.search_purchase_orders(user, filters, before, limit)
+        next_url = None
+        if next_before is not None:
+            next_url = str(request.url.include_query_params(before=next_before))
+
+        return templates.TemplateResponse("purchase_orders.html", {
+            "request": request,
+            "user": user,
+            "title": "Search Purchase Orders",
+            "purchase_orders": pos,
+            "filters": filters,
+            "participants": await methods.get_users(),
+            "next_url": next_url
+        })
+    else:
+        return await methods.message(request, user, templates, "Not Authenticated", "Please login first.")
+
+
+@app.get("/purchase_orders/export")
+async def export_purchase_orders(
+        request: Request,
+        user: models.User = Depends(auth.get_current_user),
+        filters: models.PurchaseOrderFilter = Depends(methods.parse_purchase_order_filter),
+        format: str = "csv"
+):
+    if user and user['role'] == "Admin":
+        return await methods.export_purchase_orders(user, filters, format)
+    else:
+        return await methods.message(request, user, templates, "Not Authorized",
+                                     "Only administrators can export purchase orders.")
+
+
+@app.get("/purchase_orders/archive")
+async def archive_purchase_orders(
+        request: Request,
+        user: models.User = Depends(auth.get_current_user),
+        user_id: Optional[UUID] = None
+):
+    if user:
+        if user_id is None or str(user_id) == str(user['user_id']):
+            return await methods.archive_purchase_orders(user['user_id'])
+        elif user['role'] == "Admin":
+            return await methods.archive_purchase_orders(user_id)
+        else:
+            return await methods.message(request, user, templates, "Not Authorized",
+                                         "You can only download your own purchase orders.")
+    else:
+        return await methods.message(request, user, templates, "Not Authenticated", "Please login first.")
+
+
 @app.get("/purchase_orders/{po_id}", response_class=HTMLResponse)
 async def purchase_orders(request: Request, po_id: uuid.UUID, user: models.User = Depends(auth.get_current_user)):
     if user:
@@ -279,6 +509,56 @@ async def purchase_orders(request: Request, po_id: uuid.UUID, user: models.User
         return await methods.message(request, user, templates, "Not Authenticated", "Please login first.")
 
 
+@app.post("/purchase_orders/{po_id}/attachments", response_class=HTMLResponse)
+async def upload_attachment(
+        request: Request,
+        po_id: uuid.UUID,
+        user: models.User = Depends(auth.get_current_user),
+        file: UploadFile = File(...)
+):
+    if user:
+        po = await methods.get_purchase_order(po_id)
+        if po is None:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND)
+        try:
+            row = await methods.add_attachment(po, user, file)
+        except HTTPException as e:
+            return await methods.message(request, user, templates, "Not Attached", e.detail)
+        return await methods.message(request, user, templates, "Attachment Added",
+                                     "{} was encrypted and attached to Purchase Order #{}.".format(
+                                         row['file_name'], po.purchase_order_number))
+    else:
+        return await methods.message(request, user, templates, "Not Authenticated", "Please login first.")
+
+
+@app.get("/attachments/{attachment_id}")
+async def download_attachment(request: Request, attachment_id: uuid.UUID, token: str):
+    # Streams a decrypted attachment, or the requested byte range of it, for a link handed out when its order was
+    # opened. The link only works for the user it was made for.
+    user = await auth.get_current_user(request)
+    authorization = request.headers.get("authorization", "")
+    if user is None and authorization.startswith("Bearer "):
+        user = await auth.get_user_from_token(authorization[7:])
+    row = await attachments.get_attachment(attachment_id)
+    file_key = attachments.file_key_of(token, user['user_id'], attachment_id) if user and row else None
+    if file_key is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND)
+
+    media_type, headers = attachments.download_headers(row)
+    headers.update({
+        "Accept-Ranges": "bytes",
+        "Cache-Control": "private, no-store",
+    })
+    requested = attachments.byte_range(request.headers.get("range"), row['size'])
+    first, last = requested or (0, row['size'] - 1)
+    headers["Content-Length"] = str(last - first + 1)
+    if requested:
+        headers["Content-Range"] = "bytes {}-{}/{}".format(first, last, row['size'])
+    return StreamingResponse(attachments.decrypted(row, file_key, first, last), media_type=media_type,
+                             headers=headers,
+                             status_code=status.HTTP_206_PARTIAL_CONTENT if requested else status.HTTP_200_OK)
+
+
 @app.get("/new_purchase_order", response_class=HTMLResponse)
 async def purchase(request: Request, user: models.User = Depends(auth.get_current_user)):
     if user:
@@ -286,7 +566,8 @@ async def purchase(request: Request, user: models.User = Depends(auth.get_curren
         return templates.TemplateResponse("new_purchase_order.html", {
             "request": request,
             "user": user,
-            "supervisors": supervisors
+            "supervisors": supervisors,
+            "idempotency_key": uuid.uuid4()
         })
     else:
         return await methods.message(request, user, templates, "Not Authenticated", "Please login first.")
@@ -318,13 +599,16 @@ async def purchase_orders(
         user: models.User = Depends(auth.get_current_user),
         purchaser_id: uuid.UUID = Form(...),
         accept: bool = Form(...),
-        password: str = Form(...)
+        password: str = Form(...),
+        idempotency_key: Optional[str] = Form(None),
+        idempotency_key_header: Optional[str] = Header(None, alias="Idempotency-Key")
 ):
     if user:
         po = await methods.get_purchase_order(po_id)
 
         if user['user_id'] == po.recipient_id:
-            return await methods.review_purchase_order(request, templates, po_id, user, purchaser_id, password, accept)
+            return await methods.review_purchase_order(request, templates, po_id, user, purchaser_id, password, accept,
+                                                       idempotency_key or idempotency_key_header)
         else:
             return await methods.message(request, user, templates, "Not Authorized",
                                          "You are not authorized to view this purchase.")
@@ -340,12 +624,15 @@ async def submit_order(
         supplier_name: str = Form(...),
         supplier_contact: str = Form(...),
         supplier_address: str = Form(...),
-        item_number: List[str] = Form(...),
-        item_quantity: List[int] = Form(...),
-        item_price: List[float] = Form(...),
-        item_url: List[str] = Form(...),
-        item_details: List[str] = Form(...),
-        password: str = Form(...)
+        item_number: List[str] = Form([]),
+        item_quantity: List[str] = Form([]),
+        item_price: List[str] = Form([]),
+        item_url: List[str] = Form([]),
+        item_details: List[str] = Form([]),
+        items_file: Optional[UploadFile] = File(None),
+        password: str = Form(...),
+        idempotency_key: Optional[str] = Form(None),
+        idempotency_key_header: Optional[str] = Header(None, alias="Idempotency-Key")
 ):
     return await methods.submit_purchase_order(
         request,
@@ -360,7 +647,9 @@ async def submit_order(
         item_price,
         item_url,
         item_details,
-        password
+        password,
+        idempotency_key or idempotency_key_header,
+        items_file
     )
 
 
@@ -1,4 +1,5 @@
-from sqlalchemy import Column, Integer, String, Boolean, Table, MetaData, Enum, Float, ForeignKey, DateTime, func, TEXT
+from sqlalchemy import Column, Integer, String, Boolean, Table, MetaData, Enum, Float, ForeignKey, DateTime, Date, \
+    BigInteger, func, TEXT
 from sqlalchemy.dialects.postgresql import UUID
 
 metadata = MetaData()
@@ -43,7 +44,116 @@ purchase_orders = (
           Column('purchaser_id', UUID, ForeignKey('users.user_id', ondelete='cascade')),
           Column('email_content', TEXT),
           Column('json_content', TEXT),
-          Column('sent_timestamp', DateTime, server_default=func.now()),
+          Column('sent_timestamp', DateTime, primary_key=True, server_default=func.now()),
           Column('reviewed_timestamp', DateTime),
-          Column('status', Boolean)
+          Column('status', Boolean),
+          Column('sender_name', String(201)),
+          Column('recipient_name', String(201)),
+          Column('purchaser_name', String(201)),
+          Column('order_digest', String(64)),
+          Column('timestamp_batch_id', BigInteger),
+          Column('timestamp_proof', TEXT),
+          Column('review_digest', String(64)),
+          Column('review_batch_id', BigInteger),
+          Column('review_proof', TEXT),
+          ))
+
+# reviewed purchase orders moved out of purchase_orders by `python manage.py archive-orders`
+purchase_orders_archive = (
+    Table('purchase_orders_archive', metadata,
+          Column('purchase_order_id', UUID, primary_key=True),
+          Column('purchase_order_number', Integer, nullable=False),
+          Column('sender_id', UUID, ForeignKey('users.user_id', ondelete='cascade')),
+          Column('recipient_id', UUID, ForeignKey('users.user_id', ondelete='cascade')),
+          Column('purchaser_id', UUID, ForeignKey('users.user_id', ondelete='cascade')),
+          Column('email_content', TEXT),
+          Column('json_content', TEXT),
+          Column('sent_timestamp', DateTime, nullable=False),
+          Column('reviewed_timestamp', DateTime),
+          Column('status', Boolean),
+          Column('sender_name', String(201)),
+          Column('recipient_name', String(201)),
+          Column('purchaser_name', String(201)),
+          Column('order_digest', String(64)),
+          Column('timestamp_batch_id', BigInteger),
+          Column('timestamp_proof', TEXT),
+          Column('review_digest', String(64)),
+          Column('review_batch_id', BigInteger),
+          Column('review_proof', TEXT),
+          Column('archived_timestamp', DateTime, nullable=False, server_default=func.now()),
+          ))
+
+# signed Merkle roots of batches of purchase order digests, see timestamping.py
+timestamp_batches = (
+    Table('timestamp_batches', metadata,
+          Column('batch_id', BigInteger, primary_key=True, autoincrement=True),
+          Column('root', String(64), nullable=False),
+          Column('leaf_count', Integer, nullable=False),
+          Column('sealed_timestamp', DateTime, nullable=False),
+          Column('signature', TEXT, nullable=False),
+          ))
+
+token_revocations = (
+    Table('token_revocations', metadata,
+          Column('user_id', UUID, primary_key=True),
+          Column('token_version', Integer, nullable=False),
+          Column('revoked_timestamp', DateTime, server_default=func.now()),
+          ))
+
+# a user's previous key while their purchase orders are re-encrypted to a new one, see rotation.py
+key_rotations = (
+    Table('key_rotations', metadata,
+          Column('user_id', UUID, ForeignKey('users.user_id', ondelete='cascade'), primary_key=True),
+          Column('retired_public_key', TEXT),
+          Column('retired_private_key', TEXT),
+          Column('retired_salt', TEXT),
+          Column('resign_server', Boolean, nullable=False, default=False),
+          Column('checkpoint', Integer, nullable=False, default=0),
+          Column('started_timestamp', DateTime, server_default=func.now()),
+          ))
+
+idempotency_keys = (
+    Table('idempotency_keys', metadata,
+          Column('user_id', UUID, ForeignKey('users.user_id', ondelete='cascade'), primary_key=True),
+          Column('idempotency_key', String(100), primary_key=True),
+          Column('operation', String(50), nullable=False),
+          Column('request_hash', String(64), nullable=False),
+          Column('status', String(20), nullable=False),
+          Column('result', TEXT),
+          Column('created_timestamp', DateTime, server_default=func.now()),
+          ))
+
+purchase_order_attachments = (
+    Table('purchase_order_attachments', metadata,
+          Column('attachment_id', UUID, primary_key=True),
+          Column('purchase_order_id', UUID, nullable=False, index=True),
+          Column('uploader_id', UUID, ForeignKey('users.user_id', ondelete='set null')),
+          Column('file_name', String(255), nullable=False),
+          Column('content_type', String(100), nullable=False),
+          Column('size', BigInteger, nullable=False),
+          Column('chunk_size', Integer, nullable=False),
+          Column('nonce_prefix', String(16), nullable=False),
+          Column('sha256', String(64), nullable=False),
+          Column('wrapped_key', TEXT, nullable=False),
+          Column('created_timestamp', DateTime, server_default=func.now()),
+          ))
+
+purchase_order_counters = (
+    Table('purchase_order_counters', metadata,
+          Column('user_id', UUID, ForeignKey('users.user_id', ondelete='cascade'), primary_key=True),
+          Column('pending_review', Integer, nullable=False, server_default='0'),
+          Column('awaiting_purchase', Integer, nullable=False, server_default='0'),
+          ))
+
+purchase_order_submissions = (
+    Table('purchase_order_submissions', metadata,
+          Column('user_id', UUID, ForeignKey('users.user_id', ondelete='cascade'), primary_key=True),
+          Column('month', Date, primary_key=True),
+          Column('submitted', Integer, nullable=False, server_default='0'),
+          ))
+
+schema_migrations = (
+    Table('schema_migrations', metadata,
+          Column('name', String(200), primary_key=True),
+          Column('applied_timestamp', DateTime, server_default=func.now()),
           ))
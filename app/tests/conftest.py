@@ -0,0 +1,7 @@
+import os
+import sys
+
+# the application modules import each other by name from app/ and read their settings from the environment at import
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("POSTGRES_PASSWORD", "test")
+os.environ.setdefault("SECRET_KEY", "test")
@@ -0,0 +1,61 @@
+import json
+
+import pytest
+
+from pgpy import PGPMessage
+from pgpy.constants import HashAlgorithm, SymmetricKeyAlgorithm
+
+import crypto
+import kdf
+
+PASSPHRASE = "rotation-test"
+
+
+def new_key(profile, name):
+    return crypto.generate_key(name, "{}@example.com".format(name.lower()), profile)
+
+
+@pytest.mark.parametrize("profile", ["rsa2048", "ed25519"])
+def test_resealed_order_opens_with_new_key(profile):
+    # An order re-encrypted by key rotation opens with the new key and keeps the sender's signature.
+    sender = new_key(profile, "Sender")
+    retired = new_key(profile, "Retired")
+    replacement = new_key(profile, "Replacement")
+    retired.protect(PASSPHRASE, SymmetricKeyAlgorithm.AES256, HashAlgorithm.SHA256)
+    content = json.dumps({"purchase_order": {"supplier_name": "Acme", "items": []}})
+    sealed = crypto.sign_and_encrypt(content, [sender], [sender.pubkey, retired.pubkey])
+
+    resealed, _ = crypto.reseal_orders(str(retired), PASSPHRASE, [
+        ("po", [sealed], [str(sender.pubkey), str(replacement.pubkey)])
+    ], False)
+
+    [(po_id, [message])] = resealed
+    assert po_id == "po"
+    decrypted = replacement.decrypt(PGPMessage.from_blob(message))
+    assert decrypted.message == content
+    assert sender.pubkey.verify(decrypted)
+    assert json.loads(sender.decrypt(PGPMessage.from_blob(message)).message) == json.loads(content)
+
+
+def test_resealed_orders_skip_messages_not_encrypted_to_the_key():
+    retired = new_key("ed25519", "Retired")
+    other = new_key("ed25519", "Other")
+    retired.protect(PASSPHRASE, SymmetricKeyAlgorithm.AES256, HashAlgorithm.SHA256)
+    sealed = crypto.sign_and_encrypt("{}", [other], [other.pubkey])
+
+    resealed, _ = crypto.reseal_orders(str(retired), PASSPHRASE, [("po", [sealed], [str(other.pubkey)])], False)
+
+    assert resealed == [("po", None)]
+
+
+def test_can_open_checks_the_users_current_key():
+    salt = kdf.new_salt()
+    user = new_key("ed25519", "User")
+    other = new_key("ed25519", "Other")
+    user.protect(kdf.derive_key(PASSPHRASE, salt), SymmetricKeyAlgorithm.AES256, HashAlgorithm.SHA256)
+
+    readable = crypto.sign_and_encrypt("{}", [other], [user.pubkey, other.pubkey])
+    unreadable = crypto.sign_and_encrypt("{}", [other], [other.pubkey])
+
+    assert crypto.can_open(str(user), PASSPHRASE, salt, readable)[0]
+    assert not crypto.can_open(str(user), PASSPHRASE, salt, unreadable)[0]
@@ -0,0 +1,197 @@
+import asyncio
+import contextvars
+import hashlib
+import json
+import logging
+
+from datetime import datetime
+from sqlalchemy.sql import select
+
+import constants
+import crypto
+import metrics
+import tables
+
+from database import database
+
+# Server timestamps of purchase orders. Instead of signing every order with the server key at submission and again at
+# review, each worker collects the SHA-256 digests handed to `stamp` for TIMESTAMP_WINDOW_MS (or until
+# TIMESTAMP_BATCH_MAX are waiting), builds a Merkle tree over them and signs only its root, once, in the crypto pool.
+# The root, its signature and the time it was sealed are stored in timestamp_batches; every order keeps its digest and
+# the inclusion proof of that digest in its row.
+#
+# Leaves are sha256(0x00 || digest) and inner nodes sha256(0x01 || left || right), so a leaf can never pass for an
+# inner node; a node without a sibling is carried up unchanged. A proof is a JSON list of [side, hash] steps from the
+# leaf up, side being "L" or "R" for a sibling on the left or the right. Verifying an order therefore takes a few
+# hashes plus one signature check per batch, which each worker caches.
+
+STATEMENT = "spo-timestamp-v1:{root}:{leaf_count}:{sealed}"
+
+logger = logging.getLogger(__name__)
+
+BATCHES = metrics.Counter("timestamp_batches_total", "Merkle timestamp batches sealed")
+BATCH_SIZE = metrics.Histogram("timestamp_batch_size", "Digests per sealed timestamp batch",
+                               buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000))
+
+
+def leaf_hash(digest: str):
+    return hashlib.sha256(b"\x00" + bytes.fromhex(digest)).digest()
+
+
+def node_hash(left: bytes, right: bytes):
+    return hashlib.sha256(b"\x01" + left + right).digest()
+
+
+def merkle_tree(digests):
+    # Returns (root, proofs): the hex root over the hex digests and the inclusion proof of each of them.
+    level = [leaf_hash(digest) for digest in digests]
+    proofs = [[] for _ in digests]
+    positions = list(range(len(digests)))
+    while len(level) > 1:
+        for leaf, position in enumerate(positions):
+            sibling = position ^ 1
+            if sibling < len(level):
+                proofs[leaf].append(["L" if sibling < position else "R", level[sibling].hex()])
+            positions[leaf] = position // 2
+        level = [node_hash(level[i], level[i + 1]) if i + 1 < len(level) else level[i]
+                 for i in range(0, len(level), 2)]
+    return level[0].hex(), proofs
+
+
+def proof_root(digest: str, proof):
+    # The root an inclusion proof leads to from a hex digest.
+    node = leaf_hash(digest)
+    for side, sibling in proof:
+        sibling = bytes.fromhex(sibling)
+        node = node_hash(sibling, node) if side == "L" else node_hash(node, sibling)
+    return node.hex()
+
+
+def statement(root: str, leaf_count: int, sealed: datetime):
+    # The text signed by the server key for a batch.
+    return STATEMENT.format(root=root, leaf_count=leaf_count, sealed=sealed.isoformat())
+
+
+def digest_of(content: str):
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
+def review_digest(po_id, content_digest: str, accept: bool, purchaser_id, reviewed: datetime):
+    # The digest timestamped for a review: the decision, the purchaser it assigned and the reviewed contents.
+    return digest_of(json.dumps({
+        "purchase_order_id": str(po_id),
+        "content_digest": content_digest,
+        "status": accept,
+        "purchaser_id": None if purchaser_id is None else str(purchaser_id),
+        "reviewed_timestamp": reviewed.isoformat(),
+    }, sort_keys=True))
+
+
+class Timestamper:
+
+    def __init__(self):
+        self.pending = []
+        self.timer = None
+        self.sealing = set()
+
+    def add(self, digest: str):
+        # Queues a digest for the next batch and returns a future for its (batch id, proof).
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending.append((digest, future))
+        if len(self.pending) >= constants.TIMESTAMP_BATCH_MAX:
+            self.flush()
+        elif self.timer is None:
+            # the batch belongs to no single request, so it is sealed outside the request's trace and read session
+            self.timer = loop.call_later(constants.TIMESTAMP_WINDOW_MS / 1000, self.flush,
+                                         context=contextvars.Context())
+        return future
+
+    def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        batch, self.pending = self.pending, []
+        if batch:
+            task = contextvars.Context().run(asyncio.ensure_future, self.seal(batch))
+            self.sealing.add(task)
+            task.add_done_callback(self.sealing.discard)
+
+    async def seal(self, batch):
+        # Builds the tree of a batch, signs and stores its root and resolves every waiting future.
+        try:
+            root, proofs = merkle_tree([digest for digest, _ in batch])
+            sealed = datetime.utcnow()
+            signature = await crypto.run(crypto.sign_timestamp, statement(root, len(batch), sealed))
+            query = tables.timestamp_batches.insert().values(
+                root=root,
+                leaf_count=len(batch),
+                sealed_timestamp=sealed,
+                signature=signature
+            ).returning(tables.timestamp_batches.c.batch_id)
+            batch_id = await database.fetch_val(query)
+        except Exception as e:
+            logger.warning(f"sealing a timestamp batch of {len(batch)} failed: {e}")
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        BATCHES.inc()
+        BATCH_SIZE.observe(len(batch))
+        for (_, future), proof in zip(batch, proofs):
+            if not future.done():
+                future.set_result((batch_id, json.dumps(proof)))
+
+
+stamper = Timestamper()
+
+
+async def stamp(digest: str):
+    # Timestamps a hex SHA-256 digest. Returns (batch id, proof) once the batch it joined is sealed.
+    return await asyncio.shield(stamper.add(digest))
+
+
+# (statement, signature) pairs this worker has verified
+_verified = set()
+
+
+async def verify_batch(batch_id):
+    # Returns the batch's row if its root signature is valid, None otherwise.
+    row = await database.fetch_one(
+        select([tables.timestamp_batches]).where(tables.timestamp_batches.c.batch_id == batch_id))
+    if row is None:
+        return None
+    signed = (statement(row['root'], row['leaf_count'], row['sealed_timestamp']), row['signature'])
+    if signed not in _verified:
+        if not await crypto.run(crypto.verify_timestamp, *signed):
+            return None
+        if len(_verified) > constants.CRYPTO_KEY_CACHE_SIZE:
+            _verified.clear()
+        _verified.add(signed)
+    return row
+
+
+async def verify(digest: str, batch_id, proof: str):
+    # Whether a digest is included in a batch with a valid root signature.
+    if not digest or batch_id is None or not proof:
+        return False
+    row = await verify_batch(batch_id)
+    if row is None:
+        return False
+    try:
+        return proof_root(digest, json.loads(proof)) == row['root']
+    except (ValueError, TypeError):
+        return False
+
+
+async def resign_batches():
+    # Re-signs every batch root with the current server key, after server_private_key.asc was replaced. Returns the
+    # number of batches.
+    rows = await database.fetch_all(select([tables.timestamp_batches]))
+    for row in rows:
+        signature = await crypto.run(crypto.sign_timestamp,
+                                     statement(row['root'], row['leaf_count'], row['sealed_timestamp']))
+        await database.execute(tables.timestamp_batches.update().where(
+            tables.timestamp_batches.c.batch_id == row['batch_id']).values(signature=signature))
+    return len(rows)
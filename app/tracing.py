@@ -0,0 +1,118 @@
+import contextlib
+import contextvars
+import json
+import os
+import random
+import time
+
+from datetime import datetime
+from fastapi.templating import Jinja2Templates
+
+import constants
+
+# Per-request span timelines. log_requests starts a trace for a sampled request (TRACE_SAMPLE_RATE, or an
+# administrator's `X-Trace: 1` header) and every `span` opened while handling it is recorded with its parent, so one
+# request's time can be split into KDF, key handling, signing, encryption, database calls, email and rendering. The
+# finished trace is written to TRACE_ROOT in the Chrome trace-event format; open it in chrome://tracing or Perfetto.
+#
+# Outside a trace `span` yields None and records nothing.
+
+_trace = contextvars.ContextVar("trace", default=None)
+_parent = contextvars.ContextVar("span", default=None)
+
+
+class Trace:
+
+    def __init__(self, rid: str, name: str):
+        self.rid = rid
+        self.name = name
+        self.origin = time.perf_counter()
+        self.wall_origin = time.time()
+        self.started = datetime.utcnow()
+        self.spans = []
+
+    def events(self):
+        pid = os.getpid()
+        return [
+            {
+                "name": span["name"],
+                "cat": span["name"].split(".")[0],
+                "ph": "X",
+                "ts": round((span["start"] - self.origin) * 1e6, 1),
+                "dur": round(span["duration"] * 1e6, 1),
+                "pid": pid,
+                "tid": self.rid,
+                "args": dict(span["args"], rid=self.rid, id=span["id"], parent=span["parent"]),
+            }
+            for span in self.spans
+        ]
+
+
+def sampled(requested: bool):
+    return requested or (constants.TRACE_SAMPLE_RATE > 0 and random.random() < constants.TRACE_SAMPLE_RATE)
+
+
+def start(rid: str, name: str):
+    # Starts a trace for the current request. Returns the token to pass to `finish`.
+    return _trace.set(Trace(rid, name))
+
+
+def finish(token):
+    # Ends the current trace and writes it out, returning the file name.
+    trace = _trace.get()
+    _trace.reset(token)
+    name = "{}-{}.trace.json".format(trace.started.strftime("%Y%m%dT%H%M%S"), trace.rid)
+    os.makedirs(constants.TRACE_ROOT, exist_ok=True)
+    with open(os.path.join(constants.TRACE_ROOT, name), "w") as file:
+        json.dump({
+            "traceEvents": trace.events(),
+            "displayTimeUnit": "ms",
+            "otherData": {"rid": trace.rid, "request": trace.name, "started": trace.started.isoformat()},
+        }, file)
+    return name
+
+
+@contextlib.contextmanager
+def span(name: str, **tags):
+    trace = _trace.get()
+    if trace is None:
+        yield None
+        return
+
+    record = {"id": len(trace.spans), "parent": _parent.get(), "name": name, "args": tags,
+              "start": time.perf_counter(), "duration": 0.0}
+    trace.spans.append(record)
+    token = _parent.set(record["id"])
+    try:
+        yield record
+    except BaseException as e:
+        record["args"]["error"] = type(e).__name__
+        raise
+    finally:
+        record["duration"] = time.perf_counter() - record["start"]
+        _parent.reset(token)
+
+
+def tag(record, **tags):
+    if record is not None:
+        record["args"].update(tags)
+
+
+def add_phases(phases):
+    # Adds spans timed elsewhere, e.g. in a crypto worker process, as children of the current span. Phases are
+    # (name, wall clock start, duration, tags).
+    trace = _trace.get()
+    if trace is None:
+        return
+    parent = _parent.get()
+    for name, start, duration, tags in phases:
+        trace.spans.append({"id": len(trace.spans), "parent": parent, "name": name, "args": dict(tags),
+                            "start": trace.origin + (start - trace.wall_origin), "duration": duration})
+
+
+class TracedTemplates(Jinja2Templates):
+    # Jinja2Templates that records a span for every render.
+
+    def TemplateResponse(self, name: str, context: dict, *args, **kwargs):
+        with span("render", template=name):
+            return super().TemplateResponse(name, context, *args, **kwargs)